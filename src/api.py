@@ -11,6 +11,7 @@ from easyrag.utils import get_yaml_data
 class QueryRequest(BaseModel):
     query: str = ""
     document: str = ""
+    hnsw_ef: int = 0
 
 
 class QueryResponse(BaseModel):
@@ -46,8 +47,8 @@ def test():
 
 @app.post("/v1/rag", status_code=status.HTTP_200_OK)
 async def rag(request: QueryRequest):
-    # query对象: {"query":"Daisyseed安装软件从哪里获取", "document":"director"}
-    query = {"query": request.query, "document": request.document}
+    # query对象: {"query":"Daisyseed安装软件从哪里获取", "document":"director", "hnsw_ef": 128}
+    query = {"query": request.query, "document": request.document, "hnsw_ef": request.hnsw_ef}
     res = await easyrag.run(
         query
     )
@@ -0,0 +1,659 @@
+import json
+import math
+import os
+import shutil
+import threading
+import weakref
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+import scipy.sparse as sp
+
+from ..utils.lru import LRUCache
+
+BM25_INDEX_VERSION = 2
+# bm25_type 与打分公式的对应关系：0-->BM25Okapi 1-->bm25s 2-->内置稀疏矩阵实现(公式同BM25Okapi)
+BM25_METHODS = {0: "okapi", 1: "lucene", 2: "okapi"}
+BM25_SHARD_ARRAYS = ["shard_of_doc", "doc_ids", "doc_ptr", "impacts", "indices", "indptr", "offsets"]
+
+
+class AnalyzedQuery:
+    """
+    分词并去停用词后的查询。不同索引的词表不同，词项编号按索引分别查找并缓存，
+    同一查询在稀疏检索、路径检索和上下文压缩中只需分词一次。
+    """
+
+    def __init__(self, query_str: str, tokens: List[str]):
+        self.query_str = query_str
+        self.tokens = tokens
+        self._term_ids = weakref.WeakKeyDictionary()
+
+    def term_ids(self, index: "BM25Index") -> List[int]:
+        term_ids = self._term_ids.get(index)
+        if term_ids is None:
+            term_ids = index.term_ids(self.tokens)
+            self._term_ids[index] = term_ids
+        return term_ids
+
+    def idf(self, index: "BM25Index") -> np.ndarray:
+        return np.asarray(index.idf)[self.term_ids(index)]
+
+
+class QueryAnalyzer:
+    """对查询分词并去停用词，结果放入定长LRU缓存，重复的查询直接复用"""
+
+    def __init__(self, tokenize: Callable[[str], List[str]], cache_size: int = 1024):
+        self.tokenize = tokenize
+        self.cache = LRUCache(cache_size)
+
+    def analyze(self, query: Union[str, AnalyzedQuery]) -> AnalyzedQuery:
+        if isinstance(query, AnalyzedQuery):
+            return query
+        return self.cache.get_or_compute(query, lambda: AnalyzedQuery(query, self.tokenize(query)))
+
+
+# 查询可以是词列表，也可以是已分析的查询
+Query = Union[List[str], AnalyzedQuery]
+
+
+class BM25Index:
+    """
+    以CSR格式存放的BM25倒排索引：每个词项一行，记录包含它的文档编号和词频。
+    method="okapi" 与 rank_bm25.BM25Okapi 打分一致，method="lucene" 与 bm25s 默认实现打分一致。
+    所有数组均可保存为npy文件，并以只读内存映射的方式加载，多个进程共享同一份页缓存。
+    提供 impacts(每个倒排项预先算好的BM25分量)时，查询打分是一次稀疏向量乘矩阵。
+    分量以float64存放，计算顺序与BM25Okapi相同，查询词逐个累加，分数与BM25Okapi逐位一致。
+    提供 weights 时每个文档代表 weights[i] 个内容相同的文档，文档数、df和平均文档长度按权重统计，
+    打分与把重复文档逐个建索引完全一致。
+    """
+
+    def __init__(
+            self,
+            vocab: List[str],
+            indptr: np.ndarray,
+            indices: np.ndarray,
+            tfs: np.ndarray,
+            doc_len: np.ndarray,
+            idf: np.ndarray,
+            k1: float = 1.5,
+            b: float = 0.75,
+            epsilon: float = 0.25,
+            method: str = "okapi",
+            impacts: Optional[np.ndarray] = None,
+            weights: Optional[np.ndarray] = None,
+    ):
+        if method not in ("okapi", "lucene"):
+            raise ValueError(f"Unsupported bm25 method: {method}")
+        self.vocab = vocab
+        self.vocab_dict = {term: i for i, term in enumerate(vocab)}
+        self.indptr = indptr
+        self.indices = indices
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.idf = idf
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.method = method
+        self.num_docs = len(doc_len)
+        self.weights = weights
+        if weights is None:
+            self.avgdl = float(np.asarray(doc_len, dtype=np.float64).mean()) if self.num_docs else 0.0
+        else:
+            w = np.asarray(weights, dtype=np.float64)
+            self.avgdl = float((np.asarray(doc_len, dtype=np.float64) * w).sum() / max(w.sum(), 1))
+        # 文档长度归一项与查询无关，加载时计算一次
+        self._norm = self.k1 * (1 - self.b + self.b * np.asarray(doc_len, dtype=np.float64) / max(self.avgdl, 1e-9))
+        self._tf_scale = self.k1 + 1 if method == "okapi" else 1.0
+        self.impacts = impacts
+        self._matrix = None
+        if impacts is not None:
+            # 词项 x 文档 的分量矩阵，直接包装已有数组，不复制内存映射的数据
+            self._matrix = sp.csr_matrix((impacts, indices, indptr), shape=(len(vocab), self.num_docs))
+
+    def compute_impacts(self) -> np.ndarray:
+        term_ids = np.repeat(np.arange(len(self.vocab)), np.diff(self.indptr))
+        tf = np.asarray(self.tfs, dtype=np.float64)
+        return np.asarray(self.idf)[term_ids] * (tf * self._tf_scale / (tf + self._norm[self.indices]))
+
+    @classmethod
+    def from_corpus(
+            cls,
+            corpus: List[List[str]],
+            k1: float = 1.5,
+            b: float = 0.75,
+            epsilon: float = 0.25,
+            method: str = "okapi",
+            with_impacts: bool = False,
+            weights: Optional[np.ndarray] = None,
+    ) -> "BM25Index":
+        vocab_dict = dict()
+        doc_term = build_doc_term(corpus, vocab_dict)
+        return cls.from_doc_term(doc_term, list(vocab_dict), k1=k1, b=b, epsilon=epsilon, method=method,
+                                 with_impacts=with_impacts, weights=weights)
+
+    @classmethod
+    def from_doc_term(
+            cls,
+            doc_term: sp.csr_matrix,
+            vocab: List[str],
+            k1: float = 1.5,
+            b: float = 0.75,
+            epsilon: float = 0.25,
+            method: str = "okapi",
+            with_impacts: bool = False,
+            weights: Optional[np.ndarray] = None,
+    ) -> "BM25Index":
+        # 去掉不再出现的词项，保证idf(尤其是平均idf)与全量重建一致
+        df = np.bincount(doc_term.indices, minlength=len(vocab))
+        num_docs = doc_term.shape[0]
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.int32)
+            num_docs = int(weights.sum())
+            df_weighted = np.bincount(doc_term.indices, minlength=len(vocab),
+                                      weights=np.repeat(weights, np.diff(doc_term.indptr)))
+        keep = np.flatnonzero(df)
+        if len(keep) < len(vocab):
+            doc_term = doc_term[:, keep]
+            vocab = [vocab[i] for i in keep]
+            df = df[keep]
+            if weights is not None:
+                df_weighted = df_weighted[keep]
+        if weights is not None:
+            df = df_weighted
+        term_doc = doc_term.T.tocsr()
+        term_doc.sort_indices()
+        doc_len = np.asarray(doc_term.sum(axis=1)).ravel().astype(np.int32)
+        idf = cls.compute_idf(df.astype(np.float64), num_docs, epsilon, method)
+        index = cls(
+            vocab=vocab,
+            indptr=term_doc.indptr.astype(np.int64),
+            indices=term_doc.indices.astype(np.int32),
+            tfs=term_doc.data.astype(np.int32),
+            doc_len=doc_len,
+            idf=idf,
+            k1=k1,
+            b=b,
+            epsilon=epsilon,
+            method=method,
+            weights=weights,
+        )
+        if with_impacts:
+            index = index.with_impacts()
+        return index
+
+    def with_impacts(self) -> "BM25Index":
+        return BM25Index(
+            vocab=self.vocab,
+            indptr=self.indptr,
+            indices=self.indices,
+            tfs=self.tfs,
+            doc_len=self.doc_len,
+            idf=self.idf,
+            k1=self.k1,
+            b=self.b,
+            epsilon=self.epsilon,
+            method=self.method,
+            impacts=self.compute_impacts(),
+            weights=self.weights,
+        )
+
+    def doc_term_matrix(self, num_terms: int = None) -> sp.csr_matrix:
+        term_doc = sp.csr_matrix(
+            (np.asarray(self.tfs), np.asarray(self.indices), np.asarray(self.indptr)),
+            shape=(len(self.vocab), self.num_docs),
+        )
+        doc_term = term_doc.T.tocsr()
+        if num_terms is not None:
+            doc_term = sp.csr_matrix((doc_term.data, doc_term.indices, doc_term.indptr),
+                                     shape=(self.num_docs, num_terms))
+        return doc_term
+
+    def merge(self, doc_sources: List[Union[int, List[str]]]) -> "BM25Index":
+        """
+        按 doc_sources 的顺序生成新索引：整数表示沿用本索引中对应编号文档的词频，
+        词列表表示需要新加入的文档。只有新文档需要分词，其余文档直接复用。
+        """
+        if self.weights is not None:
+            raise ValueError("Weighted BM25 index cannot be merged, rebuild it instead.")
+        vocab_dict = dict(self.vocab_dict)
+        new_corpus, selector = [], []
+        for source in doc_sources:
+            if isinstance(source, (int, np.integer)):
+                selector.append(int(source))
+            else:
+                selector.append(self.num_docs + len(new_corpus))
+                new_corpus.append(source)
+        new_doc_term = build_doc_term(new_corpus, vocab_dict)
+        doc_term = sp.vstack([
+            self.doc_term_matrix(num_terms=len(vocab_dict)),
+            new_doc_term,
+        ], format="csr")[selector]
+        return self.from_doc_term(doc_term, list(vocab_dict), k1=self.k1, b=self.b,
+                                  epsilon=self.epsilon, method=self.method,
+                                  with_impacts=self.impacts is not None)
+
+    @staticmethod
+    def compute_idf(df: np.ndarray, num_docs: float, epsilon: float = 0.25, method: str = "okapi") -> np.ndarray:
+        if method == "lucene":
+            return np.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+        # 与BM25Okapi逐项相同的计算方式(math.log、按词表顺序累加)，idf逐位一致
+        idf = np.array([math.log(num_docs - freq + 0.5) - math.log(freq + 0.5) for freq in df.tolist()],
+                       dtype=np.float64)
+        # 与BM25Okapi一致：负的idf替换为 epsilon * 平均idf
+        if len(idf) > 0:
+            average_idf = sum(idf.tolist()) / len(idf)
+            idf[idf < 0] = epsilon * average_idf
+        return idf
+
+    def term_ids(self, tokens: Query) -> List[int]:
+        if isinstance(tokens, AnalyzedQuery):
+            return tokens.term_ids(self)
+        # 保留重复词项，与BM25Okapi/bm25s对重复查询词的处理一致
+        return [self.vocab_dict[token] for token in tokens if token in self.vocab_dict]
+
+    def query_vector(self, tokens: Query) -> sp.csr_matrix:
+        return self.query_matrix([tokens])
+
+    def query_matrix(self, queries: List[Query]) -> sp.csr_matrix:
+        # 每个查询一行，每个查询词一项(重复的词不合并)，矩阵乘法按查询词顺序逐个累加分量，与BM25Okapi一致
+        indices, indptr = [], [0]
+        for tokens in queries:
+            indices.extend(self.term_ids(tokens))
+            indptr.append(len(indices))
+        return sp.csr_matrix(
+            (np.ones(len(indices), dtype=np.float64),
+             np.array(indices, dtype=np.int32),
+             np.array(indptr, dtype=np.int64)),
+            shape=(len(queries), len(self.vocab)),
+        )
+
+    def get_batch_scores(self, queries: List[Query]) -> sp.csr_matrix:
+        """
+        一次稀疏矩阵乘法为整批查询打分，返回 查询 x 文档 的稀疏分数矩阵，
+        只包含与查询有共同词项的文档，未出现的文档分数为0。
+        """
+        if self._matrix is None:
+            raise ValueError("Batch scoring requires an index with impacts.")
+        scores = (self.query_matrix(queries) @ self._matrix).tocsr()
+        scores.sort_indices()
+        return scores
+
+    def get_scores(self, tokens: Query) -> np.ndarray:
+        if self._matrix is not None:
+            return (self.query_vector(tokens) @ self._matrix).toarray().ravel()
+        scores = np.zeros(self.num_docs, dtype=np.float64)
+        for term_id in self.term_ids(tokens):
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs = self.indices[start:end]
+            tf = self.tfs[start:end]
+            scores[docs] += self.idf[term_id] * (tf * self._tf_scale / (tf + self._norm[docs]))
+        return scores
+
+    def save(self, save_dir: str):
+        # 先写入临时目录再整体替换，避免读者看到写了一半的索引
+        tmp_dir = save_dir.rstrip("/") + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        for name in ["indptr", "indices", "tfs", "doc_len", "idf", "impacts", "weights"]:
+            if getattr(self, name) is not None:
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+        with open(os.path.join(tmp_dir, "vocab.json"), "w", encoding="utf-8") as f:
+            f.write(json.dumps(self.vocab, ensure_ascii=False))
+        meta = {
+            "version": BM25_INDEX_VERSION,
+            "method": self.method,
+            "k1": self.k1,
+            "b": self.b,
+            "epsilon": self.epsilon,
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            f.write(json.dumps(meta))
+        if os.path.exists(save_dir):
+            shutil.rmtree(save_dir)
+        os.replace(tmp_dir, save_dir)
+
+    @classmethod
+    def load(cls, save_dir: str, mmap: bool = True) -> "BM25Index":
+        with open(os.path.join(save_dir, "meta.json")) as f:
+            meta = json.loads(f.read())
+        if meta["version"] != BM25_INDEX_VERSION:
+            raise ValueError(f"BM25 index version mismatch: {meta['version']} != {BM25_INDEX_VERSION}")
+        with open(os.path.join(save_dir, "vocab.json"), encoding="utf-8") as f:
+            vocab = json.loads(f.read())
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(os.path.join(save_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ["indptr", "indices", "tfs", "doc_len", "idf", "impacts", "weights"]
+            if os.path.exists(os.path.join(save_dir, f"{name}.npy"))
+        }
+        return cls(
+            vocab=vocab,
+            k1=meta["k1"],
+            b=meta["b"],
+            epsilon=meta["epsilon"],
+            method=meta["method"],
+            **arrays,
+        )
+
+
+_shard_executor = None
+_shard_executor_lock = threading.Lock()
+
+
+def shard_executor() -> ThreadPoolExecutor:
+    # 所有分片检索器共用一个线程池，线程数不随检索器个数增加
+    global _shard_executor
+    with _shard_executor_lock:
+        if _shard_executor is None:
+            _shard_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _shard_executor
+
+
+class BM25Shards:
+    """
+    按元数据编码把文档划分为分片，每个分片是一个独立的 词项 x 分片内文档 的CSR分量矩阵。
+    所有分片的分量和文档编号依次连续存放在同一组数组中，每个分片的矩阵只是这组数组上的切片视图，
+    可以保存为npy文件并以内存映射的方式加载，与 BM25Index 一样在多个进程间共享页缓存。
+    分量使用全局的idf和平均文档长度计算，因此分片内的分数与不分片时完全一致。
+    编码为 -1(缺少该元数据)的文档单独放在最后一个分片，保证不过滤时覆盖全部文档。
+    """
+
+    def __init__(
+            self,
+            index: BM25Index,
+            shard_of_doc: np.ndarray,
+            doc_ids: np.ndarray,
+            doc_ptr: np.ndarray,
+            impacts: np.ndarray,
+            indices: np.ndarray,
+            indptr: np.ndarray,
+            offsets: np.ndarray,
+            executor: Optional[ThreadPoolExecutor] = None,
+    ):
+        self.index = index
+        self.shard_of_doc = shard_of_doc  # 文档 -> 分片
+        self.doc_ids = doc_ids  # 按分片依次排列的全局文档编号，第s个分片为 doc_ids[doc_ptr[s]:doc_ptr[s + 1]]
+        self.doc_ptr = doc_ptr
+        self.impacts = impacts  # 按分片、词项依次排列的分量，第s个分片为 impacts[offsets[s]:offsets[s + 1]]
+        self.indices = indices  # 与 impacts 对应的分片内文档编号
+        self.indptr = indptr  # (分片数, 词项数 + 1)，每行是对应分片内的行指针
+        self.offsets = offsets
+        self.num_shards = len(doc_ptr) - 1
+        self.matrices = [
+            sp.csr_matrix(
+                (impacts[offsets[i]:offsets[i + 1]], indices[offsets[i]:offsets[i + 1]], indptr[i]),
+                shape=(len(index.vocab), doc_ptr[i + 1] - doc_ptr[i]),
+            )
+            for i in range(self.num_shards)
+        ]
+        self.executor = executor or shard_executor()
+
+    @classmethod
+    def build(cls, index: BM25Index, codes: np.ndarray, num_codes: int) -> "BM25Shards":
+        if index.impacts is None:
+            raise ValueError("BM25 shards require an index with impacts (bm25_type=2).")
+        shard_of_doc = np.where(codes < 0, num_codes, codes).astype(np.int32)
+        num_shards = num_codes + int((codes < 0).any())
+        doc_ids = np.argsort(shard_of_doc, kind="stable").astype(np.int32)
+        doc_ptr = np.concatenate([[0], np.cumsum(np.bincount(shard_of_doc, minlength=num_shards))]).astype(np.int64)
+        local_pos = np.empty(len(doc_ids), dtype=np.int32)
+        local_pos[doc_ids] = np.arange(len(doc_ids)) - np.repeat(doc_ptr[:-1], np.diff(doc_ptr))
+        # 倒排项按 (分片, 词项) 稳定排序，分片内每个词项的文档编号保持升序
+        num_terms = len(index.vocab)
+        term_ids = np.repeat(np.arange(num_terms, dtype=np.int32), np.diff(index.indptr))
+        postings_doc = np.asarray(index.indices)
+        postings_shard = shard_of_doc[postings_doc]
+        order = np.lexsort((term_ids, postings_shard))
+        counts = np.bincount(postings_shard.astype(np.int64) * num_terms + term_ids,
+                             minlength=num_shards * num_terms).reshape(num_shards, num_terms)
+        indptr = np.zeros((num_shards, num_terms + 1), dtype=np.int64)
+        np.cumsum(counts, axis=1, out=indptr[:, 1:])
+        offsets = np.concatenate([[0], np.cumsum(indptr[:, -1])]).astype(np.int64)
+        return cls(
+            index=index,
+            shard_of_doc=shard_of_doc,
+            doc_ids=doc_ids,
+            doc_ptr=doc_ptr,
+            impacts=np.asarray(index.impacts)[order],
+            indices=local_pos[postings_doc[order]],
+            indptr=indptr,
+            offsets=offsets,
+        )
+
+    def save(self, save_dir: str):
+        tmp_dir = save_dir.rstrip("/") + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        for name in BM25_SHARD_ARRAYS:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+        if os.path.exists(save_dir):
+            shutil.rmtree(save_dir)
+        os.replace(tmp_dir, save_dir)
+
+    @classmethod
+    def load_or_build(
+            cls,
+            index: BM25Index,
+            codes: np.ndarray,
+            num_codes: int,
+            save_dir: str = "",
+            mmap: bool = True,
+    ) -> "BM25Shards":
+        """save_dir 中保存的分片与当前文档的分片划分一致时以内存映射方式加载，否则重新划分并写回"""
+        shard_of_doc = np.where(codes < 0, num_codes, codes)
+        if save_dir and os.path.exists(os.path.join(save_dir, "shard_of_doc.npy")):
+            arrays = {
+                name: np.load(os.path.join(save_dir, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                for name in BM25_SHARD_ARRAYS
+            }
+            if np.array_equal(arrays["shard_of_doc"], shard_of_doc) \
+                    and arrays["indptr"].shape[1] == len(index.vocab) + 1:
+                return cls(index, **arrays)
+        shards = cls.build(index, codes, num_codes)
+        if save_dir:
+            shards.save(save_dir)
+            return cls.load_or_build(index, codes, num_codes, save_dir, mmap=mmap)
+        return shards
+
+    def shard_top_k(
+            self,
+            shard: int,
+            query_vector: sp.csr_matrix,
+            k: int,
+            mask: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        scores = (query_vector @ self.matrices[shard]).toarray().ravel()
+        doc_ids = self.doc_ids[self.doc_ptr[shard]:self.doc_ptr[shard + 1]]
+        top_n = positive_top_k(scores, k, None if mask is None else mask[doc_ids])
+        return doc_ids[top_n], scores[top_n]
+
+    def top_k(
+            self,
+            tokens: Query,
+            k: int,
+            shard: Optional[int] = None,
+            mask: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """返回全局文档编号和分数，结果与不分片时 bm25_top_k 的选择完全一致；指定 shard 时只计算该分片"""
+        query_vector = self.index.query_vector(tokens)
+        # 每个分片多取一个，合并后前k+1个的分数与不分片时相同，可以判断是否有同分
+        if shard is None:
+            results = list(self.executor.map(
+                lambda i: self.shard_top_k(i, query_vector, k + 1, mask), range(self.num_shards)))
+        else:
+            results = [self.shard_top_k(shard, query_vector, k + 1, mask)]
+        doc_ids = np.concatenate([ids for ids, _ in results])
+        scores = np.concatenate([scores for _, scores in results])
+        top_n = np.argsort(-scores, kind="stable")[:k + 1]
+        if has_ties(scores[top_n]):
+            # 同分文档的先后由全部文档分数的 argsort 决定，计算全量分数后按不分片的方式选择
+            all_scores = self.index.get_scores(tokens)
+            if shard is not None:
+                in_shard = np.asarray(self.shard_of_doc) == shard
+                mask = in_shard if mask is None else in_shard & mask
+            top_n = argsort_top_k(all_scores, k, mask)
+            return top_n, all_scores[top_n]
+        top_n = top_n[:k]
+        return doc_ids[top_n], scores[top_n]
+
+
+class BM25SparseEncoder:
+    """
+    把文档和查询编码为qdrant稀疏向量(词项编号, 权重)。
+    文档权重只取BM25中与idf无关的词频饱和部分，idf由qdrant按集合统计(Modifier.IDF)，
+    两者内积即lucene方式的BM25分数，集合增量更新后已写入的文档权重仍然有效。
+    词表只追加、不删除，逐行写入 save_dir/vocab.jsonl；平均文档长度由 fit 在完整语料上统计，之后保持不变。
+    查询端只需要词表和分词器，不需要加载BM25索引。
+    """
+
+    def __init__(
+            self,
+            analyzer: QueryAnalyzer,
+            save_dir: str = "",
+            k1: float = 1.5,
+            b: float = 0.75,
+    ):
+        self.analyzer = analyzer
+        self.save_dir = save_dir
+        self.k1 = k1
+        self.b = b
+        self.avgdl = None
+        self.vocab_dict = dict()
+        if save_dir and os.path.exists(os.path.join(save_dir, "meta.json")):
+            with open(os.path.join(save_dir, "meta.json")) as f:
+                meta = json.loads(f.read())
+            self.k1, self.b, self.avgdl = meta["k1"], meta["b"], meta["avgdl"]
+            self._load_vocab()
+
+    def _load_vocab(self):
+        vocab_file = os.path.join(self.save_dir, "vocab.jsonl")
+        if not os.path.exists(vocab_file):
+            return
+        with open(vocab_file, "rb") as f:
+            lines = f.read().split(b"\n")
+        valid_bytes = 0
+        for line in lines[:-1]:
+            self.vocab_dict.setdefault(json.loads(line), len(self.vocab_dict))
+            valid_bytes += len(line) + 1
+        # 最后一行没有换行符说明写入时中断，截掉后重新追加
+        with open(vocab_file, "ab") as f:
+            f.truncate(valid_bytes)
+
+    def _save(self, new_terms: List[str]):
+        if not self.save_dir:
+            return
+        os.makedirs(self.save_dir, exist_ok=True)
+        meta_file = os.path.join(self.save_dir, "meta.json")
+        if not os.path.exists(meta_file):
+            with open(meta_file + ".tmp", "w") as f:
+                f.write(json.dumps({"k1": self.k1, "b": self.b, "avgdl": self.avgdl}))
+            os.replace(meta_file + ".tmp", meta_file)
+        if new_terms:
+            with open(os.path.join(self.save_dir, "vocab.jsonl"), "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(term, ensure_ascii=False) + "\n" for term in new_terms))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def fit(self, texts: List[str]):
+        """在完整语料上统计平均文档长度，须在编码任何文档之前调用，文档权重与分批写入的方式无关"""
+        lengths = [len(self.analyzer.tokenize(text)) for text in texts]
+        self.avgdl = float(np.mean(lengths)) if lengths else 1.0
+        self._save([])
+
+    def encode_documents(self, texts: List[str]) -> List[Tuple[List[int], List[float]]]:
+        """新词项先写入词表再返回结果，调用方写入qdrant的向量总能在词表中找到对应的词项"""
+        if self.avgdl is None:
+            raise ValueError("BM25SparseEncoder.fit must be called on the full corpus before encoding documents.")
+        corpus = [self.analyzer.tokenize(text) for text in texts]
+        new_terms = []
+        vectors = []
+        for doc in corpus:
+            counts = Counter()
+            for token in doc:
+                if token not in self.vocab_dict:
+                    self.vocab_dict[token] = len(self.vocab_dict)
+                    new_terms.append(token)
+                counts[self.vocab_dict[token]] += 1
+            tf = np.array(list(counts.values()), dtype=np.float64)
+            norm = self.k1 * (1 - self.b + self.b * len(doc) / max(self.avgdl, 1e-9))
+            vectors.append((list(counts.keys()), (tf / (tf + norm)).tolist()))
+        self._save(new_terms)
+        return vectors
+
+    def encode_query(self, query: Union[str, AnalyzedQuery]) -> Tuple[List[int], List[float]]:
+        # 查询词权重为出现次数，词表外的词忽略
+        counts = Counter(self.vocab_dict[token] for token in self.analyzer.analyze(query).tokens
+                         if token in self.vocab_dict)
+        return list(counts.keys()), [float(count) for count in counts.values()]
+
+
+def build_doc_term(corpus: List[List[str]], vocab_dict: dict) -> sp.csr_matrix:
+    # 文档-词项词频矩阵，新词项追加到 vocab_dict 末尾
+    rows, cols = [], []
+    for doc_id, doc in enumerate(corpus):
+        for token in doc:
+            cols.append(vocab_dict.setdefault(token, len(vocab_dict)))
+            rows.append(doc_id)
+    # 重复的(文档, 词项)对在转CSR时累加为词频
+    doc_term = sp.coo_matrix(
+        (np.ones(len(rows), dtype=np.int32), (np.array(rows, dtype=np.int32), np.array(cols, dtype=np.int32))),
+        shape=(len(corpus), len(vocab_dict)),
+    ).tocsr()
+    doc_term.sort_indices()
+    return doc_term
+
+
+def argsort_top_k(scores: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    原 BM25Retriever.filter 的选择方式：全部分数 argsort 后倒序遍历，跳过被过滤和分数非正的文档。
+    同分文档的先后由 argsort 决定，bm25_type 0/1 沿用它，检索结果与之前完全一致。
+    """
+    order = scores.argsort()[::-1]
+    order = order[scores[order] > 0]
+    if mask is not None:
+        order = order[mask[order]]
+    return order[:k]
+
+
+def positive_top_k(scores: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    # 分数大于0且未被过滤的文档中分数最高的至多k个，按分数降序；同分文档之间的先后不作保证
+    candidates = np.flatnonzero(scores > 0 if mask is None else (scores > 0) & mask)
+    if k <= 0:
+        return candidates[:0]
+    if k < len(candidates):
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def has_ties(sorted_scores: np.ndarray) -> bool:
+    return bool((sorted_scores[1:] == sorted_scores[:-1]).any())
+
+
+def bm25_top_k(scores: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    结果与 argsort_top_k 完全一致。argpartition 以O(N)选出前k+1个并排序，其中没有同分时先后顺序唯一；
+    有同分时同分文档的先后(以及边界上保留哪一个)取决于 argsort，回退到 argsort_top_k。
+    """
+    top = positive_top_k(scores, k + 1, mask)
+    if has_ties(scores[top]):
+        return argsort_top_k(scores, k, mask)
+    return top[:k]
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    # argpartition 以O(N)选出前k个，再只对这k个排序；同分时编号小的在前
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < n:
+        # 取出所有不低于第k大分数的文档，边界上的同分文档也全部保留，再按编号决出先后
+        kth = np.partition(-scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(-scores <= kth)
+    else:
+        candidates = np.arange(n)
+    return candidates[np.lexsort((candidates, -scores[candidates]))][:k]
@@ -0,0 +1,46 @@
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+
+# 节点缺少该元数据时的编码，不会与任何过滤值匹配
+MISSING_CODE = -1
+
+
+class MetadataColumns:
+    """
+    将节点的元数据字段(如 dir)一次性编码为整数列，
+    过滤条件 {key: value} 转换为与节点一一对应的布尔掩码，代价与过滤值的稀有程度无关。
+    """
+
+    def __init__(self, nodes: Sequence[BaseNode], keys: Sequence[str] = ("dir",)):
+        self.num_nodes = len(nodes)
+        self.codes: Dict[str, np.ndarray] = dict()
+        self.value2code: Dict[str, dict] = dict()
+        for key in keys:
+            self.add_column(key, [node.metadata.get(key) for node in nodes])
+
+    def add_column(self, key: str, values: List):
+        value2code = dict()
+        codes = np.full(len(values), MISSING_CODE, dtype=np.int32)
+        for i, value in enumerate(values):
+            if value is not None:
+                codes[i] = value2code.setdefault(value, len(value2code))
+        self.codes[key] = codes
+        self.value2code[key] = value2code
+
+    def values(self, key: str) -> List:
+        return list(self.value2code[key])
+
+    def mask(self, filter_dict: Optional[dict]) -> Optional[np.ndarray]:
+        if not filter_dict:
+            return None
+        mask = np.ones(self.num_nodes, dtype=bool)
+        for key, value in filter_dict.items():
+            if key not in self.codes:
+                raise KeyError(f"Metadata column {key} is not indexed.")
+            code = self.value2code[key].get(value)
+            if code is None:
+                return np.zeros(self.num_nodes, dtype=bool)
+            mask &= self.codes[key] == code
+        return mask
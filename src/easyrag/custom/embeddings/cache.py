@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import numpy as np
+
+from ...utils.lru import LRUCache
+
+
+class EmbeddingCache:
+    """
+    以内容寻址的向量缓存：键为 (模型名, 命名空间, 文本) 的sha1摘要，向量以定长行追加写入文件，读取时内存映射。
+    先写向量再写键，进程中断时最多丢失未写完的那一批，已写入的键总能找到完整的向量。
+    """
+
+    def __init__(self, cache_path: str, model_name: str, namespace: str, dtype: str = "float16"):
+        self.cache_dir = os.path.join(cache_path, model_name.replace("/", "__"), namespace)
+        self.model_name = model_name
+        self.namespace = namespace
+        self.keys_file = os.path.join(self.cache_dir, "keys.txt")
+        self.vectors_file = os.path.join(self.cache_dir, "vectors.bin")
+        self.meta_file = os.path.join(self.cache_dir, "meta.json")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.dim = None
+        self.dtype = np.dtype(dtype)
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                meta = json.loads(f.read())
+            self.dim = meta["dim"]
+            self.dtype = np.dtype(meta["dtype"])
+        self.key2row = dict()
+        if os.path.exists(self.keys_file) and os.path.exists(self.vectors_file) and self.dim is not None:
+            num_rows = os.path.getsize(self.vectors_file) // (self.dim * self.dtype.itemsize)
+            with open(self.keys_file) as f:
+                for row, line in enumerate(f):
+                    if row >= num_rows:
+                        break
+                    self.key2row[line.strip()] = row
+        self._vectors = None
+        self._lock = threading.Lock()
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\x00{self.namespace}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _matrix(self) -> np.ndarray:
+        if self._vectors is None or len(self._vectors) < len(self.key2row):
+            self._vectors = np.memmap(self.vectors_file, dtype=self.dtype, mode="r",
+                                      shape=(len(self.key2row), self.dim))
+        return self._vectors
+
+    def get(self, texts: List[str]) -> Tuple[Optional[np.ndarray], List[int]]:
+        """返回与 texts 对应的float32向量数组(未命中的行为0，缓存为空时为None)和未命中文本的下标"""
+        with self._lock:
+            rows = [self.key2row.get(self.key(text)) for text in texts]
+            missing = [i for i, row in enumerate(rows) if row is None]
+            if not self.key2row:
+                return None, missing
+            embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+            hits = [i for i, row in enumerate(rows) if row is not None]
+            if hits:
+                embeddings[hits] = self._matrix()[[rows[i] for i in hits]]
+        return embeddings, missing
+
+    def put(self, texts: List[str], embeddings: np.ndarray):
+        if not texts:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_file, "w") as f:
+                    f.write(json.dumps({"dim": self.dim, "dtype": self.dtype.name, "model_name": self.model_name}))
+            keys, rows, seen = [], [], set()
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                if key not in self.key2row and key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+                    rows.append(vector)
+            if not keys:
+                return
+            # 补齐上次中断时可能写了一半的向量行
+            row_bytes = self.dim * self.dtype.itemsize
+            with open(self.vectors_file, "ab") as f:
+                f.truncate(len(self.key2row) * row_bytes)
+                f.write(np.asarray(rows, dtype=self.dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.keys_file, "a") as f:
+                f.truncate(len(self.key2row) * 41)
+                f.write("".join(key + "\n" for key in keys))
+            for key in keys:
+                self.key2row[key] = len(self.key2row)
+
+
+def cached_embed(
+        cache: Optional[EmbeddingCache],
+        texts: List[str],
+        embed_fn: Callable[[List[str]], np.ndarray],
+) -> np.ndarray:
+    # 只对缓存中没有的文本调用模型，返回 float32 数组
+    if cache is None:
+        return np.asarray(embed_fn(texts), dtype=np.float32)
+    embeddings, missing = cache.get(texts)
+    if missing:
+        new_embeddings = np.asarray(embed_fn([texts[i] for i in missing]), dtype=np.float32)
+        embeddings = fill_missing(cache, texts, embeddings, missing, new_embeddings)
+    return embeddings
+
+
+def fill_missing(cache, texts, embeddings, missing, new_embeddings) -> np.ndarray:
+    cache.put([texts[i] for i in missing], new_embeddings)
+    if embeddings is None:
+        embeddings = np.zeros((len(texts), new_embeddings.shape[1]), dtype=np.float32)
+    embeddings[missing] = new_embeddings
+    return embeddings
+
+
+def normalize_query(query: str) -> str:
+    # 全角半角统一、连续空白合并，写法略有差异的相同问题命中同一条缓存
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", query)).strip()
+
+
+class QueryEmbeddingCache:
+    """
+    查询向量缓存：内存中是定长LRU，键为规范化后的问题，向量始终由原始问题计算，
+    写法不同(全角半角、空白)的相同问题共用第一次计算得到的向量；
+    提供 cache_path 时，内存中命中达到 disk_min_hits 次的热门问题再写入磁盘(EmbeddingCache，命名空间 query)，
+    重启后内存未命中时先查磁盘。model_name 需区分模型及降维投影，向量与键一一对应。
+    """
+
+    def __init__(self, model_name: str, maxsize: int = 1024, cache_path: str = "", disk_min_hits: int = 2):
+        self.memory = LRUCache(maxsize)
+        self.disk = EmbeddingCache(cache_path, model_name, "query", dtype="float32") if cache_path else None
+        self.disk_min_hits = disk_min_hits
+        self.disk_hits = 0
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        # 内存中的值为 [向量, 命中次数]
+        entry = self.memory.get(key)
+        if entry is not None:
+            entry[1] += 1
+            if self.disk is not None and entry[1] == self.disk_min_hits:
+                self.disk.put([key], np.asarray([entry[0]]))
+            return entry[0]
+        if self.disk is not None:
+            embeddings, missing = self.disk.get([key])
+            if not missing:
+                self.disk_hits += 1
+                embedding = embeddings[0].tolist()
+                self.memory.put(key, [embedding, self.disk_min_hits])
+                return embedding
+        return None
+
+    def get_or_embed(self, query: str, embed_fn: Callable[[str], List[float]]) -> List[float]:
+        key = normalize_query(query)
+        embedding = self._lookup(key)
+        if embedding is None:
+            # 规范化只用于查找，模型输入仍是原始问题，未命中时的结果与不使用缓存一致
+            embedding = embed_fn(query)
+            self.memory.put(key, [embedding, 0])
+        return embedding
+
+    async def aget_or_embed(self, query: str, embed_fn: Callable[[str], Awaitable[List[float]]]) -> List[float]:
+        key = normalize_query(query)
+        embedding = self._lookup(key)
+        if embedding is None:
+            embedding = await embed_fn(query)
+            self.memory.put(key, [embedding, 0])
+        return embedding
+
+    def stats(self) -> dict:
+        return {**self.memory.stats(), "disk_hits": self.disk_hits}
@@ -1,6 +1,8 @@
+import asyncio
 import logging
-from typing import Any, List
+from typing import Any, Callable, List, Optional
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 from llama_index.core.base.embeddings.base import (
@@ -14,9 +16,12 @@ from transformers import AutoTokenizer
 
 from ...utils.modeling_qwen import Qwen2Model
 from ...utils.tokenization_qwen import Qwen2Tokenizer
+from ...utils.batching import AsyncMicroBatcher, embed_by_token_budget
 from ...pipeline.ingestion import get_node_content
+from .cache import EmbeddingCache, cached_embed
 
 logger = logging.getLogger(__name__)
+MAX_LENGTH = 8192
 
 
 class GTEEmbedding(BaseEmbedding):
@@ -24,11 +29,19 @@ class GTEEmbedding(BaseEmbedding):
     _tokenizer: Any = PrivateAttr()
     _device: str = PrivateAttr()
     _embed_type: int = PrivateAttr()
+    _query_batcher: Any = PrivateAttr()
+    _max_tokens: int = PrivateAttr()
+    _embed_cache: Any = PrivateAttr()
+    _projection: Any = PrivateAttr()
 
     def __init__(
             self,
             model_name: str = None,
             embed_type: int = 0,
+            query_batch_size: int = 16,
+            query_batch_wait_ms: float = 5.0,
+            max_tokens: int = 16384,
+            embed_cache_path: str = "",
             **kwargs: Any,
     ) -> None:
         self._device = infer_torch_device()
@@ -37,6 +50,19 @@ class GTEEmbedding(BaseEmbedding):
             self._device)
         self._model.eval()
         self._embed_type = embed_type
+        self._max_tokens = max_tokens
+        # 文档向量缓存，键包含模型名、embed_type和渲染后的文本
+        self._embed_cache = None
+        if embed_cache_path:
+            self._embed_cache = EmbeddingCache(embed_cache_path, model_name, f"text_e{embed_type}")
+        # 降维投影在缓存之后应用，缓存中始终是模型输出的原始向量
+        self._projection = None
+        # 并发的查询请求合并成一次前向计算
+        self._query_batcher = AsyncMicroBatcher(
+            lambda queries: self._embed([self.get_detailed_instruct(query) for query in queries]),
+            max_batch_size=query_batch_size,
+            max_wait_ms=query_batch_wait_ms,
+        )
         super().__init__(**kwargs)
 
     def last_token_pool(self, last_hidden_states: Tensor,
@@ -56,9 +82,17 @@ class GTEEmbedding(BaseEmbedding):
     def class_name(cls) -> str:
         return "GTEEmbedding"
 
+    def _count_tokens(self, texts: List[str]) -> List[int]:
+        batch_dict = self._tokenizer(texts, max_length=MAX_LENGTH, truncation=True)
+        return [len(input_ids) for input_ids in batch_dict['input_ids']]
+
     def _embed(self, texts: List[str]) -> List[List[float]]:
         """Embed sentences."""
-        max_length = 8192
+        return self._project(self._embed_array(texts)).tolist()
+
+    def _embed_array(self, texts: List[str]) -> np.ndarray:
+        """Embed sentences into a float32 array."""
+        max_length = MAX_LENGTH
         # Tokenize the input texts
         batch_dict = self._tokenizer(texts, max_length=max_length, padding=True, truncation=True,
                                      return_tensors='pt').to(self._device)
@@ -68,11 +102,11 @@ class GTEEmbedding(BaseEmbedding):
 
             # normalize embeddings
             embeddings = F.normalize(embeddings, p=2, dim=1)
-            embeddings = embeddings.to(torch.float).tolist()
+            embeddings = embeddings.to(torch.float).cpu().numpy()
         return embeddings
 
     async def _aget_query_embedding(self, query: str) -> List[float]:
-        return self._get_query_embedding(query)
+        return await self._query_batcher.submit(query)
 
     async def _aget_text_embedding(self, text: str) -> List[float]:
         return self._get_text_embedding(text)
@@ -87,26 +121,40 @@ class GTEEmbedding(BaseEmbedding):
 
     def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
         """Embed sentences."""
-        return self._embed(texts)
+        return self._project(self.get_text_embedding_array(texts)).tolist()
 
-    def __call__(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
-        embeddings = self.get_text_embedding_batch(
+    def get_text_embedding_array(self, texts: List[str]) -> np.ndarray:
+        # 按长度排序并按token预算分批，减少补齐带来的无效计算，长表格也不会撑爆显存
+        return embed_by_token_budget(texts, self._count_tokens, self._embed_array, self._max_tokens)
+
+    def set_projection(self, projection: Optional[Callable[[np.ndarray], np.ndarray]]):
+        self._projection = projection
+
+    def _project(self, embeddings: np.ndarray) -> np.ndarray:
+        if self._projection is None:
+            return embeddings
+        return self._projection(embeddings)
+
+    def embed_nodes(self, nodes: List[BaseNode]) -> np.ndarray:
+        """返回节点向量组成的 float32 数组，不经过python浮点数列表，也不写入 node.embedding"""
+        return self._project(cached_embed(
+            self._embed_cache,
             [get_node_content(node, self._embed_type) for node in nodes],
-            **kwargs,
-        )
+            self.get_text_embedding_array,
+        ))
+
+    def __call__(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        embeddings = self.embed_nodes(nodes)
 
         for node, embedding in zip(nodes, embeddings):
-            node.embedding = embedding
+            node.embedding = embedding.tolist()
 
         return nodes
 
     async def acall(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
-        embeddings = await self.aget_text_embedding_batch(
-            [get_node_content(node, self._embed_type) for node in nodes],
-            **kwargs,
-        )
+        embeddings = await asyncio.get_running_loop().run_in_executor(None, self.embed_nodes, nodes)
 
         for node, embedding in zip(nodes, embeddings):
-            node.embedding = embedding
+            node.embedding = embedding.tolist()
 
         return nodes
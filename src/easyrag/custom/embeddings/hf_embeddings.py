@@ -2,11 +2,15 @@ import asyncio
 import logging
 from typing import Any, Callable, Dict, List, Optional, Sequence, Union
 
+import numpy as np
+
 from llama_index.core.base.embeddings.base import (
     DEFAULT_EMBED_BATCH_SIZE,
     BaseEmbedding,
 )
 from ...pipeline.ingestion import get_node_content
+from .cache import EmbeddingCache, cached_embed
+from ...utils.batching import AsyncMicroBatcher, embed_by_token_budget
 from llama_index.core.bridge.pydantic import Field, PrivateAttr
 from llama_index.core.callbacks import CallbackManager
 from llama_index.core.schema import BaseNode
@@ -40,6 +44,10 @@ class HuggingFaceEmbedding(BaseEmbedding):
     _model: Any = PrivateAttr()
     _device: str = PrivateAttr()
     _embed_type: int = PrivateAttr()
+    _query_batcher: Any = PrivateAttr()
+    _max_tokens: int = PrivateAttr()
+    _embed_cache: Any = PrivateAttr()
+    _projection: Any = PrivateAttr()
 
     def __init__(
             self,
@@ -58,10 +66,27 @@ class HuggingFaceEmbedding(BaseEmbedding):
             device: Optional[str] = None,
             callback_manager: Optional[CallbackManager] = None,
             embed_type: int = 0,
+            query_batch_size: int = 16,
+            query_batch_wait_ms: float = 5.0,
+            max_tokens: int = 16384,
+            embed_cache_path: str = "",
             **model_kwargs,
     ):
         self._device = device or infer_torch_device()
         self._embed_type = embed_type
+        self._max_tokens = max_tokens
+        # 文档向量缓存，键包含模型名、embed_type和渲染后的文本
+        self._embed_cache = None
+        if embed_cache_path:
+            self._embed_cache = EmbeddingCache(embed_cache_path, model_name, f"text_e{embed_type}")
+        # 降维投影在缓存之后应用，缓存中始终是模型输出的原始向量
+        self._projection = None
+        # 并发的查询请求合并成一次前向计算
+        self._query_batcher = AsyncMicroBatcher(
+            lambda queries: self._embed(queries, prompt_name="query"),
+            max_batch_size=query_batch_size,
+            max_wait_ms=query_batch_wait_ms,
+        )
         cache_folder = cache_folder or get_cache_dir()
 
         for variable, value in [
@@ -115,12 +140,12 @@ class HuggingFaceEmbedding(BaseEmbedding):
             prompt_name: Optional[str] = None,
     ) -> List[List[float]]:
         """Embed sentences."""
-        return self._model.encode(
+        return self._project(self._model.encode(
             sentences,
             batch_size=self.embed_batch_size,
             prompt_name=prompt_name,
             normalize_embeddings=self.normalize,
-        ).tolist()
+        )).tolist()
 
     def _get_query_embedding(self, query: str) -> List[float]:
         """Get query embedding."""
@@ -128,7 +153,7 @@ class HuggingFaceEmbedding(BaseEmbedding):
 
     async def _aget_query_embedding(self, query: str) -> List[float]:
         """Get query embedding async."""
-        return self._get_query_embedding(query)
+        return await self._query_batcher.submit(query)
 
     async def _aget_text_embedding(self, text: str) -> List[float]:
         """Get text embedding async."""
@@ -138,28 +163,58 @@ class HuggingFaceEmbedding(BaseEmbedding):
         """Get text embedding."""
         return self._embed(text, prompt_name="text")
 
+    def _count_tokens(self, texts: List[str], prompt_name: Optional[str] = None) -> List[int]:
+        prompt = self._model.prompts.get(prompt_name, "") if prompt_name else ""
+        input_ids = self._model.tokenizer([prompt + text for text in texts])['input_ids']
+        return [min(len(ids), self.max_length) for ids in input_ids]
+
     def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
         """Get text embeddings."""
-        return self._embed(texts, prompt_name="text")
+        return self._project(self.get_text_embedding_array(texts)).tolist()
+
+    def get_text_embedding_array(self, texts: List[str]) -> np.ndarray:
+        # 按长度排序并按token预算分批，每批一次前向计算
+        return embed_by_token_budget(
+            texts,
+            lambda batch: self._count_tokens(batch, prompt_name="text"),
+            lambda batch: self._model.encode(
+                batch,
+                batch_size=len(batch),
+                prompt_name="text",
+                normalize_embeddings=self.normalize,
+                convert_to_numpy=True,
+            ).astype(np.float32),
+            self._max_tokens,
+        )
 
-    def __call__(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
-        embeddings = self.get_text_embedding_batch(
+    def set_projection(self, projection: Optional[Callable[[np.ndarray], np.ndarray]]):
+        self._projection = projection
+
+    def _project(self, embeddings: np.ndarray) -> np.ndarray:
+        if self._projection is None:
+            return embeddings
+        return self._projection(embeddings)
+
+    def embed_nodes(self, nodes: List[BaseNode]) -> np.ndarray:
+        """返回节点向量组成的 float32 数组，不经过python浮点数列表，也不写入 node.embedding"""
+        return self._project(cached_embed(
+            self._embed_cache,
             [get_node_content(node, self._embed_type) for node in nodes],
-            **kwargs,
-        )
+            self.get_text_embedding_array,
+        ))
+
+    def __call__(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        embeddings = self.embed_nodes(nodes)
 
         for node, embedding in zip(nodes, embeddings):
-            node.embedding = embedding
+            node.embedding = embedding.tolist()
 
         return nodes
 
     async def acall(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
-        embeddings = await self.aget_text_embedding_batch(
-            [get_node_content(node, self._embed_type) for node in nodes],
-            **kwargs,
-        )
+        embeddings = await asyncio.get_running_loop().run_in_executor(None, self.embed_nodes, nodes)
 
         for node, embedding in zip(nodes, embeddings):
-            node.embedding = embedding
+            node.embedding = embedding.tolist()
 
         return nodes
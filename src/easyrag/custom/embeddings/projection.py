@@ -0,0 +1,83 @@
+import hashlib
+import os
+from typing import Callable, List, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+
+
+class PCAProjection:
+    """
+    在语料向量上拟合的PCA线性投影，把高维向量降到 dim 维后重新归一化，仍用余弦相似度检索。
+    文档和查询经过同一个投影，投影与向量集合一起保存，集合存在期间保持不变。
+    """
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray, explained_variance: float = 0.0):
+        self.mean = mean.astype(np.float32)
+        # (dim, 原始维度)
+        self.components = components.astype(np.float32)
+        self.explained_variance = explained_variance
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, embeddings: np.ndarray, dim: int) -> "PCAProjection":
+        x = np.asarray(embeddings, dtype=np.float32)
+        if dim > x.shape[1]:
+            raise ValueError(f"Projection dim {dim} exceeds embedding dim {x.shape[1]}")
+        mean = x.mean(axis=0)
+        x = x - mean
+        # 原始维度不大(数千)，直接对协方差矩阵做特征分解
+        cov = (x.T @ x).astype(np.float64) / max(len(x) - 1, 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(cov)
+        order = np.argsort(eigenvalues)[::-1][:dim]
+        explained_variance = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+        return cls(mean, eigenvectors[:, order].T, explained_variance)
+
+    def fingerprint(self) -> str:
+        # 区分不同的拟合结果，用于查询向量缓存等以投影后向量为值的缓存
+        return hashlib.sha1(self.mean.tobytes() + self.components.tobytes()).hexdigest()[:12]
+
+    def __call__(self, embeddings: np.ndarray) -> np.ndarray:
+        x = np.asarray(embeddings, dtype=np.float32)
+        y = (x - self.mean) @ self.components.T
+        return y / np.maximum(np.linalg.norm(y, axis=-1, keepdims=True), 1e-12)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, mean=self.mean, components=self.components,
+                 explained_variance=np.float64(self.explained_variance))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PCAProjection":
+        with np.load(path) as data:
+            return cls(data["mean"], data["components"], float(data["explained_variance"]))
+
+
+def load_or_fit_projection(
+        path: str,
+        dim: int,
+        nodes: List[BaseNode],
+        embed_fn: Callable[[List[BaseNode]], np.ndarray],
+        refit: bool = False,
+        sample_size: int = 20000,
+        seed: int = 0,
+) -> Tuple[PCAProjection, bool]:
+    """
+    加载已保存的投影，维度不一致或 refit 时在节点采样上重新拟合。
+    返回 (投影, 是否新拟合)，新拟合的投影与已写入的向量不兼容，调用方需要重建向量集合。
+    """
+    if not refit and os.path.exists(path):
+        projection = PCAProjection.load(path)
+        if projection.dim == dim:
+            return projection, False
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(nodes), min(len(nodes), sample_size), replace=False))
+    projection = PCAProjection.fit(embed_fn([nodes[i] for i in sample]), dim)
+    projection.save(path)
+    print(f"向量投影拟合完成：{dim}维，保留方差比例{projection.explained_variance:.3f}")
+    return projection, True
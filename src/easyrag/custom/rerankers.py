@@ -1,3 +1,6 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Any, List, Optional
 
 import torch
@@ -7,11 +10,29 @@ from llama_index.core.postprocessor.types import BaseNodePostprocessor
 from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
 from llama_index.core.utils import infer_torch_device
 from transformers import AutoTokenizer, AutoModelForCausalLM
+from ..pipeline.context import current_request
 from ..pipeline.ingestion import get_node_content
+from ..utils.batching import TokenBudgetBatcher
 
 DEFAULT_SENTENCE_TRANSFORMER_MAX_LENGTH = 512
 
 
+def keep_retrieval_score(node: NodeWithScore):
+    # 节点对象在请求间共享，请求上下文中把检索分数记在上下文里，不写入节点元数据
+    context = current_request()
+    if context is None:
+        node.node.metadata["retrieval_score"] = node.score
+    else:
+        context.retrieval_scores[node.node.node_id] = node.score
+
+
+def get_retrieval_score(node: NodeWithScore) -> Optional[float]:
+    context = current_request()
+    if context is None:
+        return node.node.metadata.get("retrieval_score")
+    return context.retrieval_scores.get(node.node.node_id)
+
+
 class SentenceTransformerRerank(BaseNodePostprocessor):
     model: str = Field(description="Sentence transformer model name.")
     top_n: int = Field(description="Number of nodes to return sorted by score.")
@@ -87,8 +108,7 @@ class SentenceTransformerRerank(BaseNodePostprocessor):
 
             for node, score in zip(nodes, scores):
                 if self.keep_retrieval_score:
-                    # keep the retrieval score in metadata
-                    node.node.metadata["retrieval_score"] = node.score
+                    keep_retrieval_score(node)
                 node.score = score
 
             new_nodes = sorted(nodes, key=lambda x: -x.score if x.score else 0)[
@@ -123,6 +143,8 @@ class LLMRerank(BaseNodePostprocessor):
     _compress_ratio: int = PrivateAttr()
     _compress_layer: list[int] = PrivateAttr()
     _use_efficient: int = PrivateAttr()
+    _batcher: Any = PrivateAttr()
+    _tokenize_executor: Any = PrivateAttr()
 
     def __init__(
             self,
@@ -132,7 +154,9 @@ class LLMRerank(BaseNodePostprocessor):
             keep_retrieval_score: Optional[bool] = True,
             embed_bs: int = 64,
             embed_type: int = 0,
-            use_efficient: int = 0
+            use_efficient: int = 0,
+            max_tokens: int = 0,
+            batch_wait_ms: float = 2.0,
     ):
         device = infer_torch_device() if device is None else device
 
@@ -183,6 +207,15 @@ class LLMRerank(BaseNodePostprocessor):
             self._model.eval()
             self._type = 0
         self._embed_bs = embed_bs
+        # 并发请求的候选对在同一个模型线程中按token预算组批，默认预算与原先 embed_bs 条满长输入相当
+        self._batcher = TokenBudgetBatcher(
+            self._score_pairs,
+            lambda items: [len(item['input_ids']) for item in items],
+            max_tokens=max_tokens or embed_bs * 1024,
+            max_wait_ms=batch_wait_ms,
+        )
+        # 快速分词器不能在多个线程中同时使用，分词固定在一个线程中
+        self._tokenize_executor = ThreadPoolExecutor(max_workers=1)
         super().__init__(
             top_n=top_n,
             model=model,
@@ -200,9 +233,15 @@ class LLMRerank(BaseNodePostprocessor):
             batch_size = logits.shape[0]
             return torch.stack([logits[i, sequence_lengths[i]] for i in range(batch_size)], dim=0)
 
-    def get_inputs_v2_5(self, pairs, tokenizer, prompt=None, max_length=1024):
+    def default_prompt(self) -> str:
+        if self._type == 2:
+            return "Predict whether passage B contains an answer to query A."
+        return "Given a query A and a passage B, determine whether the passage contains an answer to the query by providing a prediction of either 'Yes' or 'No'."
+
+    def encode_pairs(self, pairs, tokenizer, prompt=None, max_length=1024) -> List[dict]:
+        """逐条分词，返回未补齐的输入，附带 v2.5 模型需要的 query_length/prompt_length"""
         if prompt is None:
-            prompt = "Predict whether passage B contains an answer to query A."
+            prompt = self.default_prompt()
         sep = "\n"
         prompt_inputs = tokenizer(prompt,
                                   return_tensors=None,
@@ -210,9 +249,7 @@ class LLMRerank(BaseNodePostprocessor):
         sep_inputs = tokenizer(sep,
                                return_tensors=None,
                                add_special_tokens=False)['input_ids']
-        inputs = []
-        query_lengths = []
-        prompt_lengths = []
+        items = []
         for query, passage in pairs:
             query_inputs = tokenizer(f'A: {query}',
                                      return_tensors=None,
@@ -234,67 +271,79 @@ class LLMRerank(BaseNodePostprocessor):
                 return_token_type_ids=False,
                 add_special_tokens=False
             )
-            item['input_ids'] = item['input_ids'] + sep_inputs + prompt_inputs
-            item['attention_mask'] = [1] * len(item['input_ids'])
-            inputs.append(item)
-            query_lengths.append(len([tokenizer.bos_token_id] + query_inputs['input_ids'] + sep_inputs))
-            prompt_lengths.append(len(sep_inputs + prompt_inputs))
+            input_ids = item['input_ids'] + sep_inputs + prompt_inputs
+            items.append({
+                'input_ids': input_ids,
+                'attention_mask': [1] * len(input_ids),
+                'query_length': len([tokenizer.bos_token_id] + query_inputs['input_ids'] + sep_inputs),
+                'prompt_length': len(sep_inputs + prompt_inputs),
+            })
+        return items
 
+    def pad_inputs(self, items, tokenizer, max_length=1024):
         return tokenizer.pad(
-            inputs,
+            [{'input_ids': item['input_ids'], 'attention_mask': item['attention_mask']} for item in items],
             padding=True,
-            max_length=max_length + len(sep_inputs) + len(prompt_inputs),
+            max_length=max_length + items[0]['prompt_length'],
             pad_to_multiple_of=8,
             return_tensors='pt',
-        ), query_lengths, prompt_lengths
+        )
+
+    def get_inputs_v2_5(self, pairs, tokenizer, prompt=None, max_length=1024):
+        items = self.encode_pairs(pairs, tokenizer, prompt, max_length)
+        return (self.pad_inputs(items, tokenizer, max_length),
+                [item['query_length'] for item in items],
+                [item['prompt_length'] for item in items])
 
     def get_inputs(self, pairs, tokenizer, prompt=None, max_length=1024):
-        if prompt is None:
-            prompt = "Given a query A and a passage B, determine whether the passage contains an answer to the query by providing a prediction of either 'Yes' or 'No'."
-        sep = "\n"
-        prompt_inputs = tokenizer(prompt,
-                                  return_tensors=None,
-                                  add_special_tokens=False)['input_ids']
-        sep_inputs = tokenizer(sep,
-                               return_tensors=None,
-                               add_special_tokens=False)['input_ids']
-        inputs = []
-        for query, passage in pairs:
-            query_inputs = tokenizer(f'A: {query}',
-                                     return_tensors=None,
-                                     add_special_tokens=False,
-                                     max_length=max_length * 3 // 4,
-                                     truncation=True)
-            passage_inputs = tokenizer(f'B: {passage}',
-                                       return_tensors=None,
-                                       add_special_tokens=False,
-                                       max_length=max_length,
-                                       truncation=True)
-            item = tokenizer.prepare_for_model(
-                [tokenizer.bos_token_id] + query_inputs['input_ids'],
-                sep_inputs + passage_inputs['input_ids'],
-                truncation='only_second',
-                max_length=max_length,
-                padding=False,
-                return_attention_mask=False,
-                return_token_type_ids=False,
-                add_special_tokens=False
-            )
-            item['input_ids'] = item['input_ids'] + sep_inputs + prompt_inputs
-            item['attention_mask'] = [1] * len(item['input_ids'])
-            inputs.append(item)
-        return tokenizer.pad(
-            inputs,
-            padding=True,
-            max_length=max_length + len(sep_inputs) + len(prompt_inputs),
-            pad_to_multiple_of=8,
-            return_tensors='pt',
-        )
+        return self.pad_inputs(self.encode_pairs(pairs, tokenizer, prompt, max_length), tokenizer, max_length)
 
     @classmethod
     def class_name(cls) -> str:
         return "LLMRerank"
 
+    def _score_pairs(self, items: List[dict]) -> List[float]:
+        # 一个批次的前向计算，items 为 encode_pairs 的输出
+        inputs = self.pad_inputs(items, self._tokenizer).to(self._model.device)
+        with torch.no_grad():
+            if self._type == 1:
+                all_scores = self._model(**inputs, return_dict=True, cutoff_layers=[self._layer])
+                scores = all_scores[0][0][:, -1].view(-1, ).float()
+            elif self._type == 2:
+                outputs = self._model(**inputs,
+                                      return_dict=True,
+                                      cutoff_layers=[self._layer],
+                                      compress_ratio=self._compress_ratio,
+                                      compress_layer=self._compress_layer,
+                                      query_lengths=[item['query_length'] for item in items],
+                                      prompt_lengths=[item['prompt_length'] for item in items])
+                scores = self.last_logit_pool(outputs.logits[0], outputs.attention_masks[0]).float()
+            else:
+                scores = self._model(**inputs, return_dict=True).logits[:, -1, self._yes_loc].view(-1, ).float()
+        scores = scores.cpu().tolist()
+        assert len(scores) == len(items)
+        return scores
+
+    def _score_items(self, items: List[dict]) -> List[float]:
+        # 单个请求按 embed_bs 顺序分批计算；加速模式下提前退出的层由第一批决定
+        scores = []
+        for i in range(0, len(items), self._embed_bs):
+            if self._type == 1 and i == 0 and self._use_efficient != 0:
+                self._model.judge = True
+                self._model.cut_layer = self._layer
+            scores.extend(self._score_pairs(items[i:i + self._embed_bs]))
+            if self._type == 1 and i == 0 and self._use_efficient == 1:
+                self._layer = self._model.cut_layer
+                self._model.judge = False
+        return scores
+
+    def _rank(self, nodes: List[NodeWithScore], scores: List[float]) -> List[NodeWithScore]:
+        for node, score in zip(nodes, scores):
+            if self.keep_retrieval_score:
+                keep_retrieval_score(node)
+            node.score = score
+        return sorted(nodes, key=lambda x: -x.score if x.score else 0)[: self.top_n]
+
     def _postprocess_nodes(
             self,
             nodes: List[NodeWithScore],
@@ -304,73 +353,61 @@ class LLMRerank(BaseNodePostprocessor):
             raise ValueError("Missing query bundle in extra info.")
         if len(nodes) == 0:
             return []
-        bsz = self._embed_bs
-        N = len(nodes)
+        pairs = [(query_bundle.query_str, get_node_content(node.node, self._embed_type)) for node in nodes]
 
-        for i in range(0, N, bsz):
-            if self._type == 1 and i == 0 and self._use_efficient != 0:
-                self._model.judge = True
-                self._model.cut_layer = self._layer
-            begin_idx, end_idx = i, min(i + bsz, N)
-            cur_nodes = nodes[begin_idx:end_idx]
-            query_and_nodes = [
-                (
-                    query_bundle.query_str,
-                    get_node_content(node.node, self._embed_type),
-                )
-                for node in cur_nodes
-            ]
-
-            with self.callback_manager.event(
-                    CBEventType.RERANKING,
-                    payload={
-                        EventPayload.NODES: cur_nodes,
-                        EventPayload.MODEL_NAME: self.model,
-                        EventPayload.QUERY_STR: query_bundle.query_str,
-                        EventPayload.TOP_K: self.top_n,
-                    },
-            ) as event:
-                if self._type == 2:
-                    inputs, query_lengths, prompt_lengths = self.get_inputs_v2_5(query_and_nodes, self._tokenizer)
-                    inputs = inputs.to(self._model.device)
-                else:
-                    inputs = self.get_inputs(query_and_nodes, self._tokenizer).to(self._model.device)
-
-                with torch.no_grad():
-                    if self._type == 1:
-                        all_scores = self._model(**inputs, return_dict=True, cutoff_layers=[self._layer])
-                        scores = [scores[:, -1].view(-1, ).float() for scores in all_scores[0]][0]
-                        if i == 0 and self._use_efficient == 1:
-                            self._layer = self._model.cut_layer
-                            self._model.judge = False
-
-                    elif self._type == 2:
-                        outputs = self._model(**inputs,
-                                              return_dict=True,
-                                              cutoff_layers=[self._layer],
-                                              compress_ratio=self._compress_ratio,
-                                              compress_layer=self._compress_layer,
-                                              query_lengths=query_lengths,
-                                              prompt_lengths=prompt_lengths)
-                        scores = []
-                        for i in range(len(outputs.logits)):
-                            logits = self.last_logit_pool(outputs.logits[i], outputs.attention_masks[i])
-                            scores.append(logits.cpu().float().tolist())
-                        scores = scores[0]
-                    else:
-                        scores = self._model(**inputs, return_dict=True).logits[:, -1, self._yes_loc].view(-1, ).float()
-                assert len(scores) == len(cur_nodes)
-
-                for node, score in zip(cur_nodes, scores):
-                    if self.keep_retrieval_score:
-                        # keep the retrieval score in metadata
-                        node.node.metadata["retrieval_score"] = node.score
-                    node.score = score
-            nodes[begin_idx:end_idx] = cur_nodes
-
-        new_nodes = sorted(nodes, key=lambda x: -x.score if x.score else 0)[
-                    : self.top_n
-                    ]
-        event.on_end(payload={EventPayload.NODES: new_nodes})
+        with self.callback_manager.event(
+                CBEventType.RERANKING,
+                payload={
+                    EventPayload.NODES: nodes,
+                    EventPayload.MODEL_NAME: self.model,
+                    EventPayload.QUERY_STR: query_bundle.query_str,
+                    EventPayload.TOP_K: self.top_n,
+                },
+        ) as event:
+            # 分词和模型计算与异步路径使用同一组线程，模型不会被两个线程同时调用
+            items = self._tokenize_executor.submit(self.encode_pairs, pairs, self._tokenizer).result()
+            if self._type == 1 and self._use_efficient != 0:
+                scores = self._batcher.executor.submit(self._score_items, items).result()
+            else:
+                scores = self._batcher.run(items)
+            new_nodes = self._rank(nodes, scores)
+            event.on_end(payload={EventPayload.NODES: new_nodes})
+
+        return new_nodes
+
+    async def apostprocess_nodes(
+            self,
+            nodes: List[NodeWithScore],
+            query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        """
+        异步精排：分词在独立线程中进行，候选对交给跨请求的批处理器，
+        与其他并发请求的候选对一起按token预算组批计算，事件循环不被模型计算阻塞。
+        """
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if len(nodes) == 0:
+            return []
+        loop = asyncio.get_running_loop()
+        pairs = [(query_bundle.query_str, get_node_content(node.node, self._embed_type)) for node in nodes]
+
+        with self.callback_manager.event(
+                CBEventType.RERANKING,
+                payload={
+                    EventPayload.NODES: nodes,
+                    EventPayload.MODEL_NAME: self.model,
+                    EventPayload.QUERY_STR: query_bundle.query_str,
+                    EventPayload.TOP_K: self.top_n,
+                },
+        ) as event:
+            items = await loop.run_in_executor(
+                self._tokenize_executor, partial(self.encode_pairs, pairs, self._tokenizer))
+            if self._type == 1 and self._use_efficient != 0:
+                # 加速模式按请求决定提前退出的层，不与其他请求混批，仍在模型线程中逐批计算
+                scores = await loop.run_in_executor(self._batcher.executor, self._score_items, items)
+            else:
+                scores = await self._batcher.submit_many(items)
+            new_nodes = self._rank(nodes, scores)
+            event.on_end(payload={EventPayload.NODES: new_nodes})
 
         return new_nodes
@@ -1,8 +1,16 @@
+import asyncio
+import contextvars
+import hashlib
+import json
 import logging
+import os
+import shutil
 import time
-from typing import List, Optional, Callable, cast
+from functools import partial
+from typing import TYPE_CHECKING, List, Optional, Callable, Sequence, cast
 
 import bm25s
+import numpy as np
 from llama_index.core import QueryBundle, VectorStoreIndex
 from llama_index.core.base.base_retriever import BaseRetriever
 from llama_index.core.base.embeddings.base import BaseEmbedding
@@ -13,29 +21,57 @@ from llama_index.core.schema import NodeWithScore, BaseNode, IndexNode
 from llama_index.core.storage.docstore import BaseDocumentStore
 from llama_index.core.vector_stores import VectorStoreQuery
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from ..pipeline.ingestion import get_node_content
+from ..pipeline.context import RequestContext, current_request, request_context, request_value
+from ..pipeline.ingestion import get_node_content, content_fingerprint
+from .bm25 import BM25Index, BM25Shards, BM25_METHODS, BM25SparseEncoder, QueryAnalyzer, argsort_top_k, \
+    bm25_top_k, top_k_indices
+from .columns import MetadataColumns
 from nltk import PorterStemmer
 from rank_bm25 import BM25Okapi
 
+if TYPE_CHECKING:
+    # 嵌入模块依赖torch，检索器只用到类型标注
+    from .embeddings.cache import QueryEmbeddingCache
+
 logger = logging.getLogger(__name__)
 
 
+def get_query_embedding(embed_model: BaseEmbedding, query_cache: Optional["QueryEmbeddingCache"], query: str):
+    if query_cache is None:
+        return embed_model.get_query_embedding(query)
+    return query_cache.get_or_embed(query, embed_model.get_query_embedding)
+
+
+async def aget_query_embedding(embed_model: BaseEmbedding, query_cache: Optional["QueryEmbeddingCache"], query: str):
+    if query_cache is None:
+        return await embed_model.aget_query_embedding(query)
+    return await query_cache.aget_or_embed(query, embed_model.aget_query_embedding)
+
+
 class QdrantRetriever(BaseRetriever):
     def __init__(
             self,
             vector_store: QdrantVectorStore,
             embed_model: BaseEmbedding,
             similarity_top_k: int = 2,
-            filters=None
+            filters=None,
+            hnsw_ef: Optional[int] = None,
+            query_cache: Optional["QueryEmbeddingCache"] = None,
     ) -> None:
         self._vector_store = vector_store
         self._embed_model = embed_model
         self._similarity_top_k = similarity_top_k
+        # 重复的问题直接复用查询向量，跳过嵌入模型的前向计算
+        self.query_cache = query_cache
+        # 默认的过滤条件和检索参数，请求上下文中的值优先
         self.filters = filters
+        # HNSW检索候选数，None时使用集合的默认检索参数
+        self.hnsw_ef = hnsw_ef
         super().__init__()
 
     async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
-        query_embedding = self._embed_model.get_query_embedding(query_bundle.query_str)
+        # 查询向量由嵌入模型在线程池中批量计算，不阻塞事件循环上的其他检索
+        query_embedding = await aget_query_embedding(self._embed_model, self.query_cache, query_bundle.query_str)
         vector_store_query = VectorStoreQuery(
             query_embedding,
             similarity_top_k=self._similarity_top_k,
@@ -43,7 +79,8 @@ class QdrantRetriever(BaseRetriever):
         )
         query_result = await self._vector_store.aquery(
             vector_store_query,
-            qdrant_filters=self.filters,  # 需要查找qdrant相关用法
+            qdrant_filters=request_value("filters", self.filters),  # 需要查找qdrant相关用法
+            hnsw_ef=request_value("hnsw_ef", self.hnsw_ef),
         )
 
         node_with_scores = []
@@ -53,14 +90,15 @@ class QdrantRetriever(BaseRetriever):
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         # 不维护
-        query_embedding = self._embed_model.get_query_embedding(query_bundle.query_str)
+        query_embedding = get_query_embedding(self._embed_model, self.query_cache, query_bundle.query_str)
         vector_store_query = VectorStoreQuery(
             query_embedding,
             similarity_top_k=self._similarity_top_k,
         )
         query_result = self._vector_store.query(
             vector_store_query,
-            qdrant_filters=self.filters,  # 需要查找qdrant相关用法
+            qdrant_filters=request_value("filters", self.filters),  # 需要查找qdrant相关用法
+            hnsw_ef=request_value("hnsw_ef", self.hnsw_ef),
         )
 
         node_with_scores = []
@@ -69,6 +107,62 @@ class QdrantRetriever(BaseRetriever):
         return node_with_scores
 
 
+# embed_type 4/5 分别只使用 file_path/know_path，大量切片共享同一路径
+PATH_EMBED_TYPES = (4, 5)
+
+
+class QdrantHybridRetriever(BaseRetriever):
+    """
+    qdrant原生混合检索：查询向量和BM25稀疏查询向量一起发给qdrant，两路预取后在qdrant中做倒数排序融合，
+    一次请求返回融合结果。查询端只需要嵌入模型和 BM25SparseEncoder 的词表。
+    """
+
+    def __init__(
+            self,
+            vector_store: QdrantVectorStore,
+            embed_model: BaseEmbedding,
+            sparse_encoder: BM25SparseEncoder,
+            similarity_top_k: int = 256,
+            dense_top_k: int = 256,
+            sparse_top_k: int = 256,
+            query_cache: Optional["QueryEmbeddingCache"] = None,
+    ) -> None:
+        self._vector_store = vector_store
+        self._embed_model = embed_model
+        self.query_cache = query_cache
+        self._sparse_encoder = sparse_encoder
+        self._similarity_top_k = similarity_top_k
+        self._dense_top_k = dense_top_k
+        self._sparse_top_k = sparse_top_k
+        self.filters = None
+        self.filter_dict = None
+        self.hnsw_ef = None
+        super().__init__()
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # jieba分词是CPU计算，与查询向量的计算并发放到线程池中执行，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        query_embedding, sparse_vector = await asyncio.gather(
+            aget_query_embedding(self._embed_model, self.query_cache, query_bundle.query_str),
+            loop.run_in_executor(None, self._sparse_encoder.encode_query, query_bundle.query_str),
+        )
+        query_result = await self._vector_store.ahybrid_query(
+            query_embedding,
+            sparse_vector,
+            similarity_top_k=self._similarity_top_k,
+            dense_top_k=self._dense_top_k,
+            sparse_top_k=self._sparse_top_k,
+            qdrant_filters=request_value("filters", self.filters),
+            hnsw_ef=request_value("hnsw_ef", self.hnsw_ef),
+        )
+        return [NodeWithScore(node=node, score=similarity)
+                for node, similarity in zip(query_result.nodes, query_result.similarities)]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # 不维护
+        return asyncio.get_event_loop().run_until_complete(self._aretrieve(query_bundle))
+
+
 def tokenize_and_remove_stopwords(tokenizer, text, stopwords):
     words = tokenizer.cut(text)
     filtered_words = [word for word in words
@@ -76,6 +170,10 @@ def tokenize_and_remove_stopwords(tokenizer, text, stopwords):
     return filtered_words
 
 
+def stopwords_hash(stopwords) -> str:
+    return hashlib.sha1("\n".join(sorted(stopwords)).encode("utf-8")).hexdigest()
+
+
 # using jieba to split sentence and remove meaningless words
 class BM25Retriever(BaseRetriever):
     def __init__(
@@ -90,34 +188,87 @@ class BM25Retriever(BaseRetriever):
             stopwords: List[str] = [""],
             embed_type: int = 0,
             bm25_type: int = 0,
+            index: Optional[BM25Index] = None,
+            filter_keys: Sequence[str] = ("dir",),
+            shard_key: Optional[str] = None,
+            analyzer: Optional[QueryAnalyzer] = None,
     ) -> None:
         self._nodes = nodes
         self._tokenizer = tokenizer
         self._similarity_top_k = similarity_top_k
         self.embed_type = embed_type
-        self._corpus = [tokenize_and_remove_stopwords(
-            self._tokenizer, get_node_content(node, self.embed_type), stopwords=stopwords)
-            for node in self._nodes]
-        # self._corpus = [self._tokenizer(node.get_content()) for node in self._nodes]
         self.bm25_type = bm25_type
         self.k1 = 1.5
         self.b = 0.75
         self.epsilon = 0.25
-        if self.bm25_type == 1:
-            self.bm25 = bm25s.BM25(
-                k1=self.k1,
-                b=self.b,
-            )
-            self.bm25.index(self._corpus)
-        else:
-            self.bm25 = BM25Okapi(
+        self.index = index
+        self.path_ids = None
+        if self.embed_type in PATH_EMBED_TYPES:
+            # 路径检索：相同的路径只建一次索引，打分后再展开到对应的各个切片
+            path2id = dict()
+            self.path_ids = np.array([path2id.setdefault(get_node_content(node, self.embed_type), len(path2id))
+                                      for node in self._nodes], dtype=np.int32)
+            self.paths = list(path2id)
+            path_counts = np.bincount(self.path_ids, minlength=len(self.paths))
+            self.path_chunks = np.argsort(self.path_ids, kind="stable")
+            self.path_ptr = np.concatenate([[0], np.cumsum(path_counts)])
+        if self.index is not None:
+            # 从磁盘加载的索引，无需重新分词
+            if self.path_ids is not None and self.index.num_docs != len(self.paths):
+                raise ValueError("Saved BM25 path index does not match the given nodes.")
+            self._corpus = None
+            self.bm25 = self.index
+        elif self.path_ids is not None:
+            self._corpus = [tokenize_and_remove_stopwords(self._tokenizer, path, stopwords=stopwords)
+                            for path in self.paths]
+            self.index = BM25Index.from_corpus(
                 self._corpus,
                 k1=self.k1,
                 b=self.b,
                 epsilon=self.epsilon,
+                method=BM25_METHODS[self.bm25_type],
+                with_impacts=True,
+                weights=path_counts,
             )
+            self.bm25 = self.index
+        else:
+            self._corpus = [tokenize_and_remove_stopwords(
+                self._tokenizer, get_node_content(node, self.embed_type), stopwords=stopwords)
+                for node in self._nodes]
+            # self._corpus = [self._tokenizer(node.get_content()) for node in self._nodes]
+            if self.bm25_type == 1:
+                self.bm25 = bm25s.BM25(
+                    k1=self.k1,
+                    b=self.b,
+                )
+                self.bm25.index(self._corpus)
+            elif self.bm25_type == 2:
+                self.index = BM25Index.from_corpus(
+                    self._corpus,
+                    k1=self.k1,
+                    b=self.b,
+                    epsilon=self.epsilon,
+                    method=BM25_METHODS[self.bm25_type],
+                    with_impacts=True,
+                )
+                self.bm25 = self.index
+            else:
+                self.bm25 = BM25Okapi(
+                    self._corpus,
+                    k1=self.k1,
+                    b=self.b,
+                    epsilon=self.epsilon,
+                )
         self.filter_dict = None
+        self.columns = MetadataColumns(self._nodes, keys=filter_keys)
+        self.shard_key = None
+        self.shards = None
+        if shard_key:
+            self.build_shards(shard_key)
         self.stopwords = stopwords
+        # 查询分析器可由多个检索器共享，同一查询只分词一次
+        self.analyzer = analyzer or QueryAnalyzer(
+            partial(tokenize_and_remove_stopwords, self._tokenizer, stopwords=stopwords))
         super().__init__(
             callback_manager=callback_manager,
             object_map=object_map,
@@ -125,6 +276,16 @@ class BM25Retriever(BaseRetriever):
             verbose=verbose,
         )
 
+    def build_shards(self, shard_key: str, save_dir: str = "", mmap: bool = True):
+        # 按元数据分片，过滤查询只计算目标分片；提供 save_dir 时分片随索引一起保存、以内存映射方式加载
+        if self.index is None or self.index.impacts is None or self.path_ids is not None:
+            raise ValueError("BM25 shards are only supported with bm25_type=2 on chunk content.")
+        if shard_key not in self.columns.codes:
+            self.columns.add_column(shard_key, [node.metadata.get(shard_key) for node in self._nodes])
+        self.shard_key = shard_key
+        self.shards = BM25Shards.load_or_build(self.index, self.columns.codes[shard_key],
+                                               len(self.columns.value2code[shard_key]), save_dir, mmap=mmap)
+
     def get_scores(self, query, docs=None):
         if docs is None:
             bm25 = self.bm25
@@ -145,11 +306,125 @@ class BM25Retriever(BaseRetriever):
                     b=self.b,
                     epsilon=self.epsilon,
                 )
-        tokenized_query = tokenize_and_remove_stopwords(self._tokenizer, query,
-                                                        stopwords=self.stopwords)
-        scores = bm25.get_scores(tokenized_query)
+        analyzed_query = self.analyzer.analyze(query)
+        if isinstance(bm25, BM25Index):
+            scores = bm25.get_scores(analyzed_query)
+        else:
+            scores = bm25.get_scores(analyzed_query.tokens)
+        if docs is None and self.path_ids is not None:
+            scores = scores[self.path_ids]
         return scores
 
+    def save(self, save_dir: str):
+        """保存词表、倒排表、文档长度和idf，供 load 以内存映射方式加载"""
+        if self.index is None:
+            self.index = BM25Index.from_corpus(
+                self._corpus,
+                k1=self.k1,
+                b=self.b,
+                epsilon=self.epsilon,
+                method=BM25_METHODS[self.bm25_type],
+            )
+        os.makedirs(save_dir, exist_ok=True)
+        meta_file = os.path.join(save_dir, "retriever.json")
+        # 元信息最后写入，存在即代表索引完整
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        # 分片由索引派生，索引重写后旧的分片一律失效
+        for name in os.listdir(save_dir):
+            if name.startswith("shards_"):
+                shutil.rmtree(os.path.join(save_dir, name))
+        self.index.save(os.path.join(save_dir, "index"))
+        if self.shards is not None:
+            self.shards.save(os.path.join(save_dir, f"shards_{self.shard_key}"))
+        meta = {
+            "embed_type": self.embed_type,
+            "bm25_type": self.bm25_type,
+            "stopwords": stopwords_hash(self.stopwords),
+            "node_ids": [node.node_id for node in self._nodes],
+        }
+        with open(meta_file + ".tmp", "w") as f:
+            f.write(json.dumps(meta))
+        os.replace(meta_file + ".tmp", meta_file)
+
+    @classmethod
+    def load(
+            cls,
+            save_dir: str,
+            nodes: List[BaseNode],
+            tokenizer: Optional[Callable[[str], List[str]]] = None,
+            similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K,
+            stopwords: List[str] = [""],
+            mmap: bool = True,
+            update: bool = False,
+            verbose: bool = False,
+            shard_key: Optional[str] = None,
+    ) -> "BM25Retriever":
+        """
+        update=True 时允许节点与保存时不同：沿用未变节点的词频，只对新节点分词，
+        合并后的索引会写回 save_dir。
+        """
+        meta_file = os.path.join(save_dir, "retriever.json")
+        if not os.path.exists(meta_file):
+            raise FileNotFoundError(f"BM25 index not found in {save_dir}")
+        with open(meta_file) as f:
+            meta = json.loads(f.read())
+        if meta["stopwords"] != stopwords_hash(stopwords):
+            raise ValueError("Saved BM25 index was built with different stopwords.")
+        node_ids = [node.node_id for node in nodes]
+        index = BM25Index.load(os.path.join(save_dir, "index"), mmap=mmap)
+        if meta["node_ids"] != node_ids:
+            if not update:
+                raise ValueError("Saved BM25 index does not match the given nodes.")
+            if meta["embed_type"] in PATH_EMBED_TYPES:
+                # 路径索引只包含不重复的路径，重建的代价很小
+                print("BM25路径索引重建")
+                retriever = cls(
+                    nodes=nodes,
+                    tokenizer=tokenizer,
+                    similarity_top_k=similarity_top_k,
+                    stopwords=stopwords,
+                    embed_type=meta["embed_type"],
+                    bm25_type=meta["bm25_type"],
+                )
+                retriever.save(save_dir)
+                return cls.load(save_dir, nodes, tokenizer, similarity_top_k, stopwords, mmap=mmap,
+                                verbose=verbose, shard_key=shard_key)
+            old_pos = {node_id: i for i, node_id in enumerate(meta["node_ids"])}
+            doc_sources = []
+            for node in nodes:
+                if node.node_id in old_pos:
+                    doc_sources.append(old_pos[node.node_id])
+                else:
+                    doc_sources.append(tokenize_and_remove_stopwords(
+                        tokenizer, get_node_content(node, meta["embed_type"]), stopwords=stopwords))
+            num_new = sum(not isinstance(source, int) for source in doc_sources)
+            print(f"BM25索引增量更新：新增{num_new}个节点，删除{len(old_pos) - len(nodes) + num_new}个节点")
+            retriever = cls(
+                nodes=nodes,
+                tokenizer=tokenizer,
+                similarity_top_k=similarity_top_k,
+                stopwords=stopwords,
+                embed_type=meta["embed_type"],
+                bm25_type=meta["bm25_type"],
+                index=index.merge(doc_sources),
+            )
+            retriever.save(save_dir)
+            index = BM25Index.load(os.path.join(save_dir, "index"), mmap=mmap)
+        retriever = cls(
+            nodes=nodes,
+            tokenizer=tokenizer,
+            similarity_top_k=similarity_top_k,
+            verbose=verbose,
+            stopwords=stopwords,
+            embed_type=meta["embed_type"],
+            bm25_type=meta["bm25_type"],
+            index=index,
+        )
+        if shard_key:
+            retriever.build_shards(shard_key, os.path.join(save_dir, f"shards_{shard_key}"), mmap=mmap)
+        return retriever
+
     @classmethod
     def from_defaults(
             cls,
@@ -161,7 +436,8 @@ class BM25Retriever(BaseRetriever):
             verbose: bool = False,
             stopwords: List[str] = [""],
             embed_type: int = 0,
-            bm25_type: int = 0,  # 0-->official bm25-Okapi 1-->bm25s
+            bm25_type: int = 0,  # 0-->official bm25-Okapi 1-->bm25s 2-->built-in sparse matrix
+            shard_key: Optional[str] = None,
     ) -> "BM25Retriever":
         # ensure only one of index, nodes, or docstore is passed
         if sum(bool(val) for val in [index, nodes, docstore]) != 1:
@@ -186,40 +462,126 @@ class BM25Retriever(BaseRetriever):
             stopwords=stopwords,
             embed_type=embed_type,
             bm25_type=bm25_type,
+            shard_key=shard_key,
         )
 
-    def filter(self, scores):
-        top_n = scores.argsort()[::-1]
-        nodes: List[NodeWithScore] = []
-        for ix in top_n:
-            if scores[ix] <= 0:
-                break
-            flag = True
-            if self.filter_dict is not None:
-                for key, value in self.filter_dict.items():
-                    if self._nodes[ix].metadata[key] != value:
-                        flag = False
-                        break
-            if flag:
-                nodes.append(NodeWithScore(node=self._nodes[ix], score=float(scores[ix])))
-            if len(nodes) == self._similarity_top_k:
-                break
-
-        # add nodes sort in BM25Retriever
-        nodes = sorted(nodes, key=lambda x: x.score, reverse=True)
-        return nodes
+    def filter(self, scores, filter_dict=None):
+        # 过滤条件先转换为掩码作用在分数上，再统一做top-k
+        # 选择结果(包括同分文档的先后)与原来 argsort 倒序遍历的方式一致
+        mask = self.columns.mask(filter_dict)
+        return [NodeWithScore(node=self._nodes[ix], score=float(scores[ix]))
+                for ix in bm25_top_k(scores, self._similarity_top_k, mask)]
+
+    def path_filter(self, path_scores, filter_dict=None) -> List[NodeWithScore]:
+        if len(path_scores) == 0 or path_scores.max() <= 0:
+            # 没有路径或查询词都不在路径中
+            return []
+        mask = self.columns.mask(filter_dict)
+        if self.bm25_type != 2:
+            # bm25_type 0/1 展开到全部切片，按原来的方式选择，路径分数相同的切片先后顺序不变
+            scores = path_scores[self.path_ids]
+            chunk_ids = argsort_top_k(scores, self._similarity_top_k, mask)
+            scores = scores[chunk_ids]
+        elif mask is not None:
+            # 带过滤条件时展开到全部切片再过滤
+            scores = np.where(mask, path_scores[self.path_ids], 0)
+            chunk_ids = top_k_indices(scores, self._similarity_top_k)
+            scores = scores[chunk_ids]
+        else:
+            # 按路径分数从高到低累计切片数，只展开分数不低于第k个切片所在路径的那些路径
+            order = np.lexsort((np.arange(len(path_scores)), -path_scores))
+            num_chunks = np.cumsum(np.diff(self.path_ptr)[order])
+            cut = min(np.searchsorted(num_chunks, self._similarity_top_k), len(order) - 1)
+            threshold = max(path_scores[order[cut]], np.finfo(np.float32).tiny)
+            candidates = np.flatnonzero(path_scores >= threshold)
+            chunk_ids = np.sort(np.concatenate(
+                [self.path_chunks[self.path_ptr[p]:self.path_ptr[p + 1]] for p in candidates] + [[]]
+            ).astype(np.int64))
+            scores = path_scores[self.path_ids[chunk_ids]]
+            top_n = top_k_indices(scores, self._similarity_top_k)
+            chunk_ids, scores = chunk_ids[top_n], scores[top_n]
+        return [NodeWithScore(node=self._nodes[ix], score=float(score))
+                for ix, score in zip(chunk_ids, scores) if score > 0]
+
+    def shard_retrieve(self, query, filter_dict=None) -> List[NodeWithScore]:
+        filter_dict = dict(filter_dict or {})
+        shard = None
+        if self.shard_key in filter_dict:
+            shard = self.columns.value2code[self.shard_key].get(filter_dict.pop(self.shard_key))
+            if shard is None:
+                return []
+        doc_ids, scores = self.shards.top_k(self.analyzer.analyze(query), self._similarity_top_k,
+                                            shard=shard, mask=self.columns.mask(filter_dict))
+        return [NodeWithScore(node=self._nodes[ix], score=float(score))
+                for ix, score in zip(doc_ids, scores) if score > 0]
+
+    def retrieve_batch(
+            self,
+            query_bundles: List[QueryBundle],
+            filter_dicts: Optional[List[Optional[dict]]] = None,
+    ) -> List[List[NodeWithScore]]:
+        """
+        批量检索，结果与逐条调用 retrieve 一致。
+        内置稀疏矩阵实现(bm25_type=2)对整批查询只做一次稀疏矩阵乘法，再逐行取top-k；
+        其余实现逐条打分。filter_dicts 为空时所有查询使用当前请求上下文(或 self.filter_dict)的过滤条件。
+        """
+        if filter_dicts is None:
+            filter_dicts = [request_value("filter_dict", self.filter_dict)] * len(query_bundles)
+        if self.index is None or self.index.impacts is None or (self.bm25_type != 2 and self.path_ids is None):
+            results = []
+            for query_bundle, filter_dict in zip(query_bundles, filter_dicts):
+                with request_context(RequestContext(filter_dict=filter_dict)):
+                    results.append(self.retrieve(query_bundle))
+            return results
+        queries = [self.analyzer.analyze(query_bundle.query_str) for query_bundle in query_bundles]
+        scores = self.index.get_batch_scores(queries)
+        results = []
+        for i, (query_bundle, filter_dict) in enumerate(zip(query_bundles, filter_dicts)):
+            # 还原为完整的分数数组，选择方式与 retrieve 完全相同
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            row = np.zeros(self.index.num_docs, dtype=np.float64)
+            row[scores.indices[start:end]] = scores.data[start:end]
+            if self.path_ids is not None:
+                nodes = self.path_filter(row, filter_dict)
+            else:
+                nodes = self.filter(row, filter_dict)
+            results.append(self._handle_recursive_retrieval(query_bundle, nodes))
+        return results
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # 分词和打分都是CPU计算，放到线程池中执行；线程池不继承上下文变量，需要带上当前请求的上下文
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, contextvars.copy_context().run, self._retrieve, query_bundle)
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         if query_bundle.custom_embedding_strs or query_bundle.embedding:
             logger.warning("BM25Retriever does not support embeddings, skipping...")
 
         query = query_bundle.query_str
+        filter_dict = request_value("filter_dict", self.filter_dict)
+        if self.shards is not None:
+            return self.shard_retrieve(query, filter_dict)
+        if self.path_ids is not None:
+            path_scores = self.bm25.get_scores(self.analyzer.analyze(query))
+            return self.path_filter(path_scores, filter_dict)
         scores = self.get_scores(query)
-        nodes = self.filter(scores)
+        nodes = self.filter(scores, filter_dict)
 
         return nodes
 
 
+def reciprocal_rank_scores(id_lists: Sequence[np.ndarray], num_ids: int, K: int = 60) -> np.ndarray:
+    """
+    多路排序结果的倒数排名融合分数。每一路是按排名排列的整数编号数组，
+    返回长度为 num_ids 的分数数组，多查询扩展等路数较多时也只需一次 bincount。
+    """
+    if not id_lists:
+        return np.zeros(num_ids, dtype=np.float64)
+    ids = np.concatenate(id_lists)
+    weights = np.concatenate([1.0 / (np.arange(1, len(id_list) + 1) + K) for id_list in id_lists])
+    return np.bincount(ids, weights=weights, minlength=num_ids)
+
+
 class HybridRetriever(BaseRetriever):
     def __init__(
             self,
@@ -231,8 +593,10 @@ class HybridRetriever(BaseRetriever):
         self.dense_retriever = dense_retriever
         self.sparse_retriever = sparse_retriever
         self.retrieval_type = retrieval_type  # 1:dense only 2:sparse only 3:hybrid
+        # 不在请求上下文中调用时，两路子检索器使用这里的过滤条件
         self.filters = None
         self.filter_dict = None
+        self.hnsw_ef = None
         self.topk = topk
         super().__init__()
 
@@ -240,13 +604,13 @@ class HybridRetriever(BaseRetriever):
     def fusion(self, list_of_list_ranks_system, topk=256):
         all_nodes = []
 
-        node_ids = set()
+        fingerprints = set()
         for nodes in list_of_list_ranks_system:
             for node in nodes:
-                content = node.get_content()
-                if content not in node_ids:
+                fingerprint = content_fingerprint(node)
+                if fingerprint not in fingerprints:
                     all_nodes.append(node)
-                    node_ids.add(content)
+                    fingerprints.add(fingerprint)
         all_nodes = sorted(all_nodes, key=lambda node: node.score, reverse=True)
         topk = min(len(all_nodes), topk)
         # print("simple fusion后数量:", topk)
@@ -255,35 +619,47 @@ class HybridRetriever(BaseRetriever):
     # 倒数排序融合
     @classmethod
     def reciprocal_rank_fusion(self, list_of_list_ranks_system, K=60, topk=256):
-        from collections import defaultdict
-        rrf_map = defaultdict(float)
-        text_to_node = {}
+        # 内容相同的节点(不同切分或不同检索器返回的副本)按指纹映射到同一个整数编号，保留最后出现的节点
+        fingerprint_to_id = {}
+        id_to_node: List[NodeWithScore] = []
+        id_lists = []
         for rank_list in list_of_list_ranks_system:
-            for rank, item in enumerate(rank_list, 1):
-                content = item.get_content()
-                text_to_node[content] = item
-                rrf_map[content] += 1 / (rank + K)
-        sorted_items = sorted(rrf_map.items(), key=lambda x: x[1], reverse=True)
+            ids = np.empty(len(rank_list), dtype=np.int64)
+            for rank, item in enumerate(rank_list):
+                idx = fingerprint_to_id.setdefault(content_fingerprint(item), len(id_to_node))
+                if idx == len(id_to_node):
+                    id_to_node.append(item)
+                else:
+                    id_to_node[idx] = item
+                ids[rank] = idx
+            id_lists.append(ids)
+        scores = reciprocal_rank_scores(id_lists, len(id_to_node), K)
 
         reranked_nodes: List[NodeWithScore] = []
-        for text, score in sorted_items:
-            reranked_nodes.append(text_to_node[text])
-            reranked_nodes[-1].score = score
-        topk = min(topk, len(reranked_nodes))
-        # print("rrf fusion后数量:", topk)
-        return reranked_nodes[:topk]
+        for idx in top_k_indices(scores, topk):
+            reranked_nodes.append(id_to_node[idx])
+            reranked_nodes[-1].score = float(scores[idx])
+        # print("rrf fusion后数量:", len(reranked_nodes))
+        return reranked_nodes
+
+    def request(self) -> RequestContext:
+        context = current_request()
+        if context is None:
+            context = RequestContext(filters=self.filters, filter_dict=self.filter_dict, hnsw_ef=self.hnsw_ef)
+        return context
 
     async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
-        if self.retrieval_type != 1:
-            self.sparse_retriever.filter_dict = self.filter_dict
-            sparse_nodes = await self.sparse_retriever.aretrieve(query_bundle)
+        with request_context(self.request()):
             if self.retrieval_type == 2:
-                return sparse_nodes
-        if self.retrieval_type != 2:
-            self.dense_retriever.filters = self.filters
-            dense_nodes = await self.dense_retriever.aretrieve(query_bundle)
+                return await self.sparse_retriever.aretrieve(query_bundle)
             if self.retrieval_type == 1:
-                return dense_nodes
+                return await self.dense_retriever.aretrieve(query_bundle)
+
+            # 两路检索并发执行，耗时取两者的最大值
+            sparse_nodes, dense_nodes = await asyncio.gather(
+                self.sparse_retriever.aretrieve(query_bundle),
+                self.dense_retriever.aretrieve(query_bundle),
+            )
 
         # combine the two lists of nodes
         # all_nodes = self.fusion(sparse_nodes, dense_nodes)
@@ -0,0 +1,398 @@
+import asyncio
+import json
+import os
+import shutil
+from functools import partial
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores import VectorStoreQuery, VectorStoreQueryResult
+from llama_index.core.vector_stores.types import VectorStoreQueryMode
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from qdrant_client import models
+from qdrant_client.http.models import FieldCondition, Filter, MatchValue
+
+from .bm25 import top_k_indices
+from .columns import MetadataColumns
+
+LOCAL_STORE_VERSION = 1
+QUANTIZATION_TYPES = ("", "int8", "binary")
+# 集合中BM25稀疏向量的名字，密集向量仍为默认的无名向量
+SPARSE_VECTOR_NAME = "bm25"
+# 0-255 每个字节中1的个数，用于二值向量的汉明距离
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class LocalVectorStore:
+    """
+    进程内的向量索引，可替代qdrant供 QdrantRetriever 使用。
+    向量归一化后以float16保存并内存映射加载，相似度为余弦相似度，与qdrant的COSINE一致。
+    向量数少于 ivf_threshold 时精确检索，分块从内存映射的向量计算相似度；否则按IVF粗量化器分桶，
+    同一桶的向量在文件中连续存放，查询只计算与查询最接近的 nprobe 个桶，
+    这些桶中的向量(带过滤条件时为满足条件的向量)不足k个时按顺序继续增加桶。
+    quantization 为 int8 或 binary 时内存中只保留量化编码，先用编码粗排 topk x oversampling 个候选，
+    再从磁盘上的float16向量读取候选重新打分。
+    """
+
+    def __init__(
+            self,
+            persist_dir: str,
+            nodes: List[BaseNode],
+            nprobe: int = 8,
+            quantization: str = "",
+            oversampling: float = 3.0,
+            filter_keys=("dir",),
+    ):
+        with open(os.path.join(persist_dir, "meta.json")) as f:
+            self.meta = json.loads(f.read())
+        if self.meta["version"] != LOCAL_STORE_VERSION:
+            raise ValueError(f"Local vector store version mismatch: {self.meta['version']}")
+        if self.meta.get("quantization", "") != quantization:
+            raise ValueError(f"Local vector store quantization mismatch: {self.meta.get('quantization', '')}")
+        with open(os.path.join(persist_dir, "ids.json")) as f:
+            ids = json.loads(f.read())
+        id2node = {node.node_id: node for node in nodes}
+        if len(ids) != len(nodes) or any(node_id not in id2node for node_id in ids):
+            raise ValueError("Local vector store does not match the given nodes.")
+        self.persist_dir = persist_dir
+        self.ids = ids
+        # 存储顺序(按桶排列)下的节点
+        self.nodes = [id2node[node_id] for node_id in ids]
+        self.columns = MetadataColumns(self.nodes, keys=filter_keys)
+        self.vectors = np.load(os.path.join(persist_dir, "vectors.npy"), mmap_mode="r")
+        self.nprobe = nprobe
+        self.quantization = quantization
+        self.oversampling = oversampling
+        self.centroids = None
+        self.list_ptr = None
+        self.codes = None
+        if self.meta["ivf"]:
+            self.centroids = np.load(os.path.join(persist_dir, "centroids.npy"))
+            self.list_ptr = np.load(os.path.join(persist_dir, "list_ptr.npy"))
+        if quantization:
+            self.codes = np.load(os.path.join(persist_dir, "codes.npy"))
+
+    @classmethod
+    def build(
+            cls,
+            persist_dir: str,
+            nodes: List[BaseNode],
+            embed_fn: Callable[[List[BaseNode]], np.ndarray],
+            config: dict = None,
+            ivf_threshold: int = 20000,
+            block_size: int = 1024,
+            nprobe: int = 8,
+            quantization: str = "",
+            oversampling: float = 3.0,
+    ) -> "LocalVectorStore":
+        """分块编码后写入float16文件，超过 ivf_threshold 时训练粗量化器并按桶重排，需要时再生成量化编码"""
+        if quantization not in QUANTIZATION_TYPES:
+            raise ValueError(f"Invalid quantization: {quantization}")
+        tmp_dir = persist_dir.rstrip("/") + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        vectors = None
+        for start in range(0, len(nodes), block_size):
+            block = normalize(np.asarray(embed_fn(nodes[start:start + block_size]), dtype=np.float32))
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(os.path.join(tmp_dir, "raw.npy"), mode="w+",
+                                                    dtype=np.float16, shape=(len(nodes), block.shape[1]))
+            vectors[start:start + len(block)] = block
+        ids = [node.node_id for node in nodes]
+        ivf = vectors is not None and len(nodes) >= ivf_threshold
+        if ivf:
+            nlist = int(4 * np.sqrt(len(nodes)))
+            centroids = train_kmeans(vectors, nlist)
+            assign = assign_lists(vectors, centroids)
+            order = np.argsort(assign, kind="stable")
+            list_ptr = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+            ordered = np.lib.format.open_memmap(os.path.join(tmp_dir, "vectors.npy"), mode="w+",
+                                                dtype=np.float16, shape=vectors.shape)
+            for start in range(0, len(order), block_size):
+                ordered[start:start + block_size] = vectors[order[start:start + block_size]]
+            ordered.flush()
+            del ordered, vectors
+            os.remove(os.path.join(tmp_dir, "raw.npy"))
+            np.save(os.path.join(tmp_dir, "centroids.npy"), centroids)
+            np.save(os.path.join(tmp_dir, "list_ptr.npy"), list_ptr)
+            ids = [ids[i] for i in order]
+        else:
+            if vectors is None:
+                vectors = np.zeros((0, 0), dtype=np.float16)
+                np.save(os.path.join(tmp_dir, "vectors.npy"), vectors)
+            else:
+                vectors.flush()
+                del vectors
+                os.replace(os.path.join(tmp_dir, "raw.npy"), os.path.join(tmp_dir, "vectors.npy"))
+        if quantization:
+            vectors = np.load(os.path.join(tmp_dir, "vectors.npy"), mmap_mode="r")
+            np.save(os.path.join(tmp_dir, "codes.npy"), quantize(vectors, quantization, block_size))
+            del vectors
+        with open(os.path.join(tmp_dir, "ids.json"), "w") as f:
+            f.write(json.dumps(ids))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            f.write(json.dumps({"version": LOCAL_STORE_VERSION, "ivf": bool(ivf), "config": config,
+                                "quantization": quantization}))
+        if os.path.exists(persist_dir):
+            shutil.rmtree(persist_dir)
+        os.replace(tmp_dir, persist_dir)
+        return cls(persist_dir, nodes, nprobe=nprobe, quantization=quantization, oversampling=oversampling)
+
+    def search(
+            self,
+            query_embedding: np.ndarray,
+            k: int,
+            mask: Optional[np.ndarray] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """返回存储顺序下的行号和余弦相似度，按相似度降序"""
+        query = normalize(np.asarray(query_embedding, dtype=np.float32)[None])[0]
+        if self.centroids is None:
+            rows = None
+            ranges = [(0, len(self.vectors))]
+        else:
+            lists = self.probe_lists(query, k, mask)
+            ranges = [(self.list_ptr[i], self.list_ptr[i + 1]) for i in lists]
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges] + [np.zeros(0, dtype=np.int64)])
+        if self.codes is not None:
+            scores = np.concatenate([self.approx_scores(start, end, query) for start, end in ranges]
+                                    + [np.zeros(0, dtype=np.float32)])
+        else:
+            scores = np.concatenate([self.exact_scores(start, end, query) for start, end in ranges]
+                                    + [np.zeros(0, dtype=np.float32)])
+        if mask is not None:
+            scores = np.where(mask if rows is None else mask[rows], scores, -np.inf)
+        if self.codes is None:
+            top_n = top_k_indices(scores, k)
+            top_n = top_n[np.isfinite(scores[top_n])]
+            return (top_n if rows is None else rows[top_n]), scores[top_n]
+        # 量化编码粗排，候选按行号顺序从磁盘读取原始向量重打分
+        candidates = top_k_indices(scores, max(int(k * self.oversampling), k))
+        candidates = candidates[np.isfinite(scores[candidates])]
+        candidates = np.sort(candidates if rows is None else rows[candidates])
+        scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+        top_n = top_k_indices(scores, k)
+        return candidates[top_n], scores[top_n]
+
+    def probe_lists(self, query: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        # 按质心相似度从高到低取桶，至少 nprobe 个，直到累计的(满足过滤条件的)向量数达到k或桶已取完
+        order = top_k_indices(self.centroids @ query, len(self.centroids))
+        if mask is None:
+            counts = np.diff(self.list_ptr)
+        else:
+            matched = np.concatenate([[0], np.cumsum(mask, dtype=np.int64)])
+            counts = matched[self.list_ptr[1:]] - matched[self.list_ptr[:-1]]
+        enough = np.flatnonzero(np.cumsum(counts[order]) >= k)
+        num_lists = len(order) if len(enough) == 0 else enough[0] + 1
+        return order[:max(min(self.nprobe, len(order)), num_lists)]
+
+    def exact_scores(self, start: int, end: int, query: np.ndarray, block_size: int = 16384) -> np.ndarray:
+        # 分块从内存映射的float16向量计算相似度，内存中只有一个块的float32副本
+        scores = np.empty(end - start, dtype=np.float32)
+        for i in range(start, end, block_size):
+            block = np.asarray(self.vectors[i:min(i + block_size, end)], dtype=np.float32)
+            scores[i - start:i - start + len(block)] = block @ query
+        return scores
+
+    def approx_scores(self, start: int, end: int, query: np.ndarray, block_size: int = 16384) -> np.ndarray:
+        # 与量化编码的近似相似度，只用于排序：int8为内积，binary为负的汉明距离
+        scores = np.empty(end - start, dtype=np.float32)
+        if self.quantization == "binary":
+            query_code = np.packbits(query > 0)
+        for i in range(start, end, block_size):
+            codes = self.codes[i:min(i + block_size, end)]
+            if self.quantization == "binary":
+                scores[i - start:i - start + len(codes)] = -_POPCOUNT[codes ^ query_code].sum(axis=1, dtype=np.int32)
+            else:
+                scores[i - start:i - start + len(codes)] = codes.astype(np.float32) @ query
+        return scores
+
+    def query(self, query: VectorStoreQuery, qdrant_filters: Optional[Filter] = None, **kwargs) -> VectorStoreQueryResult:
+        mask = self.columns.mask(parse_qdrant_filter(qdrant_filters))
+        rows, scores = self.search(query.query_embedding, query.similarity_top_k, mask)
+        return VectorStoreQueryResult(
+            nodes=[self.nodes[row] for row in rows],
+            similarities=scores.tolist(),
+            ids=[self.ids[row] for row in rows],
+        )
+
+    async def aquery(self, query: VectorStoreQuery, qdrant_filters: Optional[Filter] = None,
+                     **kwargs) -> VectorStoreQueryResult:
+        # 相似度计算在线程池中执行，不阻塞事件循环上的其他请求
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(self.query, query, qdrant_filters=qdrant_filters, **kwargs))
+
+
+class SearchParamsQdrantVectorStore(QdrantVectorStore):
+    """
+    密集检索时附带 search_params(量化粗排的过采样和重打分、hnsw_ef)，其他查询模式与 QdrantVectorStore 相同。
+    查询时传入的 hnsw_ef 优先于默认值。
+    """
+
+    _search_params: Optional[models.SearchParams] = PrivateAttr(default=None)
+
+    def __init__(self, *args, search_params: Optional[models.SearchParams] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._search_params = search_params
+
+    def get_search_params(self, query: VectorStoreQuery, hnsw_ef: Optional[int] = None) -> Optional[models.SearchParams]:
+        if self.enable_hybrid or query.mode != VectorStoreQueryMode.DEFAULT:
+            return None
+        if not hnsw_ef:
+            return self._search_params
+        search_params = self._search_params or models.SearchParams()
+        return models.SearchParams(
+            hnsw_ef=hnsw_ef,
+            exact=search_params.exact,
+            quantization=search_params.quantization,
+            indexed_only=search_params.indexed_only,
+        )
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        search_params = self.get_search_params(query, kwargs.pop("hnsw_ef", None))
+        if search_params is None:
+            return super().query(query, **kwargs)
+        response = self._client.search(
+            collection_name=self.collection_name,
+            query_vector=query.query_embedding,
+            limit=query.similarity_top_k,
+            query_filter=kwargs.get("qdrant_filters") or self._build_query_filter(query),
+            search_params=search_params,
+        )
+        return self.parse_to_query_result(response)
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        search_params = self.get_search_params(query, kwargs.pop("hnsw_ef", None))
+        if search_params is None:
+            return await super().aquery(query, **kwargs)
+        response = await self._aclient.search(
+            collection_name=self.collection_name,
+            query_vector=query.query_embedding,
+            limit=query.similarity_top_k,
+            query_filter=kwargs.get("qdrant_filters") or self._build_query_filter(query),
+            search_params=search_params,
+        )
+        return self.parse_to_query_result(response)
+
+    async def ahybrid_query(
+            self,
+            query_embedding: List[float],
+            sparse_vector: Tuple[List[int], List[float]],
+            similarity_top_k: int,
+            dense_top_k: int,
+            sparse_top_k: int,
+            qdrant_filters: Optional[Filter] = None,
+            hnsw_ef: Optional[int] = None,
+    ) -> VectorStoreQueryResult:
+        """密集和BM25稀疏两路候选在qdrant中预取，并由qdrant做倒数排序融合，一次请求返回融合结果"""
+        search_params = self.get_search_params(VectorStoreQuery(query_embedding=query_embedding), hnsw_ef)
+        prefetch = [models.Prefetch(query=query_embedding, limit=dense_top_k, filter=qdrant_filters,
+                                    params=search_params)]
+        indices, values = sparse_vector
+        if indices:
+            prefetch.append(models.Prefetch(
+                query=models.SparseVector(indices=indices, values=values),
+                using=SPARSE_VECTOR_NAME,
+                limit=sparse_top_k,
+                filter=qdrant_filters,
+            ))
+        response = await self._aclient.query_points(
+            collection_name=self.collection_name,
+            prefetch=prefetch,
+            query=models.FusionQuery(fusion=models.Fusion.RRF),
+            limit=similarity_top_k,
+            with_payload=True,
+        )
+        return self.parse_to_query_result(response.points)
+
+
+def build_quantization_config(quantization: str):
+    # 量化编码常驻内存，原始向量存于磁盘只用于重打分
+    if quantization == "int8":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True),
+        )
+    if quantization == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    if quantization:
+        raise ValueError(f"Invalid quantization: {quantization}")
+    return None
+
+
+def build_search_params(
+        quantization: str,
+        oversampling: float = 3.0,
+        hnsw_ef: Optional[int] = None,
+) -> Optional[models.SearchParams]:
+    if not quantization and not hnsw_ef:
+        return None
+    return models.SearchParams(
+        hnsw_ef=hnsw_ef or None,
+        quantization=models.QuantizationSearchParams(rescore=True, oversampling=oversampling) if quantization else None,
+    )
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def quantize(vectors: np.ndarray, quantization: str, block_size: int = 8192) -> np.ndarray:
+    """
+    int8：按所有分量绝对值的0.99分位数确定全局缩放，截断到[-127, 127]；
+    binary：每个分量取符号位，8维打包为一个字节
+    """
+    if len(vectors) == 0:
+        dim = vectors.shape[1] if vectors.ndim == 2 else 0
+        return np.zeros((0, (dim + 7) // 8 if quantization == "binary" else dim),
+                        dtype=np.uint8 if quantization == "binary" else np.int8)
+    if quantization == "binary":
+        return np.concatenate([np.packbits(np.asarray(vectors[i:i + block_size]) > 0, axis=1)
+                               for i in range(0, len(vectors), block_size)])
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(len(vectors), min(len(vectors), 10000), replace=False))
+    scale = max(float(np.quantile(np.abs(np.asarray(vectors[sample], dtype=np.float32)), 0.99)), 1e-6) / 127
+    return np.concatenate([
+        np.clip(np.rint(np.asarray(vectors[i:i + block_size], dtype=np.float32) / scale), -127, 127).astype(np.int8)
+        for i in range(0, len(vectors), block_size)
+    ])
+
+
+def parse_qdrant_filter(qdrant_filters: Optional[Filter]) -> Optional[dict]:
+    # 只支持 build_qdrant_filters 生成的 must + 精确匹配 条件
+    if qdrant_filters is None:
+        return None
+    if qdrant_filters.should or qdrant_filters.must_not:
+        raise ValueError("Local vector store only supports `must` filters.")
+    filter_dict = dict()
+    for condition in qdrant_filters.must or []:
+        if not isinstance(condition, FieldCondition) or not isinstance(condition.match, MatchValue):
+            raise ValueError(f"Unsupported filter condition for local vector store: {condition}")
+        filter_dict[condition.key] = condition.match.value
+    return filter_dict
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 8192) -> np.ndarray:
+    assign = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        assign[start:start + block_size] = (block @ centroids.T).argmax(axis=1)
+    return assign
+
+
+def train_kmeans(vectors: np.ndarray, nlist: int, iters: int = 10, sample_size: int = 256, seed: int = 0) -> np.ndarray:
+    # 球面k-means：在采样上按内积聚类，质心归一化
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(vectors), min(len(vectors), nlist * sample_size), replace=False))
+    x = np.asarray(vectors[sample], dtype=np.float32)
+    centroids = x[rng.choice(len(x), nlist, replace=False)]
+    for _ in range(iters):
+        assign = (x @ centroids.T).argmax(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        # 空桶重新随机取一个样本作为质心
+        sums[empty] = x[rng.choice(len(x), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
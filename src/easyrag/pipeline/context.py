@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+
+@dataclass
+class RequestContext:
+    """
+    单个请求的检索状态：过滤条件、HNSW参数、精排前的检索分数和各阶段输出。
+    检索器和精排模型从当前请求的上下文中读取/写入这些状态，自身保持只读，多个请求可以在同一事件循环上并发执行。
+    """
+    filters: Any = None  # qdrant 过滤条件
+    filter_dict: Optional[dict] = None  # BM25 元数据过滤条件
+    hnsw_ef: Optional[int] = None
+    retrieval_scores: Dict[str, float] = field(default_factory=dict)  # node_id -> 精排前的检索分数
+    stages: Dict[str, Any] = field(default_factory=dict)  # 阶段名 -> 该阶段输出
+
+
+_request_context: ContextVar[Optional[RequestContext]] = ContextVar("easyrag_request_context", default=None)
+
+
+def current_request() -> Optional[RequestContext]:
+    return _request_context.get()
+
+
+def request_value(name: str, default: Any = None) -> Any:
+    # 处于请求上下文中时以上下文为准，否则使用检索器自身的默认配置
+    context = _request_context.get()
+    return default if context is None else getattr(context, name)
+
+
+@contextmanager
+def request_context(context: RequestContext):
+    # asyncio 的任务创建时复制当前上下文，请求内并发的子任务也能读到
+    token = _request_context.set(context)
+    try:
+        yield context
+    finally:
+        _request_context.reset(token)
+
+
+def record_stage(name: str, output: Any):
+    context = _request_context.get()
+    if context is not None:
+        context.stages[name] = output
@@ -1,20 +1,39 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from collections import Counter
 from typing import List, Dict, Any
 
+import numpy as np
 from llama_index.core.node_parser import HierarchicalNodeParser
 
 from ..custom.transformation import CustomFilePathExtractor, CustomTitleExtractor
 from llama_index.core import SimpleDirectoryReader
 from llama_index.core.embeddings import BaseEmbedding
-from llama_index.core.ingestion import IngestionPipeline
-from llama_index.core.llms.llm import LLM
+from llama_index.core.ingestion import IngestionPipeline, run_transformations
 from ..custom.splitter import SentenceSplitter
 from ..custom.hierarchical import HierarchicalNodeParser
-from llama_index.core.schema import Document, MetadataMode, TransformComponent, NodeRelationship, TextNode, NodeWithScore
-from llama_index.core.vector_stores.types import BasePydanticVectorStore, MetadataFilters, MetadataFilter
+from ..custom.vector_stores import LocalVectorStore, SearchParamsQdrantVectorStore, build_quantization_config, \
+    build_search_params, SPARSE_VECTOR_NAME
+from ..custom.bm25 import BM25SparseEncoder
+from llama_index.core.schema import Document, MetadataMode, TransformComponent, NodeRelationship, TextNode, NodeWithScore, BaseNode
+from llama_index.core.vector_stores.types import MetadataFilters, MetadataFilter
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
 from llama_index.vector_stores.qdrant import QdrantVectorStore
 from qdrant_client import AsyncQdrantClient, models
 from qdrant_client.http.exceptions import UnexpectedResponse
-from qdrant_client.http.models import Filter, FieldCondition, MatchValue
+from qdrant_client.http.models import Filter, FieldCondition, MatchValue, MatchAny
+from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
+from .snapshot import scan_data_files, diff_files, load_nodes_snapshot, save_nodes_snapshot, load_manifest, save_manifest
+
+
+# 向量库点id的命名空间
+POINT_ID_NAMESPACE = uuid.UUID("6f1c2a8e-5d1b-4c47-9a55-3b2f0e7d9c10")
 
 
 def merge_strings(A, B):
@@ -76,9 +95,27 @@ def get_node_content(node: NodeWithScore, embed_type=0, nodes: list[TextNode] =
     return text
 
 
-def read_data(path: str = "data") -> list[Document]:
+def content_fingerprint(node: BaseNode) -> str:
+    """节点正文的指纹，融合去重时代替整段正文作为键；建库时预先写入元数据，缺失时现算"""
+    fingerprint = node.metadata.get("content_fp")
+    if fingerprint is None:
+        fingerprint = hashlib.blake2b(node.get_content().encode("utf-8"), digest_size=8).hexdigest()
+    return fingerprint
+
+
+def set_content_fingerprints(nodes: list[BaseNode]):
+    for node in nodes:
+        if "content_fp" not in node.metadata:
+            node.metadata["content_fp"] = content_fingerprint(node)
+            # 指纹只用于去重，不进入嵌入和大模型的上下文
+            node.excluded_embed_metadata_keys.append("content_fp")
+            node.excluded_llm_metadata_keys.append("content_fp")
+
+
+def read_data(path: str = "data", input_files: list[str] = None) -> list[Document]:
     reader = SimpleDirectoryReader(
-        input_dir=path,
+        input_dir=path if input_files is None else None,
+        input_files=input_files,
         recursive=True,
         required_exts=[
             ".txt",
@@ -87,6 +124,79 @@ def read_data(path: str = "data") -> list[Document]:
     return reader.load_data()
 
 
+def group_nodes_by_file(nodes: list[BaseNode]) -> dict[str, list[BaseNode]]:
+    file2nodes = dict()
+    for node in nodes:
+        file2nodes.setdefault(node.metadata["file_path"], []).append(node)
+    return file2nodes
+
+
+def link_adjacent_nodes(nodes: list[BaseNode]):
+    """
+    按列表顺序重建相邻节点的 PREVIOUS/NEXT 关系，与对整个语料一次切分的结果一致(句子切分会跨文档串联)。
+    只改动与相邻节点不一致的关系，用于分片拼接处和增量更新后的文件边界。
+    """
+    for prev_node, node in zip(nodes, nodes[1:]):
+        next_info = prev_node.relationships.get(NodeRelationship.NEXT)
+        if next_info is None or next_info.node_id != node.node_id:
+            prev_node.relationships[NodeRelationship.NEXT] = node.as_related_node_info()
+        prev_info = node.relationships.get(NodeRelationship.PREVIOUS)
+        if prev_info is None or prev_info.node_id != prev_node.node_id:
+            node.relationships[NodeRelationship.PREVIOUS] = prev_node.as_related_node_info()
+    if nodes:
+        nodes[0].relationships.pop(NodeRelationship.PREVIOUS, None)
+        nodes[-1].relationships.pop(NodeRelationship.NEXT, None)
+
+
+async def build_nodes(
+        data_path,
+        chunk_size=1024,
+        chunk_overlap=50,
+        split_type=0,
+        snapshot_path="",
+        num_workers=1,
+) -> list[BaseNode]:
+    """
+    文档预处理成节点。设置 snapshot_path 时优先使用节点快照：
+    语料未变化直接加载，部分文件变化时只对新增和修改的文件重新预处理。
+    """
+    files, snapshot = None, None
+    if snapshot_path:
+        files = scan_data_files(data_path)
+        snapshot = load_nodes_snapshot(snapshot_path, data_path, chunk_size, chunk_overlap, split_type)
+    if snapshot is not None and snapshot["files"] == files:
+        print(f"从快照加载节点，一共有{len(snapshot['nodes'])}个节点")
+        set_content_fingerprints(snapshot["nodes"])
+        return snapshot["nodes"]
+
+    if snapshot is None:
+        data = read_data(data_path)
+        print(f"文档读入完成，一共有{len(data)}个文档")
+        nodes = await arun_preprocess(data, data_path, chunk_size, chunk_overlap, split_type, num_workers)
+    else:
+        added, changed, deleted = diff_files(snapshot["files"], files)
+        print(f"语料增量更新：新增{len(added)}个文件，修改{len(changed)}个文件，删除{len(deleted)}个文件")
+        new_nodes = []
+        if added or changed:
+            data = read_data(data_path, input_files=[os.path.join(data_path, path) for path in added + changed])
+            new_nodes = await arun_preprocess(data, data_path, chunk_size, chunk_overlap, split_type, num_workers)
+        file2nodes = group_nodes_by_file(snapshot["nodes"])
+        for path in changed + deleted:
+            file2nodes.pop(path, None)
+        file2nodes.update(group_nodes_by_file(new_nodes))
+        nodes = [node for path in files for node in file2nodes.get(path, [])]
+        if split_type == 0:
+            # 未变化文件的节点仍指向已修改或删除文件中的旧节点，按合并后的顺序重新串联
+            link_adjacent_nodes(nodes)
+    set_content_fingerprints(nodes)
+
+    if snapshot_path:
+        snapshot_file = save_nodes_snapshot(
+            snapshot_path, data_path, chunk_size, chunk_overlap, split_type, nodes, files)
+        print(f"节点快照已保存至{snapshot_file}")
+    return nodes
+
+
 def build_preprocess(
         data_path=None,
         chunk_size=1024,
@@ -127,29 +237,86 @@ def build_preprocess_pipeline(
     return IngestionPipeline(transformations=transformation)
 
 
-def build_pipeline(
-        llm: LLM,
-        embed_model: BaseEmbedding,
-        template: str = None,
-        vector_store: BasePydanticVectorStore = None,
+def preprocess_documents(
+        documents: list[Document],
         data_path=None,
         chunk_size=1024,
         chunk_overlap=50,
-) -> IngestionPipeline:
+        split_type=0,
+) -> list[BaseNode]:
+    # 在子进程内重新构建transformation，分词器等闭包对象无法pickle到子进程
     transformation = build_preprocess(
         data_path,
         chunk_size,
         chunk_overlap,
+        split_type=split_type,
     )
-    transformation.extend([
-        # SummaryExtractor(
-        #     llm=llm,
-        #     metadata_mode=MetadataMode.EMBED,
-        #     prompt_template=template or SUMMARY_EXTRACT_TEMPLATE,
-        # ),
-        embed_model,
-    ])
-    return IngestionPipeline(transformations=transformation, vector_store=vector_store)
+    return run_transformations(documents, transformation)
+
+
+def shard_documents(documents: list[Document], num_shards: int) -> list[list[Document]]:
+    # 按文本长度切成大致均衡的连续分片，分片内外都保持文档原有顺序
+    total = sum(len(doc.text) for doc in documents)
+    target = max(1, total // max(1, num_shards))
+    shards, shard, size = [], [], 0
+    for doc in documents:
+        shard.append(doc)
+        size += len(doc.text)
+        if size >= target:
+            shards.append(shard)
+            shard, size = [], 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+async def arun_preprocess(
+        documents: list[Document],
+        data_path=None,
+        chunk_size=1024,
+        chunk_overlap=50,
+        split_type=0,
+        num_workers=1,
+) -> list[BaseNode]:
+    """
+    文档切分和元数据抽取。num_workers > 1 时按文档分片交给进程池，
+    每个文档只会落在一个分片内，文档标题不受影响；结果按分片顺序拼接，
+    句子切分时再补上分片之间的前后节点关系，与串行切分一致。
+    """
+    if num_workers <= 1 or len(documents) <= 1:
+        preprocess_pipeline = build_preprocess_pipeline(
+            data_path,
+            chunk_size,
+            chunk_overlap,
+            split_type,
+        )
+        return await preprocess_pipeline.arun(documents=documents, show_progress=True, num_workers=1)
+
+    num_workers = min(num_workers, multiprocessing.cpu_count())
+    # 分片数多于进程数，先完成的进程继续领取分片，减少长文档造成的等待
+    shards = shard_documents(documents, num_workers * 4)
+    loop = asyncio.get_event_loop()
+    # 使用spawn避免fork已加载模型和线程池的父进程
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        tasks = [
+            loop.run_in_executor(
+                pool,
+                partial(
+                    preprocess_documents,
+                    data_path=data_path,
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                    split_type=split_type,
+                ),
+                shard,
+            )
+            for shard in shards
+        ]
+        results = await tqdm_asyncio.gather(*tasks, desc=f"预处理({num_workers}进程)")
+    nodes = [node for shard_nodes in results for node in shard_nodes]
+    if split_type == 0:
+        link_adjacent_nodes(nodes)
+    return nodes
 
 
 async def build_vector_store(
@@ -158,6 +325,15 @@ async def build_vector_store(
         reindex: bool = False,
         collection_name: str = "aiops24",
         vector_size: int = 3584,
+        quantization: str = "",
+        oversampling: float = 3.0,
+        hnsw_m: int = 16,
+        hnsw_ef_construct: int = 100,
+        hnsw_on_disk: bool = False,
+        vectors_on_disk: bool = False,
+        hnsw_ef: int = None,
+        payload_index_keys: tuple = ("dir", "file_path"),
+        sparse_vectors: bool = False,
 ) -> tuple[AsyncQdrantClient, QdrantVectorStore]:
     if qdrant_url:
         client = AsyncQdrantClient(
@@ -174,21 +350,333 @@ async def build_vector_store(
         except UnexpectedResponse as e:
             print(f"Collection not found: {e}")
 
+    quantization_config = build_quantization_config(quantization)
+    hnsw_config = models.HnswConfigDiff(m=hnsw_m, ef_construct=hnsw_ef_construct, on_disk=hnsw_on_disk)
+    # 量化时原始向量只用于重打分，总是放在磁盘上
+    vectors_on_disk = vectors_on_disk or quantization_config is not None
+    # BM25稀疏向量，idf由qdrant按集合统计
+    sparse_vectors_config = None
+    if sparse_vectors:
+        sparse_vectors_config = {SPARSE_VECTOR_NAME: models.SparseVectorParams(modifier=models.Modifier.IDF)}
+    create_collection = partial(
+        client.create_collection,
+        collection_name=collection_name,
+        vectors_config=models.VectorParams(
+            size=vector_size, distance=models.Distance.COSINE, on_disk=vectors_on_disk,
+        ),
+        hnsw_config=hnsw_config,
+        quantization_config=quantization_config,
+        sparse_vectors_config=sparse_vectors_config,
+    )
     try:
-        await client.create_collection(
-            collection_name=collection_name,
-            vectors_config=models.VectorParams(
-                size=vector_size, distance=models.Distance.COSINE
-            ),
-        )
+        await create_collection()
     except Exception as e:
         print("集合已存在")
-    return client, QdrantVectorStore(
+        if await update_collection_config(client, collection_name, hnsw_config, vectors_on_disk,
+                                          quantization_config, sparse_vectors_config):
+            print("集合缺少稀疏向量，删除后重建")
+            await client.delete_collection(collection_name)
+            await create_collection()
+    if qdrant_url:
+        # 过滤字段建立keyword索引，带过滤的检索不随集合增大而变慢；本地模式不支持payload索引
+        for key in payload_index_keys:
+            await client.create_payload_index(
+                collection_name=collection_name,
+                field_name=key,
+                field_schema=models.PayloadSchemaType.KEYWORD,
+            )
+    return client, SearchParamsQdrantVectorStore(
         aclient=client,
         collection_name=collection_name,
         parallel=4,
         batch_size=32,
+        search_params=build_search_params(quantization, oversampling, hnsw_ef),
+    )
+
+
+async def update_collection_config(
+        client: AsyncQdrantClient,
+        collection_name: str,
+        hnsw_config: models.HnswConfigDiff,
+        vectors_on_disk: bool,
+        quantization_config=None,
+        sparse_vectors_config: dict = None,
+):
+    # 已有集合只更新与配置不同的部分，无需重新写入向量；修改HNSW参数会触发qdrant后台重建索引
+    # 返回True表示集合需要重建：已写入的点没有稀疏向量，只补充稀疏向量配置会让稀疏检索查不到任何结果
+    config = (await client.get_collection(collection_name)).config
+    if sparse_vectors_config and SPARSE_VECTOR_NAME not in (config.params.sparse_vectors or {}):
+        return True
+    update = dict()
+    current_hnsw = config.hnsw_config
+    if (current_hnsw.m, current_hnsw.ef_construct, bool(current_hnsw.on_disk)) != \
+            (hnsw_config.m, hnsw_config.ef_construct, hnsw_config.on_disk):
+        update["hnsw_config"] = hnsw_config
+    vectors = config.params.vectors
+    if isinstance(vectors, models.VectorParams) and bool(vectors.on_disk) != vectors_on_disk:
+        update["vectors_config"] = {"": models.VectorParamsDiff(on_disk=vectors_on_disk)}
+    if quantization_config is None:
+        # 关闭量化时需要显式禁用，不传该参数会保留集合原有的量化配置
+        if config.quantization_config is not None:
+            update["quantization_config"] = models.Disabled.DISABLED
+    elif config.quantization_config != quantization_config:
+        update["quantization_config"] = quantization_config
+    if update:
+        await client.update_collection(collection_name=collection_name, **update)
+    return False
+
+
+async def update_vector_store(
+        client: AsyncQdrantClient,
+        vector_store: QdrantVectorStore,
+        embed_model: BaseEmbedding,
+        nodes: list[BaseNode],
+        collection_name: str,
+        manifest_file: str = "",
+        data_path: str = "",
+        config: dict = None,
+        checkpoint_file: str = "",
+        upload_batch_size: int = 64,
+        upload_parallel: int = 4,
+        sparse_encoder: BM25SparseEncoder = None,
+        sparse_embed_type: int = 0,
+):
+    """
+    让qdrant集合与节点保持一致。manifest_file 记录集合中各文件的内容哈希，
+    有清单时只删除修改和删除的文件对应的点，并只对新增和修改的文件重新编码。
+    checkpoint_file 记录未完成的写入计划和已确认的批次，进程中断后重新启动时跳过已写入的批次继续写入。
+    """
+    manifest = load_manifest(manifest_file) if manifest_file else None
+    checkpoint = load_manifest(checkpoint_file) if checkpoint_file else None
+    if checkpoint is not None and checkpoint["config"] != config:
+        checkpoint = None
+    collection_info = await client.get_collection(
+        collection_name=collection_name,
     )
+    files = scan_data_files(data_path) if manifest_file else None
+    if checkpoint is not None and collection_info.points_count == 0:
+        # 集合被清空或重建，断点记录的已写入批次不再存在
+        checkpoint = None
+    if manifest is not None and (manifest["config"] != config or collection_info.points_count == 0):
+        # 编码配置变化或集合被清空，清单失效
+        manifest = None
+    delete_files = []
+    if manifest is None:
+        if collection_info.points_count > 0 and checkpoint is None:
+            # 没有清单的已有集合，沿用之前的做法认为其与语料一致
+            upsert_nodes = []
+        else:
+            upsert_nodes = nodes
+    else:
+        added, changed, deleted = diff_files(manifest["files"], files)
+        print(f"向量库增量更新：新增{len(added)}个文件，修改{len(changed)}个文件，删除{len(deleted)}个文件")
+        delete_files = changed + deleted
+        upsert_files = set(added + changed)
+        upsert_nodes = [node for node in nodes if node.metadata["file_path"] in upsert_files]
+
+    if sparse_encoder is not None and sparse_encoder.avgdl is None:
+        # 平均文档长度在写入任何文档之前按全部节点统计，与写入的分批方式无关
+        await asyncio.get_running_loop().run_in_executor(
+            None, sparse_encoder.fit, [get_node_content(node, sparse_embed_type) for node in nodes])
+    plan = upload_plan(upsert_nodes, delete_files, upload_batch_size)
+    done_batches = []
+    if checkpoint is not None and checkpoint["plan"] == plan:
+        # 上次写入中断，删除已执行过，只补写未确认的批次
+        done_batches = checkpoint["done"]
+        print(f"从断点继续写入向量库：已完成{len(done_batches)}个批次")
+    else:
+        if checkpoint is not None and manifest is None:
+            # 中断前后语料发生变化，集合中的内容无法确定，清空后重写
+            await client.delete(
+                collection_name=collection_name,
+                points_selector=models.FilterSelector(filter=models.Filter()),
+            )
+        if delete_files:
+            await client.delete(
+                collection_name=collection_name,
+                points_selector=models.FilterSelector(filter=build_qdrant_file_filters(delete_files)),
+            )
+
+    if len(upsert_nodes) > 0:
+        full_build = len(upsert_nodes) == len(nodes)
+        if full_build:
+            # 暂时停止实时索引
+            await client.update_collection(
+                collection_name=collection_name,
+                optimizer_config=models.OptimizersConfigDiff(indexing_threshold=0),
+            )
+        await upsert_nodes_with_embeddings(
+            client, vector_store, embed_model, upsert_nodes, collection_name,
+            upload_batch_size=upload_batch_size,
+            upload_parallel=upload_parallel,
+            done_batches=done_batches,
+            checkpoint_file=checkpoint_file,
+            checkpoint={"config": config, "plan": plan},
+            sparse_encoder=sparse_encoder,
+            sparse_embed_type=sparse_embed_type,
+        )
+        if full_build:
+            # 恢复实时索引
+            await client.update_collection(
+                collection_name=collection_name,
+                optimizer_config=models.OptimizersConfigDiff(indexing_threshold=20000),
+            )
+        print(f"向量库写入完成，一共写入{len(upsert_nodes)}个节点")
+    if manifest_file:
+        save_manifest(manifest_file, {"config": config, "files": files})
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+
+async def build_local_vector_store(
+        persist_dir: str,
+        embed_model: BaseEmbedding,
+        nodes: list[BaseNode],
+        reindex: bool = False,
+        config: dict = None,
+        ivf_threshold: int = 20000,
+        nprobe: int = 8,
+        quantization: str = "",
+        oversampling: float = 3.0,
+) -> LocalVectorStore:
+    """加载内置向量索引，节点或编码配置变化时整体重建；文档向量来自嵌入缓存，重建只为新文本计算向量"""
+    if not reindex:
+        try:
+            vector_store = LocalVectorStore(persist_dir, nodes, nprobe=nprobe,
+                                            quantization=quantization, oversampling=oversampling)
+            if vector_store.meta["config"] == config:
+                return vector_store
+        except (FileNotFoundError, ValueError) as e:
+            print(f"内置向量索引需要重建: {e}")
+    loop = asyncio.get_event_loop()
+    block_size = max(getattr(embed_model, "embed_batch_size", 64), 64)
+    vector_store = await loop.run_in_executor(None, partial(
+        LocalVectorStore.build, persist_dir, nodes, partial(embed_nodes, embed_model),
+        config=config, ivf_threshold=ivf_threshold, block_size=block_size, nprobe=nprobe,
+        quantization=quantization, oversampling=oversampling,
+    ))
+    print(f"内置向量索引写入完成，一共写入{len(nodes)}个节点")
+    return vector_store
+
+
+def embed_nodes(embed_model: BaseEmbedding, nodes: list[BaseNode]) -> np.ndarray:
+    if hasattr(embed_model, "embed_nodes"):
+        return embed_model.embed_nodes(nodes)
+    # 其他嵌入模型仍按llama_index的方式写入 node.embedding，取出后立即释放
+    embed_model(nodes)
+    embeddings = np.asarray([node.embedding for node in nodes], dtype=np.float32)
+    for node in nodes:
+        node.embedding = None
+    return embeddings
+
+
+def point_ids(nodes: list[BaseNode]) -> list[str]:
+    """
+    由文件、文本及其在文件中第几次出现确定的点id，重复写入同一个节点总是覆盖同一个点。
+    同一文件的节点总是一起写入，出现次数与只写入部分文件时一致。
+    """
+    seen = Counter()
+    ids = []
+    for node in nodes:
+        key = f"{node.metadata.get('file_path', '')}\x00{node.get_content()}"
+        ids.append(str(uuid.uuid5(POINT_ID_NAMESPACE, f"{key}\x00{seen[key]}")))
+        seen[key] += 1
+    return ids
+
+
+def upload_plan(nodes: list[BaseNode], delete_files: list[str], upload_batch_size: int) -> str:
+    # 写入计划的指纹：待删除的文件、待写入的点及其分批方式都相同时才能从断点继续
+    digest = hashlib.sha1(f"{upload_batch_size}\x00{sorted(delete_files)}".encode("utf-8"))
+    for node_id in point_ids(nodes):
+        digest.update(node_id.encode("utf-8"))
+    return digest.hexdigest()
+
+
+async def upsert_nodes_with_embeddings(
+        client: AsyncQdrantClient,
+        vector_store: QdrantVectorStore,
+        embed_model: BaseEmbedding,
+        nodes: list[BaseNode],
+        collection_name: str,
+        upload_batch_size: int = 64,
+        upload_parallel: int = 4,
+        done_batches: list[int] = None,
+        checkpoint_file: str = "",
+        checkpoint: dict = None,
+        sparse_encoder: BM25SparseEncoder = None,
+        sparse_embed_type: int = 0,
+):
+    """
+    按固定大小的批次写入，第 i 批总是 nodes[i*upload_batch_size: (i+1)*upload_batch_size]。
+    按 embed_batch_size 分块编码，每块向量是一个连续的 float32 数组，直接按行切片上传，
+    最多 upload_parallel 个批次同时上传，上传期间继续编码下一块。每个批次被qdrant确认后记录到 checkpoint_file，
+    已记录的批次不再编码和上传。payload 与 QdrantVectorStore 写入的格式一致。
+    提供 sparse_encoder 时同时写入BM25稀疏向量。
+    """
+    loop = asyncio.get_event_loop()
+    done = set(done_batches or [])
+    embed_batch_size = getattr(embed_model, "embed_batch_size", upload_batch_size)
+    batches_per_block = max(1, -(-embed_batch_size // upload_batch_size))
+    block_size = batches_per_block * upload_batch_size
+    ids = point_ids(nodes)
+    if checkpoint_file:
+        save_manifest(checkpoint_file, {**checkpoint, "done": sorted(done)})
+
+    async def upload(batch_idx, batch, embeddings, sparse):
+        vectors = embeddings.tolist()
+        if sparse is not None:
+            vectors = {
+                "": vectors,
+                SPARSE_VECTOR_NAME: [models.SparseVector(indices=indices, values=values) for indices, values in sparse],
+            }
+        await client.upsert(
+            collection_name=collection_name,
+            points=models.Batch(
+                ids=ids[batch_idx * upload_batch_size:(batch_idx + 1) * upload_batch_size],
+                vectors=vectors,
+                payloads=[node_to_metadata_dict(node, remove_text=False, flat_metadata=vector_store.flat_metadata)
+                          for node in batch],
+            ),
+            wait=True,
+        )
+        done.add(batch_idx)
+        if checkpoint_file:
+            save_manifest(checkpoint_file, {**checkpoint, "done": sorted(done)})
+
+    pending = set()
+    try:
+        for start in tqdm(range(0, len(nodes), block_size), desc="写入向量库"):
+            batch_ids = [start // upload_batch_size + i for i in range(batches_per_block)
+                         if start + i * upload_batch_size < len(nodes)]
+            todo = [batch_idx for batch_idx in batch_ids if batch_idx not in done]
+            if not todo:
+                continue
+            # 只编码未写入的批次
+            block = [node for batch_idx in todo
+                     for node in nodes[batch_idx * upload_batch_size:(batch_idx + 1) * upload_batch_size]]
+            embeddings = await loop.run_in_executor(None, embed_nodes, embed_model, block)
+            sparse = None
+            if sparse_encoder is not None:
+                sparse = await loop.run_in_executor(None, sparse_encoder.encode_documents,
+                                                    [get_node_content(node, sparse_embed_type) for node in block])
+            offset = 0
+            for batch_idx in todo:
+                batch = nodes[batch_idx * upload_batch_size:(batch_idx + 1) * upload_batch_size]
+                while len(pending) >= upload_parallel:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished:
+                        task.result()
+                pending.add(asyncio.ensure_future(upload(
+                    batch_idx, batch, embeddings[offset:offset + len(batch)],
+                    sparse[offset:offset + len(batch)] if sparse is not None else None,
+                )))
+                offset += len(batch)
+            del embeddings
+        await asyncio.gather(*pending)
+    finally:
+        # 出错时等待已发出的批次结束，保证断点记录与集合一致
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
 
 
 def build_filters(dir):
@@ -204,6 +692,18 @@ def build_filters(dir):
     return filters
 
 
+def build_qdrant_file_filters(file_paths: list[str]):
+    filters = Filter(
+        must=[
+            FieldCondition(
+                key="file_path",
+                match=MatchAny(any=file_paths),
+            )
+        ]
+    )
+    return filters
+
+
 def build_qdrant_filters(dir):
     filters = Filter(
         must=[
@@ -1,7 +1,9 @@
 import os
 os.environ['NLTK_DATA'] = './data/nltk_data/'
 import random
+import shutil
 import asyncio
+from functools import partial
 import nest_asyncio
 import torch
 from llama_index.core.retrievers import AutoMergingRetriever
@@ -10,17 +12,26 @@ from llama_index.core.indices.query.query_transform import HyDEQueryTransform
 from llama_index.core.query_engine import TransformQueryEngine
 from llama_index.legacy.llms import OpenAILike as OpenAI
 from qdrant_client import models
+from tqdm import tqdm
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from ..custom.embeddings import GTEEmbedding, HuggingFaceEmbedding
+from ..custom.embeddings.projection import load_or_fit_projection
+from ..custom.embeddings.cache import QueryEmbeddingCache
 from llama_index.core import Settings, StorageContext, QueryBundle, PromptTemplate
-from .ingestion import read_data, build_pipeline, build_preprocess_pipeline, build_vector_store, build_qdrant_filters
-from ..custom.rerankers import SentenceTransformerRerank, LLMRerank
-from ..custom.retrievers import QdrantRetriever, BM25Retriever, HybridRetriever
+from llama_index.core.schema import NodeWithScore
+from .ingestion import build_nodes, build_vector_store, update_vector_store, build_qdrant_filters, \
+    build_local_vector_store
+from ..custom.rerankers import SentenceTransformerRerank, LLMRerank, get_retrieval_score
+from ..custom.retrievers import QdrantRetriever, QdrantHybridRetriever, BM25Retriever, HybridRetriever, \
+    tokenize_and_remove_stopwords
+from ..custom.bm25 import BM25SparseEncoder, QueryAnalyzer
 from ..custom.hierarchical import get_leaf_nodes
 from ..custom.template import QA_TEMPLATE, MERGE_TEMPLATE
 from ..custom.compressors import ContextCompressor
 from .ingestion import get_node_content as _get_node_content
+from .snapshot import load_manifest, snapshot_key
+from .context import RequestContext, record_stage, request_context
 from ..utils.llm_utils import local_llm_generate as _local_llm_generate
 from .rag import generation as _generation
 
@@ -94,6 +105,7 @@ class EasyRAGPipeline:
 
         # 初始化Embedding模型
         retrieval_type = config['retrieval_type']
+        self.retrieval_type = retrieval_type
         embedding_name = config['embedding_name']
         f_embed_type_1 = config['f_embed_type_1']
         hfmodel_cache_folder = config['hfmodel_cache_folder']
@@ -102,80 +114,165 @@ class EasyRAGPipeline:
                     or "Zhihui" in embedding_name:
                 embedding = GTEEmbedding(
                     model_name=embedding_name,
-                    embed_batch_size=128,
+                    embed_batch_size=config.get('embed_batch_size', 128),
+                    max_tokens=config.get('embed_max_tokens', 16384),
+                    embed_cache_path=config.get('embed_cache_path', ""),
                     embed_type=f_embed_type_1,
+                    query_batch_size=config.get('query_batch_size', 16),
+                    query_batch_wait_ms=config.get('query_batch_wait_ms', 5),
                 )
             else:
                 embedding = HuggingFaceEmbedding(
                     model_name=embedding_name,
                     cache_folder=hfmodel_cache_folder,
-                    embed_batch_size=128,
+                    embed_batch_size=config.get('embed_batch_size', 128),
+                    max_tokens=config.get('embed_max_tokens', 16384),
+                    embed_cache_path=config.get('embed_cache_path', ""),
                     embed_type=f_embed_type_1,
+                    query_batch_size=config.get('query_batch_size', 16),
+                    query_batch_wait_ms=config.get('query_batch_wait_ms', 5),
                     # query_instruction="为这个句子生成表示以用于检索相关文章：", # 默认已经加上了，所以加不加无所谓
                 )
         else:
             embedding = None
         Settings.embed_model = embedding
 
+        self.stp_words = load_stopwords("./data/hit_stopwords.txt")
+        import jieba
+        self.sparse_tk = jieba.Tokenizer()
+        # 稀疏检索、路径检索、qdrant稀疏向量和上下文压缩共用的查询分析器，同一问题只分词一次
+        self.query_analyzer = QueryAnalyzer(
+            partial(tokenize_and_remove_stopwords, self.sparse_tk, stopwords=self.stp_words),
+            cache_size=config.get('query_cache_size', 1024),
+        )
+
         # 文档预处理成节点
         data_path = os.path.abspath(config['data_path'])
         chunk_size = config['chunk_size']
         chunk_overlap = config['chunk_overlap']
-        data = read_data(data_path)
-        print(f"文档读入完成，一共有{len(data)}个文档")
+        split_type = config['split_type']
+        snapshot_path = config.get('snapshot_path', "")
+        num_workers = config.get('num_workers', 1)
+        nodes_ = await build_nodes(data_path, chunk_size, chunk_overlap, split_type, snapshot_path, num_workers)
         vector_store = None
+        self.sparse_encoder = None
+        # 查询向量缓存的键包含模型名和投影，投影重新拟合后旧的缓存向量不会被命中
+        query_embed_key = embedding_name
         if retrieval_type != 2:
             collection_name = config['collection_name']
-            # 初始化 数据ingestion pipeline 和 vector store
-            client, vector_store = await build_vector_store(
-                qdrant_url=config['qdrant_url'],
-                cache_path=config['cache_path'],
-                reindex=config['reindex'],
-                collection_name=collection_name,
-                vector_size=config['vector_size'],
-            )
-
-            collection_info = await client.get_collection(
-                collection_name=collection_name,
-            )
-            if collection_info.points_count == 0:
-                pipeline = build_pipeline(
-                    self.llm, embedding, vector_store=vector_store, data_path=data_path,
-                    chunk_size=chunk_size,
-                    chunk_overlap=chunk_overlap,
+            # 密集检索始终使用句子切分的节点
+            if split_type == 0:
+                dense_nodes = nodes_
+            else:
+                dense_nodes = await build_nodes(data_path, chunk_size, chunk_overlap, 0, snapshot_path, num_workers)
+            manifest_file = ""
+            dense_config = None
+            reindex = False
+            projection_dim = config.get('projection_dim', 0)
+            # 混合检索时把BM25稀疏向量写入qdrant，由qdrant一次完成两路检索和融合
+            hybrid_native = retrieval_type == 3 and config.get('hybrid_native', False)
+            if hybrid_native and config.get('vector_store', "qdrant") != "qdrant":
+                raise ValueError("hybrid_native requires the qdrant vector store.")
+            if snapshot_path:
+                manifest_file = os.path.join(snapshot_path, f"qdrant_{collection_name}.json")
+                dense_config = {
+                    "embedding_name": embedding_name,
+                    "embed_type": f_embed_type_1,
+                    "data_path": data_path,
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": chunk_overlap,
+                    "projection_dim": projection_dim,
+                    "sparse_vectors": hybrid_native,
+                    "sparse_embed_type": config['f_embed_type_2'],
+                }
+                manifest = load_manifest(manifest_file)
+                # 编码或切分配置变化时需要重建集合
+                reindex = manifest is not None and manifest["config"] != dense_config
+            checkpoint_file = os.path.join(snapshot_path or config['cache_path'],
+                                           f"qdrant_{collection_name}.checkpoint.json")
+            checkpoint = load_manifest(checkpoint_file)
+            if reindex and checkpoint is not None and checkpoint["config"] == dense_config:
+                # 按新配置重建集合时写入中断，集合已经重建，不再重建，从断点继续
+                reindex = False
+            # 显式要求重建时总是重建
+            reindex = reindex or config['reindex']
+            if projection_dim:
+                # 降维投影与集合一起保存，重新拟合后已写入的向量失效，需要重建集合
+                projection, fitted = load_or_fit_projection(
+                    os.path.join(config['cache_path'], f"projection_{collection_name}.npz"),
+                    projection_dim, dense_nodes, embedding.embed_nodes, refit=reindex,
                 )
-                # 暂时停止实时索引
-                await client.update_collection(
-                    collection_name=collection_name,
-                    optimizer_config=models.OptimizersConfigDiff(indexing_threshold=0),
+                embedding.set_projection(projection)
+                query_embed_key = f"{embedding_name}/pca-{projection.fingerprint()}"
+                reindex = reindex or fitted
+            if reindex and checkpoint is not None:
+                # 集合将被重建，之前的写入断点失效
+                os.remove(checkpoint_file)
+            if config.get('vector_store', "qdrant") == "local":
+                # 内置向量索引，与节点和编码配置一起校验，不一致时重建
+                vector_store = await build_local_vector_store(
+                    os.path.join(config['cache_path'], f"local_{collection_name}"),
+                    embedding, dense_nodes,
+                    reindex=reindex,
+                    config=dense_config,
+                    ivf_threshold=config.get('ivf_threshold', 20000),
+                    nprobe=config.get('ivf_nprobe', 8),
+                    quantization=config.get('quantization', ""),
+                    oversampling=config.get('quantization_oversampling', 3.0),
                 )
-                nodes = await pipeline.arun(documents=data, show_progress=True, num_workers=1)
-                # 恢复实时索引
-                await client.update_collection(
+            else:
+                # 初始化 数据ingestion pipeline 和 vector store
+                client, vector_store = await build_vector_store(
+                    qdrant_url=config['qdrant_url'],
+                    cache_path=config['cache_path'],
+                    reindex=reindex,
                     collection_name=collection_name,
-                    optimizer_config=models.OptimizersConfigDiff(indexing_threshold=20000),
+                    vector_size=projection_dim or config['vector_size'],
+                    quantization=config.get('quantization', ""),
+                    oversampling=config.get('quantization_oversampling', 3.0),
+                    hnsw_m=config.get('hnsw_m', 16),
+                    hnsw_ef_construct=config.get('hnsw_ef_construct', 100),
+                    hnsw_on_disk=config.get('hnsw_on_disk', False),
+                    vectors_on_disk=config.get('vectors_on_disk', False),
+                    hnsw_ef=config.get('hnsw_ef', 0) or None,
+                    sparse_vectors=hybrid_native,
+                )
+                if hybrid_native:
+                    sparse_dir = os.path.join(snapshot_path or config['cache_path'], f"sparse_{collection_name}")
+                    if reindex and os.path.exists(sparse_dir):
+                        # 集合已重建，词表和平均文档长度随之重新统计
+                        shutil.rmtree(sparse_dir)
+                    self.sparse_encoder = BM25SparseEncoder(self.query_analyzer, save_dir=sparse_dir)
+                await update_vector_store(
+                    client, vector_store, embedding, dense_nodes, collection_name,
+                    manifest_file=manifest_file,
+                    data_path=data_path,
+                    config=dense_config,
+                    checkpoint_file=checkpoint_file,
+                    upload_batch_size=config.get('upload_batch_size', 64),
+                    upload_parallel=config.get('upload_parallel', 4),
+                    sparse_encoder=self.sparse_encoder,
+                    sparse_embed_type=config['f_embed_type_2'],
                 )
-                print(f"索引建立完成，一共有{len(nodes)}个节点")
-        split_type = config['split_type']
-        preprocess_pipeline = build_preprocess_pipeline(
-            data_path,
-            chunk_size,
-            chunk_overlap,
-            split_type,
-        )
-        nodes_ = await preprocess_pipeline.arun(documents=data, show_progress=True, num_workers=1)
         print(f"索引已建立，一共有{len(nodes_)}个节点")
 
         # 加载密集检索
+        self.query_cache = None
         if embedding is not None:
             f_topk_1 = config['f_topk_1']
-            self.dense_retriever = QdrantRetriever(vector_store, embedding, similarity_top_k=f_topk_1)
+            query_cache_size = config.get('query_embed_cache_size', 1024)
+            if query_cache_size > 0:
+                self.query_cache = QueryEmbeddingCache(
+                    query_embed_key,
+                    maxsize=query_cache_size,
+                    cache_path=config.get('query_embed_cache_path', ""),
+                    disk_min_hits=config.get('query_embed_disk_min_hits', 2),
+                )
+            self.dense_retriever = QdrantRetriever(vector_store, embedding, similarity_top_k=f_topk_1,
+                                                   query_cache=self.query_cache)
             print(f"创建{embedding_name}密集检索器成功")
 
         # 加载稀疏检索
-        self.stp_words = load_stopwords("./data/hit_stopwords.txt")
-        import jieba
-        self.sparse_tk = jieba.Tokenizer()
         if split_type == 1:
             self.nodes = get_leaf_nodes(nodes_)
             print("叶子节点数量:", len(self.nodes))
@@ -187,35 +284,40 @@ class EasyRAGPipeline:
         f_topk_2 = config['f_topk_2']
         f_embed_type_2 = config['f_embed_type_2']
         bm25_type = config['bm25_type']
-        self.sparse_retriever = BM25Retriever.from_defaults(
-            nodes=self.nodes,
-            tokenizer=self.sparse_tk,
-            similarity_top_k=f_topk_2,
-            stopwords=self.stp_words,
-            embed_type=f_embed_type_2,
-            bm25_type=bm25_type,
-        )
+        self.bm25_dir_prefix = ""
+        if snapshot_path:
+            key = snapshot_key(data_path, chunk_size, chunk_overlap, split_type)
+            self.bm25_dir_prefix = os.path.join(snapshot_path, f"bm25_{key}")
+        # qdrant原生混合检索已包含BM25稀疏一路，只有上下文压缩或精排后fusion仍需要内存中的BM25索引
+        if self.sparse_encoder is None or config['compress_method'] == "bm25_extract" \
+                or self.rerank_fusion_type != 0:
+            self.sparse_retriever = self.build_bm25_retriever(
+                similarity_top_k=f_topk_2,
+                embed_type=f_embed_type_2,
+                bm25_type=bm25_type,
+                shard_key=config.get('bm25_shard_key', "") or None,
+            )
+        else:
+            self.sparse_retriever = None
 
         f_topk_3 = config['f_topk_3']
         if f_topk_3 != 0:
-            self.path_retriever = BM25Retriever.from_defaults(
-                nodes=self.nodes,
-                tokenizer=self.sparse_tk,
+            self.path_retriever = self.build_bm25_retriever(
                 similarity_top_k=f_topk_3,
-                stopwords=self.stp_words,
                 embed_type=5,  # 4-->file_path 5-->know_path
                 bm25_type=bm25_type,
             )
         else:
             self.path_retriever = None
 
-        if split_type == 1:
+        if split_type == 1 and self.sparse_retriever is not None:
             self.sparse_retriever = AutoMergingRetriever(
                 self.sparse_retriever,
                 storage_context,
                 simple_ratio_thresh=0.4,
             )
-        print("创建BM25稀疏检索器成功")
+        if self.sparse_retriever is not None:
+            print("创建BM25稀疏检索器成功")
 
         # 创建node快速索引
         self.nodeid2idx = dict()
@@ -227,6 +329,15 @@ class EasyRAGPipeline:
             self.retriever = self.dense_retriever
         elif retrieval_type == 2:
             self.retriever = self.sparse_retriever
+        elif retrieval_type == 3 and self.sparse_encoder is not None:
+            self.retriever = QdrantHybridRetriever(
+                vector_store, embedding, self.sparse_encoder,
+                similarity_top_k=config['f_topk'],
+                dense_top_k=config['f_topk_1'],
+                sparse_top_k=config['f_topk_2'],
+                query_cache=self.query_cache,
+            )
+            print("创建qdrant原生混合检索器成功")
         elif retrieval_type == 3:
             f_topk = config['f_topk']
             self.retriever = HybridRetriever(
@@ -258,6 +369,8 @@ class EasyRAGPipeline:
                 embed_bs=r_embed_bs,  # 控制重排器批大小，减小显存占用
                 embed_type=r_embed_type,
                 use_efficient=r_use_efficient,
+                max_tokens=config.get('r_max_tokens', 0),
+                batch_wait_ms=config.get('r_batch_wait_ms', 2.0),
             )
             print(f"创建{reranker_name}LLM重排器成功")
 
@@ -291,6 +404,50 @@ class EasyRAGPipeline:
 
         print("EasyRAGPipeline 初始化完成".center(60, "="))
 
+    def build_bm25_retriever(self, similarity_top_k, embed_type, bm25_type, shard_key=None):
+        save_dir = ""
+        if self.bm25_dir_prefix:
+            save_dir = f"{self.bm25_dir_prefix}_e{embed_type}_t{bm25_type}"
+            try:
+                retriever = BM25Retriever.load(
+                    save_dir,
+                    nodes=self.nodes,
+                    tokenizer=self.sparse_tk,
+                    similarity_top_k=similarity_top_k,
+                    stopwords=self.stp_words,
+                    mmap=True,
+                    update=True,
+                    shard_key=shard_key,
+                )
+                print(f"从{save_dir}加载BM25索引")
+                retriever.analyzer = self.query_analyzer
+                return retriever
+            except (FileNotFoundError, ValueError) as e:
+                print(f"重新构建BM25索引: {e}")
+        retriever = BM25Retriever.from_defaults(
+            nodes=self.nodes,
+            tokenizer=self.sparse_tk,
+            similarity_top_k=similarity_top_k,
+            stopwords=self.stp_words,
+            embed_type=embed_type,
+            bm25_type=bm25_type,
+            shard_key=None if save_dir else shard_key,
+        )
+        if save_dir:
+            retriever.save(save_dir)
+            # 重新以内存映射方式加载，索引和分片不在进程内另存一份
+            retriever = BM25Retriever.load(
+                save_dir,
+                nodes=self.nodes,
+                tokenizer=self.sparse_tk,
+                similarity_top_k=similarity_top_k,
+                stopwords=self.stp_words,
+                mmap=True,
+                shard_key=shard_key,
+            )
+        retriever.analyzer = self.query_analyzer
+        return retriever
+
     def build_query_bundle(self, query_str):
         query_bundle = QueryBundle(query_str=query_str)
         return query_bundle
@@ -311,6 +468,11 @@ class EasyRAGPipeline:
             }
         return filters, filter_dict
 
+    def build_request_context(self, query) -> RequestContext:
+        # 每个请求独立的检索状态，检索器和精排模型本身不保存请求相关的状态
+        filters, filter_dict = self.build_filters(query)
+        return RequestContext(filters=filters, filter_dict=filter_dict, hnsw_ef=query.get("hnsw_ef") or None)
+
     async def generation(self, llm, fmt_qa_prompt):
         return await _generation(llm, fmt_qa_prompt)
 
@@ -324,38 +486,80 @@ class EasyRAGPipeline:
         '''
         "query":"问题" #必填
         "document": "所属路径" #用于过滤文档，可选
+        "hnsw_ef": 128 #密集检索的HNSW候选数，越大越准越慢，可选
         '''
         if self.hyde:
             hyde_query = self.hyde_transform(query["query"])
             query["hyde_query"] = hyde_query.custom_embedding_strs[0]
-        self.filters, self.filter_dict = self.build_filters(query)
-        if self.rerank_fusion_type == 0:
-            self.retriever.filters = self.filters
-            self.retriever.filter_dict = self.filter_dict
-            res = await self.generation_with_knowledge_retrieval(
-                query_str=query["query"],
-                hyde_query=query.get("hyde_query", "")
-            )
-        else:
-            self.dense_retriever.filters = self.filters
-            self.sparse_retriever.filter_dict = self.filter_dict
-            res = await self.generation_with_rerank_fusion(
-                query_str=query["query"],
-            )
+        with request_context(self.build_request_context(query)) as context:
+            if self.rerank_fusion_type == 0:
+                res = await self.generation_with_knowledge_retrieval(
+                    query_str=query["query"],
+                    hyde_query=query.get("hyde_query", "")
+                )
+            else:
+                res = await self.generation_with_rerank_fusion(
+                    query_str=query["query"],
+                )
+        # 各阶段(粗排、精排)的节点，便于分析检索和精排各自的效果
+        res["stages"] = context.stages
         return res
 
+    async def run_batch(self, queries: list[dict]) -> list[dict]:
+        '''
+        批量运行：BM25稀疏检索对整批问题一次打分，精排和生成仍逐条进行，结果与逐条调用 run 一致
+        '''
+        if self.rerank_fusion_type != 0 or self.retrieval_type == 3 \
+                or not isinstance(self.sparse_retriever, BM25Retriever):
+            return [await self.run(query) for query in tqdm(queries, total=len(queries))]
+        for query in queries:
+            if self.hyde:
+                hyde_query = self.hyde_transform(query["query"])
+                query["hyde_query"] = hyde_query.custom_embedding_strs[0]
+        query_bundles = [self.build_query_bundle(query["query"] + query.get("hyde_query", "")) for query in queries]
+        contexts = [self.build_request_context(query) for query in queries]
+        filter_dicts = [context.filter_dict for context in contexts]
+        sparse_nodes = self.sparse_retriever.retrieve_batch(query_bundles, filter_dicts)
+        if self.path_retriever is not None:
+            path_nodes = self.path_retriever.retrieve_batch(query_bundles, filter_dicts)
+        else:
+            path_nodes = [[] for _ in queries]
+        results = []
+        for i, query in enumerate(tqdm(queries, total=len(queries))):
+            with request_context(contexts[i]):
+                res = await self.generation_with_knowledge_retrieval(
+                    query_str=query["query"],
+                    hyde_query=query.get("hyde_query", ""),
+                    sparse_nodes=sparse_nodes[i],
+                    path_nodes=path_nodes[i],
+                )
+            res["stages"] = contexts[i].stages
+            results.append(res)
+        return results
+
     def sort_by_retrieval(self, nodes):
-        new_nodes = sorted(nodes, key=lambda x: -x.node.metadata['retrieval_score'] if x.score else 0)
+        new_nodes = sorted(nodes, key=lambda x: -get_retrieval_score(x) if x.score else 0)
         return new_nodes
 
     async def generation_with_knowledge_retrieval(
             self,
             query_str: str,
-            hyde_query: str=""
+            hyde_query: str="",
+            sparse_nodes=None,
+            path_nodes=None,
     ):
         query_bundle = self.build_query_bundle(query_str+hyde_query)
-        node_with_scores = await self.sparse_retriever.aretrieve(query_bundle)
-        if self.path_retriever is not None:
+        # sparse_nodes/path_nodes 为 run_batch 预先批量检索的结果
+        if sparse_nodes is not None:
+            node_with_scores = sparse_nodes
+        elif self.retrieval_type == 3:
+            # 混合检索：稠密、稀疏两路倒数排序融合，hybrid_native 时由qdrant一次请求完成，否则在进程内融合
+            node_with_scores = await self.retriever.aretrieve(query_bundle)
+        else:
+            node_with_scores = await self.sparse_retriever.aretrieve(query_bundle)
+        if path_nodes is not None:
+            node_with_scores_path = path_nodes
+        elif self.path_retriever is not None:
             node_with_scores_path = await self.path_retriever.aretrieve(query_bundle)
         else:
             node_with_scores_path = []
@@ -363,6 +567,8 @@ class EasyRAGPipeline:
             node_with_scores,
             node_with_scores_path,
         ])
+        # 精排会原地改写节点分数，粗排阶段记录副本
+        record_stage("retrieve", [NodeWithScore(node=node.node, score=node.score) for node in node_with_scores])
         if self.reranker:
             if self.hyde_merging and self.hyde:
                 hyde_query_top1_chunk = f'问题：{query_str},\n 可能有用的提示文档:{hyde_query},\n ' \
@@ -370,7 +576,12 @@ class EasyRAGPipeline:
                 hyde_merging_query_bundle = self.hyde_transform_merging(hyde_query_top1_chunk)
                 query_bundle = self.build_query_bundle(query_str + "\n" + hyde_merging_query_bundle.custom_embedding_strs[0])
 
-            node_with_scores = self.reranker.postprocess_nodes(node_with_scores, query_bundle)
+            if isinstance(self.reranker, LLMRerank):
+                # 与其他并发请求的候选对合并成批计算
+                node_with_scores = await self.reranker.apostprocess_nodes(node_with_scores, query_bundle)
+            else:
+                node_with_scores = self.reranker.postprocess_nodes(node_with_scores, query_bundle)
+            record_stage("rerank", node_with_scores)
         contents = [self.get_node_content(node=node) for node in node_with_scores]
         context_str = "\n\n".join(
             [f"### 文档{i}: {content}" for i, content in enumerate(contents)]
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import pickle
+from typing import Optional
+
+from llama_index.core.schema import BaseNode
+
+# 快照格式版本，节点结构或预处理逻辑变化时需要递增
+SNAPSHOT_VERSION = 1
+# 预处理时会读取的路径映射和图片映射文件
+MAP_FILES = ["pathmap.json", "imgmap_filtered.json"]
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_data_files(data_path: str, required_exts=(".txt",)) -> dict[str, str]:
+    # 与 read_data 保持一致：递归读取指定后缀文件，跳过隐藏文件和目录，按路径逐级排序
+    paths = []
+    for root, dirs, names in os.walk(data_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in names:
+            if name.startswith(".") or not name.endswith(tuple(required_exts)):
+                continue
+            paths.append(os.path.relpath(os.path.join(root, name), data_path))
+    paths.sort(key=lambda path: path.split(os.sep))
+    return {path: hash_file(os.path.join(data_path, path)) for path in paths}
+
+
+def diff_files(old: dict[str, str], new: dict[str, str]) -> tuple[list[str], list[str], list[str]]:
+    added = [path for path in new if path not in old]
+    changed = [path for path in new if path in old and old[path] != new[path]]
+    deleted = [path for path in old if path not in new]
+    return added, changed, deleted
+
+
+def load_manifest(manifest_file: str) -> Optional[dict]:
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        return json.loads(f.read())
+
+
+def save_manifest(manifest_file: str, manifest: dict):
+    os.makedirs(os.path.dirname(manifest_file) or ".", exist_ok=True)
+    with open(manifest_file + ".tmp", "w") as f:
+        f.write(json.dumps(manifest, ensure_ascii=False))
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def scan_map_files(data_path: str) -> dict[str, str]:
+    maps = dict()
+    for name in MAP_FILES:
+        path = os.path.join(data_path, name)
+        maps[name] = hash_file(path) if os.path.exists(path) else ""
+    return maps
+
+
+def snapshot_key(
+        data_path: str,
+        chunk_size: int,
+        chunk_overlap: int,
+        split_type: int,
+) -> str:
+    # 快照文件名由预处理配置决定，语料内容在快照内部单独校验
+    key = json.dumps({
+        "version": SNAPSHOT_VERSION,
+        "data_path": os.path.abspath(data_path),
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "split_type": split_type,
+    }, sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def get_snapshot_file(snapshot_path, data_path, chunk_size, chunk_overlap, split_type) -> str:
+    key = snapshot_key(data_path, chunk_size, chunk_overlap, split_type)
+    return os.path.join(snapshot_path, f"nodes_{key}.pkl")
+
+
+def load_nodes_snapshot(
+        snapshot_path: str,
+        data_path: str,
+        chunk_size: int,
+        chunk_overlap: int,
+        split_type: int,
+) -> Optional[dict]:
+    """
+    返回 {"files": 各文件内容哈希, "nodes": 节点列表}。
+    路径映射和图片映射会影响所有节点的元数据，二者变化时快照整体失效；
+    单个文件的变化由调用方根据 files 做增量更新。
+    """
+    snapshot_file = get_snapshot_file(snapshot_path, data_path, chunk_size, chunk_overlap, split_type)
+    if not os.path.exists(snapshot_file):
+        return None
+    try:
+        with open(snapshot_file, "rb") as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        print(f"节点快照读取失败，重新预处理: {e}")
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    if snapshot["maps"] != scan_map_files(data_path):
+        print("路径映射或图片映射已变化，节点快照失效")
+        return None
+    return snapshot
+
+
+def save_nodes_snapshot(
+        snapshot_path: str,
+        data_path: str,
+        chunk_size: int,
+        chunk_overlap: int,
+        split_type: int,
+        nodes: list[BaseNode],
+        files: dict[str, str],
+) -> str:
+    os.makedirs(snapshot_path, exist_ok=True)
+    snapshot_file = get_snapshot_file(snapshot_path, data_path, chunk_size, chunk_overlap, split_type)
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "maps": scan_map_files(data_path),
+        "files": files,
+        "nodes": list(nodes),
+    }
+    # 先写临时文件再替换，避免进程中断留下损坏的快照
+    tmp_file = snapshot_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, snapshot_file)
+    return snapshot_file
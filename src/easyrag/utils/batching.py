@@ -0,0 +1,180 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+
+
+class AsyncMicroBatcher:
+    """
+    把并发到达的单条请求合并成批次：攒够 max_batch_size 条或等待 max_wait_ms 毫秒后，
+    调用一次 batch_fn(items) -> results，再把结果按顺序分发给各个调用方。
+    batch_fn 在 executor 中执行，默认单线程，同一时刻只有一个批次占用模型，
+    执行期间到达的请求会在队列中攒成下一个批次。
+    """
+
+    def __init__(
+            self,
+            batch_fn: Callable[[List[Any]], List[Any]],
+            max_batch_size: int = 16,
+            max_wait_ms: float = 5.0,
+            executor: Optional[Executor] = None,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait_ms = max_wait_ms
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._queue = []
+        self._timer = None
+        self._loop = None
+        # 持有运行中批次的引用，避免任务被垃圾回收
+        self._tasks = set()
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # 队列中的future属于创建它的事件循环，换了事件循环(如多次asyncio.run)时重新开始
+            self._loop, self._queue, self._timer = loop, [], None
+        future = loop.create_future()
+        self._queue.append((item, future))
+        if len(self._queue) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._queue:
+            batch = self._queue[:self.max_batch_size]
+            self._queue = self._queue[self.max_batch_size:]
+            task = self._loop.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = await self._loop.run_in_executor(self.executor, self.batch_fn, items)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class TokenBudgetBatcher:
+    """
+    跨请求的动态批处理：各请求提交的一组条目进入同一个队列，模型空闲时取出队列中的全部条目，
+    按长度排序并按token预算切分批次依次调用 batch_fn(items) -> results，再把结果分发回各个请求。
+    一轮计算期间到达的条目在队列中累积，组成下一轮的批次。batch_fn 在单线程 executor 中执行。
+    """
+
+    def __init__(
+            self,
+            batch_fn: Callable[[List[Any]], List[Any]],
+            count_tokens: Callable[[List[Any]], List[int]],
+            max_tokens: int,
+            max_batch_size: Optional[int] = None,
+            max_wait_ms: float = 2.0,
+            executor: Optional[Executor] = None,
+    ):
+        self.batch_fn = batch_fn
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._queue = []
+        self._worker = None
+        self._loop = None
+
+    async def submit_many(self, items: List[Any]) -> List[Any]:
+        if not items:
+            return []
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop, self._queue, self._worker = loop, [], None
+        futures = [loop.create_future() for _ in items]
+        self._queue.extend(zip(items, futures))
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._work())
+        return list(await asyncio.gather(*futures))
+
+    async def _work(self):
+        # 稍等片刻，让同时到达的请求进入同一轮
+        await asyncio.sleep(self.max_wait_ms / 1000)
+        while self._queue:
+            pending, self._queue = self._queue, []
+            items = [item for item, _ in pending]
+            try:
+                results = await self._loop.run_in_executor(self.executor, self._run_round, items)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(pending, results):
+                # 请求已取消时丢弃其结果
+                if not future.done():
+                    future.set_result(result)
+
+    def run(self, items: List[Any]) -> List[Any]:
+        """同步调用：在同一个模型线程中按token预算分批计算并等待结果，与异步提交的各轮计算串行执行"""
+        if not items:
+            return []
+        return self.executor.submit(self._run_round, items).result()
+
+    def _run_round(self, items: List[Any]) -> List[Any]:
+        results = [None] * len(items)
+        for batch in token_budget_batches(self.count_tokens(items), self.max_tokens, self.max_batch_size):
+            for i, result in zip(batch, self.batch_fn([items[i] for i in batch])):
+                results[i] = result
+        return results
+
+
+def token_budget_batches(
+        lengths: List[int],
+        max_tokens: int,
+        max_batch_size: Optional[int] = None,
+) -> List[List[int]]:
+    """
+    按长度从长到短排序后切分批次，返回每批文本的原始下标。
+    批次按最长成员补齐，每批 条数 x 最长长度 不超过 max_tokens；单条超过预算的文本单独成批。
+    最长的批次最先计算，显存不足会在一开始暴露。
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches, batch, batch_max = [], [], 0
+    for i in order:
+        new_max = max(batch_max, lengths[i])
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (new_max * (len(batch) + 1) > max_tokens or full):
+            batches.append(batch)
+            batch, new_max = [], lengths[i]
+        batch.append(i)
+        batch_max = new_max
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_by_token_budget(
+        texts: List[str],
+        count_tokens: Callable[[List[str]], List[int]],
+        embed_fn: Callable[[List[str]], np.ndarray],
+        max_tokens: int,
+        max_batch_size: Optional[int] = None,
+) -> np.ndarray:
+    # 按token预算分批计算，结果按输入顺序写入一个连续数组
+    results = np.zeros((0, 0), dtype=np.float32)
+    for batch in token_budget_batches(count_tokens(texts), max_tokens, max_batch_size):
+        embeddings = np.asarray(embed_fn([texts[i] for i in batch]))
+        if results.shape[0] != len(texts):
+            results = np.empty((len(texts), embeddings.shape[1]), dtype=embeddings.dtype)
+        results[batch] = embeddings
+    return results
@@ -45,11 +45,12 @@ async def main(
     answers = []
     all_nodes = []
     all_contexts = []
-    for query in tqdm(queries, total=len(queries)):
-        res = await rag_pipeline.run(query)
+    all_stages = []
+    for res in await rag_pipeline.run_batch(queries):
         answers.append(res['answer'])
         all_nodes.append(res['nodes'])
         all_contexts.append(res['contexts'])
+        all_stages.append(res['stages'])
 
     # 处理结果
     print("处理生成内容...")
@@ -94,7 +95,7 @@ async def main(
     if save_inter:
         print("保存中间结果...")
         inter_res_list = []
-        for query, answer, nodes, contexts in tqdm(zip(queries, answers, all_nodes, all_contexts)):
+        for query, answer, nodes, contexts, stages in tqdm(zip(queries, answers, all_nodes, all_contexts, all_stages)):
             paths = [node.metadata['file_path'] for node in nodes]
             know_paths = [node.metadata['know_path'] for node in nodes]
             inter_res = {
@@ -104,6 +105,11 @@ async def main(
                 "candidates": contexts,
                 "paths": paths,
                 "know_paths": know_paths,
+                # 粗排、精排各阶段输出的节点路径和分数
+                "stages": {
+                    name: [{"path": node.metadata['file_path'], "score": node.score} for node in stage_nodes]
+                    for name, stage_nodes in stages.items()
+                },
                 "quality": [0 for _ in range(len(contexts))],
                 "score": 0,
                 "duplicate": 0,
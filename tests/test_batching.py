@@ -0,0 +1,134 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from easyrag.utils.batching import AsyncMicroBatcher, TokenBudgetBatcher, embed_by_token_budget, \
+    token_budget_batches
+
+
+class Model:
+    """记录每个批次和调用线程的假模型，条目为字符串，长度即token数"""
+
+    def __init__(self, fail_on=None):
+        self.batches = []
+        self.threads = set()
+        self.fail_on = fail_on
+
+    def __call__(self, items):
+        self.threads.add(threading.get_ident())
+        if self.fail_on in items:
+            raise RuntimeError("model failed")
+        self.batches.append(list(items))
+        return [item.upper() for item in items]
+
+
+def make_batcher(model, max_tokens=12, max_batch_size=None):
+    return TokenBudgetBatcher(model, lambda items: [len(item) for item in items], max_tokens=max_tokens,
+                              max_batch_size=max_batch_size, max_wait_ms=5)
+
+
+def test_token_budget_batcher_merges_requests_within_budget():
+    model = Model()
+    batcher = make_batcher(model, max_tokens=12, max_batch_size=3)
+    requests = [["aaaa", "b", "cc"], ["dddddd", "e"], ["ffffffffffffff"], []]
+
+    async def main():
+        return await asyncio.gather(*(batcher.submit_many(items) for items in requests))
+
+    results = asyncio.run(main())
+    # 每个请求按提交顺序拿回自己的结果
+    assert results == [[item.upper() for item in items] for items in requests]
+    # 同时到达的请求在同一轮中组批，每批补齐后的token数不超过预算，超长的条目单独成批
+    assert sorted(item for batch in model.batches for item in batch) == sorted(sum(requests, []))
+    for batch in model.batches:
+        assert len(batch) <= 3
+        assert len(batch) == 1 or len(batch) * max(map(len, batch)) <= 12
+    assert ["ffffffffffffff"] in model.batches
+    assert len(model.batches) < 6
+
+
+def test_token_budget_batcher_propagates_errors():
+    model = Model(fail_on="bad")
+    batcher = make_batcher(model)
+
+    async def main():
+        return await asyncio.gather(batcher.submit_many(["ok", "bad"]), batcher.submit_many(["fine"]),
+                                    return_exceptions=True)
+
+    results = asyncio.run(main())
+    # 同一轮的请求都收到异常
+    assert all(isinstance(result, RuntimeError) for result in results)
+    # 出错后批处理器仍可继续使用
+    assert asyncio.run(batcher.submit_many(["again"])) == ["AGAIN"]
+    with pytest.raises(RuntimeError):
+        batcher.run(["bad"])
+
+
+def test_token_budget_batcher_sync_run_uses_model_thread():
+    model = Model()
+    batcher = make_batcher(model, max_tokens=4)
+    assert batcher.run(["aa", "b", "cccc", "dd"]) == ["AA", "B", "CCCC", "DD"]
+    assert asyncio.run(batcher.submit_many(["x"])) == ["X"]
+    # 同步和异步调用都在同一个模型线程中执行
+    assert len(model.threads) == 1 and threading.get_ident() not in model.threads
+
+
+def test_micro_batcher_merges_concurrent_requests():
+    model = Model()
+    batcher = AsyncMicroBatcher(model, max_batch_size=4, max_wait_ms=5)
+    items = [f"q{i}" for i in range(10)]
+
+    async def main():
+        return await asyncio.gather(*(batcher.submit(item) for item in items))
+
+    # 每个调用方拿回自己的结果，批次不超过 max_batch_size，未攒满的批次等待超时后计算
+    assert asyncio.run(main()) == [item.upper() for item in items]
+    assert [len(batch) for batch in model.batches] == [4, 4, 2]
+    # 换一个事件循环后仍可使用
+    assert asyncio.run(batcher.submit("again")) == "AGAIN"
+    assert model.batches[-1] == ["again"]
+    assert len(model.threads) == 1
+
+
+def test_micro_batcher_propagates_errors():
+    model = Model(fail_on="bad")
+    batcher = AsyncMicroBatcher(model, max_batch_size=8, max_wait_ms=5)
+
+    async def main():
+        return await asyncio.gather(batcher.submit("ok"), batcher.submit("bad"), return_exceptions=True)
+
+    # 同一批的请求都收到异常，之后的批次不受影响
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(main()))
+    assert asyncio.run(batcher.submit("fine")) == "FINE"
+
+
+@pytest.mark.parametrize("max_batch_size", [None, 3])
+def test_token_budget_batches(max_batch_size):
+    lengths = list(np.random.default_rng(0).integers(1, 40, size=200)) + [100]
+    batches = token_budget_batches(lengths, max_tokens=64, max_batch_size=max_batch_size)
+    # 每条文本恰好出现一次，从长到短排列
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    order = [lengths[i] for batch in batches for i in batch]
+    assert order == sorted(order, reverse=True)
+    for batch in batches:
+        # 超过预算的文本单独成批
+        assert len(batch) == 1 or len(batch) * max(lengths[i] for i in batch) <= 64
+        assert max_batch_size is None or len(batch) <= max_batch_size
+    assert batches[0] == [len(lengths) - 1]
+    assert token_budget_batches([], max_tokens=64) == []
+
+
+def test_embed_by_token_budget_keeps_input_order():
+    texts = ["a" * n for n in [5, 1, 30, 12, 7, 7, 2]]
+    calls = []
+
+    def embed_fn(batch):
+        calls.append(batch)
+        return np.array([[len(text), i] for i, text in enumerate(batch)], dtype=np.float32)
+
+    embeddings = embed_by_token_budget(texts, lambda items: [len(item) for item in items], embed_fn, max_tokens=16)
+    assert embeddings.dtype == np.float32 and embeddings.flags.c_contiguous
+    np.testing.assert_array_equal(embeddings[:, 0], [len(text) for text in texts])
+    assert len(calls) > 1 and all(len(batch) * max(map(len, batch)) <= 16 or len(batch) == 1 for batch in calls)
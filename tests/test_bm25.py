@@ -0,0 +1,231 @@
+import types
+
+import numpy as np
+import pytest
+from llama_index.core import QueryBundle
+from llama_index.core.schema import NodeWithScore, TextNode
+from rank_bm25 import BM25Okapi
+
+from easyrag.custom.retrievers import BM25Retriever
+from easyrag.pipeline.context import RequestContext, request_context
+
+TOKENIZER = types.SimpleNamespace(cut=str.split)
+TOP_K = 10
+
+
+def baseline_filter(nodes, scores, filter_dict=None, top_k=TOP_K):
+    # 优化前 BM25Retriever.filter 的选择方式
+    result = []
+    for ix in scores.argsort()[::-1]:
+        if scores[ix] <= 0:
+            break
+        if filter_dict is None or all(nodes[ix].metadata[k] == v for k, v in filter_dict.items()):
+            result.append(NodeWithScore(node=nodes[ix], score=float(scores[ix])))
+        if len(result) == top_k:
+            break
+    return sorted(result, key=lambda x: x.score, reverse=True)
+
+
+@pytest.fixture
+def nodes():
+    rng = np.random.default_rng(0)
+    words = [f"w{i}" for i in range(30)]
+    paths = [" ".join(rng.choice(words, 3)) for _ in range(40)]
+    # 大量切片共享同一路径，路径检索的分数中有很多同分
+    return [TextNode(text=" ".join(rng.choice(words, 12)),
+                     metadata={"file_path": paths[rng.integers(len(paths))], "dir": f"d{i % 3}"})
+            for i in range(600)]
+
+
+@pytest.mark.parametrize("embed_type", [0, 4])
+@pytest.mark.parametrize("filter_dict", [None, {"dir": "d1"}])
+def test_okapi_keeps_baseline_ranking(nodes, embed_type, filter_dict):
+    retriever = BM25Retriever.from_defaults(nodes=nodes, tokenizer=TOKENIZER, similarity_top_k=TOP_K,
+                                            embed_type=embed_type, bm25_type=0)
+    field = (lambda node: node.text) if embed_type == 0 else (lambda node: node.metadata["file_path"])
+    baseline = BM25Okapi([field(node).split() for node in nodes], k1=1.5, b=0.75, epsilon=0.25)
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        query = " ".join(f"w{i}" for i in rng.integers(30, size=2))
+        expected = baseline_filter(nodes, baseline.get_scores(query.split()), filter_dict)
+        with request_context(RequestContext(filter_dict=filter_dict)):
+            result = retriever.retrieve(QueryBundle(query))
+        assert [n.node.node_id for n in result] == [n.node.node_id for n in expected]
+        np.testing.assert_allclose([n.score for n in result], [n.score for n in expected], rtol=1e-6)
+
+
+@pytest.fixture
+def zipf_nodes():
+    # 词频服从Zipf分布，文档长度不一，并混入重复文档制造同分
+    rng = np.random.default_rng(2)
+    words = [f"w{i}" for i in range(800)]
+    p = 1 / np.arange(1, len(words) + 1)
+    texts = [" ".join(rng.choice(words, rng.integers(5, 60), p=p / p.sum())) for _ in range(1500)]
+    texts += [texts[i] for i in rng.integers(len(texts), size=100)]
+    return [TextNode(text=text, metadata={"dir": f"d{rng.integers(12)}"}) for text in texts]
+
+
+@pytest.mark.parametrize("filter_dict", [None, {"dir": "d5"}])
+def test_builtin_bm25_matches_okapi(zipf_nodes, filter_dict):
+    okapi = BM25Retriever.from_defaults(nodes=zipf_nodes, tokenizer=TOKENIZER, similarity_top_k=30, bm25_type=0)
+    builtin = BM25Retriever.from_defaults(nodes=zipf_nodes, tokenizer=TOKENIZER, similarity_top_k=30, bm25_type=2)
+    rng = np.random.default_rng(3)
+    words = [f"w{i}" for i in range(800)]
+    for _ in range(100):
+        query = " ".join(rng.choice(words[:200], rng.integers(1, 6)))
+        np.testing.assert_array_equal(builtin.get_scores(query), okapi.get_scores(query))
+        with request_context(RequestContext(filter_dict=filter_dict)):
+            expected = okapi.retrieve(QueryBundle(query))
+            result = builtin.retrieve(QueryBundle(query))
+        assert [(n.node.node_id, n.score) for n in result] == [(n.node.node_id, n.score) for n in expected]
+
+
+def test_sharded_retrieval_matches_unsharded(zipf_nodes, tmp_path):
+    # 部分文档缺少分片字段，单独放在最后一个分片
+    for node in zipf_nodes[::37]:
+        del node.metadata["dir"]
+    unsharded = BM25Retriever.from_defaults(nodes=zipf_nodes, tokenizer=TOKENIZER, similarity_top_k=30, bm25_type=2)
+    sharded = BM25Retriever.from_defaults(nodes=zipf_nodes, tokenizer=TOKENIZER, similarity_top_k=30, bm25_type=2,
+                                          shard_key="dir")
+    sharded.save(str(tmp_path / "bm25"))
+    loaded = BM25Retriever.load(str(tmp_path / "bm25"), zipf_nodes, tokenizer=TOKENIZER, similarity_top_k=30,
+                                shard_key="dir")
+    # 分片矩阵是同一组内存映射数组上的视图
+    assert isinstance(loaded.shards.impacts, np.memmap)
+    assert all(np.shares_memory(matrix.data, loaded.shards.impacts) for matrix in loaded.shards.matrices)
+
+    rng = np.random.default_rng(4)
+    words = [f"w{i}" for i in range(200)]
+    for _ in range(50):
+        query = QueryBundle(" ".join(rng.choice(words, rng.integers(1, 6))))
+        for filter_dict in [None, {"dir": "d5"}, {"dir": "missing"}]:
+            with request_context(RequestContext(filter_dict=filter_dict)):
+                expected = [(n.node.node_id, n.score) for n in unsharded.retrieve(query)]
+                assert [(n.node.node_id, n.score) for n in sharded.retrieve(query)] == expected
+                assert [(n.node.node_id, n.score) for n in loaded.retrieve(query)] == expected
+
+
+def test_sparse_encoder_weights_match_corpus_bm25(nodes, tmp_path):
+    from easyrag.custom.bm25 import BM25Index, BM25SparseEncoder, QueryAnalyzer
+
+    texts = [node.text for node in nodes]
+    analyzer = QueryAnalyzer(str.split)
+    whole = BM25SparseEncoder(analyzer, save_dir=str(tmp_path / "whole"))
+    whole.fit(texts)
+    batched = BM25SparseEncoder(analyzer, save_dir=str(tmp_path / "batched"))
+    batched.fit(texts)
+    # 编码结果与写入时的分批方式无关
+    vectors = whole.encode_documents(texts)
+    assert batched.encode_documents(texts[:7]) + batched.encode_documents(texts[7:]) == vectors
+
+    # 文档权重乘以qdrant的idf即为整个语料上的lucene BM25分数
+    index = BM25Index.from_corpus([text.split() for text in texts], method="lucene")
+    num_docs = len(texts)
+    df = np.zeros(len(whole.vocab_dict))
+    for indices, _ in vectors:
+        df[indices] += 1
+    idf = np.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+    query = "w1 w2 w3"
+    q_indices, q_weights = whole.encode_query(query)
+    query_vector = np.zeros(len(whole.vocab_dict))
+    query_vector[q_indices] = q_weights
+    scores = [sum(w * idf[i] * query_vector[i] for i, w in zip(indices, weights)) for indices, weights in vectors]
+    np.testing.assert_allclose(scores, index.get_scores(query.split()), rtol=1e-5)
+
+
+def test_sparse_encoder_requires_fit(tmp_path):
+    from easyrag.custom.bm25 import BM25SparseEncoder, QueryAnalyzer
+
+    with pytest.raises(ValueError):
+        BM25SparseEncoder(QueryAnalyzer(str.split)).encode_documents(["a b"])
+
+
+@pytest.mark.parametrize("bm25_type", [0, 2])
+def test_path_retrieval_without_matches(bm25_type):
+    # 没有任何路径(空语料)和查询词不在路径中时都返回空结果
+    empty = BM25Retriever(nodes=[], tokenizer=TOKENIZER, similarity_top_k=TOP_K, embed_type=4, bm25_type=bm25_type)
+    assert empty.path_filter(np.zeros(0)) == []
+    assert empty.retrieve(QueryBundle("x")) == []
+    nodes = [TextNode(text="a", metadata={"file_path": path, "dir": "d"}) for path in ["x y", "z w", "u v"]]
+    retriever = BM25Retriever(nodes=nodes, tokenizer=TOKENIZER, similarity_top_k=TOP_K, embed_type=4,
+                              bm25_type=bm25_type)
+    assert retriever.retrieve(QueryBundle("unknown")) == []
+    assert [n.node.node_id for n in retriever.retrieve(QueryBundle("x"))] == [nodes[0].node_id]
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+@pytest.mark.parametrize("embed_type, bm25_type", [(0, 0), (0, 2), (4, 0), (4, 2)])
+def test_save_load_round_trip(nodes, tmp_path, embed_type, bm25_type, mmap):
+    retriever = BM25Retriever.from_defaults(nodes=nodes, tokenizer=TOKENIZER, similarity_top_k=TOP_K,
+                                            embed_type=embed_type, bm25_type=bm25_type)
+    retriever.save(str(tmp_path / "bm25"))
+    loaded = BM25Retriever.load(str(tmp_path / "bm25"), nodes, tokenizer=TOKENIZER, similarity_top_k=TOP_K,
+                                mmap=mmap)
+    # 加载时不再分词，数组直接映射磁盘上的文件
+    assert loaded._corpus is None
+    assert isinstance(loaded.index.indices, np.memmap) is mmap
+    rng = np.random.default_rng(5)
+    for _ in range(30):
+        query = QueryBundle(" ".join(f"w{i}" for i in rng.integers(30, size=2)))
+        for filter_dict in [None, {"dir": "d1"}]:
+            with request_context(RequestContext(filter_dict=filter_dict)):
+                expected = [(n.node.node_id, n.score) for n in retriever.retrieve(query)]
+                result = [(n.node.node_id, n.score) for n in loaded.retrieve(query)]
+            assert [node_id for node_id, _ in result] == [node_id for node_id, _ in expected]
+            np.testing.assert_allclose([score for _, score in result], [score for _, score in expected], rtol=1e-6)
+
+
+def test_load_rejects_mismatched_index(nodes, tmp_path):
+    save_dir = str(tmp_path / "bm25")
+    with pytest.raises(FileNotFoundError):
+        BM25Retriever.load(save_dir, nodes, tokenizer=TOKENIZER)
+    BM25Retriever.from_defaults(nodes=nodes, tokenizer=TOKENIZER, bm25_type=2).save(save_dir)
+    with pytest.raises(ValueError):
+        BM25Retriever.load(save_dir, nodes[:-1], tokenizer=TOKENIZER)
+    with pytest.raises(ValueError):
+        BM25Retriever.load(save_dir, nodes, tokenizer=TOKENIZER, stopwords=["w1"])
+
+
+@pytest.mark.parametrize("embed_type, bm25_type", [(0, 0), (0, 2), (4, 0), (4, 2)])
+def test_retrieve_batch_matches_retrieve(nodes, embed_type, bm25_type):
+    retriever = BM25Retriever.from_defaults(nodes=nodes, tokenizer=TOKENIZER, similarity_top_k=TOP_K,
+                                            embed_type=embed_type, bm25_type=bm25_type)
+    rng = np.random.default_rng(6)
+    queries = [QueryBundle(" ".join(f"w{i}" for i in rng.integers(35, size=rng.integers(1, 4)))) for _ in range(40)]
+    # 每个查询各自的过滤条件，包括没有结果的过滤
+    filter_dicts = [[None, {"dir": "d1"}, {"dir": "missing"}][i % 3] for i in range(len(queries))]
+    results = retriever.retrieve_batch(queries, filter_dicts)
+    for query, filter_dict, result in zip(queries, filter_dicts, results):
+        with request_context(RequestContext(filter_dict=filter_dict)):
+            expected = retriever.retrieve(query)
+        assert [(n.node.node_id, n.score) for n in result] == [(n.node.node_id, n.score) for n in expected]
+
+
+def test_query_analyzer_shared_between_retrievers(nodes):
+    from easyrag.custom.bm25 import QueryAnalyzer
+
+    calls = []
+
+    def tokenize(text):
+        calls.append(text)
+        return text.split()
+
+    analyzer = QueryAnalyzer(tokenize, cache_size=2)
+    sparse = BM25Retriever(nodes, TOKENIZER, similarity_top_k=TOP_K, bm25_type=2, analyzer=analyzer)
+    path = BM25Retriever(nodes, TOKENIZER, similarity_top_k=TOP_K, embed_type=4, bm25_type=2, analyzer=analyzer)
+    own = BM25Retriever(nodes, TOKENIZER, similarity_top_k=TOP_K, bm25_type=2)
+    query = QueryBundle("w1 w2 w3")
+    for _ in range(3):
+        assert [(n.node.node_id, n.score) for n in sparse.retrieve(query)] == \
+               [(n.node.node_id, n.score) for n in own.retrieve(query)]
+        path.retrieve(query)
+    # 同一查询在两个检索器中只分词一次，词项编号按索引分别缓存
+    assert calls == ["w1 w2 w3"]
+    analyzed = analyzer.analyze("w1 w2 w3")
+    assert analyzed.term_ids(sparse.index) == sparse.index.term_ids(["w1", "w2", "w3"])
+    assert analyzed.term_ids(path.index) == path.index.term_ids(["w1", "w2", "w3"])
+    # 超出缓存容量后最久未用的查询重新分词
+    analyzer.analyze("w4")
+    analyzer.analyze("w5")
+    analyzer.analyze("w1 w2 w3")
+    assert calls == ["w1 w2 w3", "w4", "w5", "w1 w2 w3"]
@@ -0,0 +1,30 @@
+import asyncio
+
+from easyrag.pipeline.context import RequestContext, current_request, record_stage, request_context, request_value
+
+
+def test_concurrent_requests_keep_their_own_context():
+    async def handle(name):
+        with request_context(RequestContext(filter_dict={"dir": name}, hnsw_ef=len(name))) as context:
+            # 请求内并发的子任务读到同一个上下文
+            await asyncio.gather(*[stage(name, i) for i in range(3)])
+            assert current_request() is context
+        assert current_request() is None
+        return context
+
+    async def stage(name, i):
+        await asyncio.sleep(0.001 * (3 - i))
+        assert request_value("filter_dict") == {"dir": name}
+        record_stage(f"stage{i}", (name, request_value("hnsw_ef")))
+
+    async def handle_all():
+        return await asyncio.gather(*[handle(name) for name in ["a", "bb", "ccc"]])
+
+    for name, context in zip(["a", "bb", "ccc"], asyncio.run(handle_all())):
+        assert context.stages == {f"stage{i}": (name, len(name)) for i in range(3)}
+
+
+def test_outside_request_uses_defaults():
+    assert request_value("filters", "default") == "default"
+    record_stage("ignored", [])
+    assert current_request() is None
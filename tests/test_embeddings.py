@@ -0,0 +1,128 @@
+import asyncio
+
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+
+# embeddings 包导入时加载嵌入模型的实现，需要torch
+pytest.importorskip("torch")
+
+from easyrag.custom.embeddings.cache import EmbeddingCache, QueryEmbeddingCache, cached_embed
+from easyrag.custom.embeddings.projection import PCAProjection, load_or_fit_projection
+
+
+def fake_embed(query):
+    # 向量由原始文本决定，全角和半角标点得到不同的向量；取float32可表示的值，与磁盘缓存的精度一致
+    rng = np.random.default_rng(list(query.encode("utf-8")))
+    return rng.standard_normal(8).astype(np.float32).tolist()
+
+
+async def afake_embed(query):
+    return fake_embed(query)
+
+
+def test_query_cache_returns_uncached_embedding(tmp_path):
+    query = "  文档中，什么是ＲＡＧ？（检索增强）"
+    cache = QueryEmbeddingCache("model", cache_path=str(tmp_path), disk_min_hits=1)
+    assert cache.get_or_embed(query, fake_embed) == fake_embed(query)
+    assert cache.get_or_embed(query, fake_embed) == fake_embed(query)
+    assert asyncio.run(cache.aget_or_embed(query, afake_embed)) == fake_embed(query)
+    assert cache.stats()["hits"] == 2
+
+    # 重启后从磁盘命中
+    reloaded = QueryEmbeddingCache("model", cache_path=str(tmp_path), disk_min_hits=1)
+    assert asyncio.run(reloaded.aget_or_embed(query, afake_embed)) == fake_embed(query)
+    assert reloaded.stats()["disk_hits"] == 1
+
+
+def test_query_cache_miss_embeds_original_query():
+    seen = []
+    cache = QueryEmbeddingCache("model")
+    cache.get_or_embed("什么是RAG？ ", lambda query: seen.append(query) or fake_embed(query))
+    assert seen == ["什么是RAG？ "]
+
+
+def test_embedding_cache_only_embeds_new_texts(tmp_path):
+    calls = []
+
+    def embed_batch(texts):
+        calls.append(list(texts))
+        return np.asarray([fake_embed(text) for text in texts])
+
+    texts = [f"text {i}" for i in range(6)]
+    cache = EmbeddingCache(str(tmp_path), "org/model", "text_e0")
+    first = cached_embed(cache, texts[:4], embed_batch)
+    # 部分命中时只计算未命中的文本，重复文本只写入一次
+    second = cached_embed(cache, texts[2:] + ["text 5"], embed_batch)
+    assert calls == [texts[:4], texts[4:] + ["text 5"]]
+    assert len(cache.key2row) == 6
+    # 命中的向量按float16存储，新计算的向量原样返回
+    exact = np.asarray([fake_embed(text) for text in texts], dtype=np.float32)
+    expected = exact.astype(np.float16).astype(np.float32)
+    np.testing.assert_array_equal(first, exact[:4])
+    np.testing.assert_array_equal(second, np.concatenate([expected[2:4], exact[4:], exact[5:]]))
+
+    # 重新打开后从磁盘命中，不同模型或命名空间互不影响
+    reopened = EmbeddingCache(str(tmp_path), "org/model", "text_e0")
+    np.testing.assert_array_equal(cached_embed(reopened, texts, embed_batch), expected)
+    assert len(calls) == 2
+    assert EmbeddingCache(str(tmp_path), "org/model", "text_e4").get(texts) == (None, list(range(6)))
+    assert EmbeddingCache(str(tmp_path), "org/other", "text_e0").get(texts)[1] == list(range(6))
+
+
+def test_embedding_cache_recovers_from_partial_write(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", "text_e0")
+    cache.put(["a", "b"], np.asarray([fake_embed("a"), fake_embed("b")]))
+    # 模拟写入向量后、写入键之前中断：向量文件多出半行
+    with open(cache.vectors_file, "ab") as f:
+        f.write(b"\0" * 5)
+    reopened = EmbeddingCache(str(tmp_path), "model", "text_e0")
+    reopened.put(["c"], np.asarray([fake_embed("c")]))
+    embeddings, missing = EmbeddingCache(str(tmp_path), "model", "text_e0").get(["a", "b", "c"])
+    assert missing == []
+    np.testing.assert_array_equal(
+        embeddings, np.asarray([fake_embed(t) for t in "abc"], dtype=np.float16).astype(np.float32))
+
+
+def low_rank_embeddings(num, dim=64, rank=8, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((num, rank)) @ rng.standard_normal((rank, dim)) + 0.01 * rng.standard_normal((num, dim))
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+def test_pca_projection_keeps_neighbours(tmp_path):
+    corpus = low_rank_embeddings(500)
+    projection = PCAProjection.fit(corpus, 8)
+    assert projection.dim == 8 and projection.explained_variance > 0.99
+    projected = projection(corpus)
+    np.testing.assert_allclose(np.linalg.norm(projected, axis=1), 1, rtol=1e-5)
+    # 数据本身是低秩的，投影后的最近邻与原始向量一致
+    queries = corpus[:20] + 0.05 * np.random.default_rng(1).standard_normal((20, 64)).astype(np.float32)
+    assert ((queries @ corpus.T).argmax(1) == (projection(queries) @ projected.T).argmax(1)).all()
+    with pytest.raises(ValueError):
+        PCAProjection.fit(corpus, 65)
+
+    projection.save(str(tmp_path / "projection.npz"))
+    loaded = PCAProjection.load(str(tmp_path / "projection.npz"))
+    np.testing.assert_array_equal(loaded(queries), projection(queries))
+    assert loaded.fingerprint() == projection.fingerprint()
+
+
+def test_load_or_fit_projection(tmp_path):
+    corpus = low_rank_embeddings(300)
+    nodes = [TextNode(text=str(i), id_=str(i)) for i in range(len(corpus))]
+    calls = []
+
+    def embed_fn(sample):
+        calls.append(len(sample))
+        return corpus[[int(node.node_id) for node in sample]]
+
+    path = str(tmp_path / "projection.npz")
+    projection, fitted = load_or_fit_projection(path, 8, nodes, embed_fn, sample_size=100)
+    assert fitted and calls == [100]
+    # 已保存的投影直接加载，维度变化或 refit 时重新拟合
+    loaded, fitted = load_or_fit_projection(path, 8, nodes, embed_fn, sample_size=100)
+    assert not fitted and calls == [100] and loaded.fingerprint() == projection.fingerprint()
+    assert load_or_fit_projection(path, 4, nodes, embed_fn, sample_size=100)[1]
+    assert load_or_fit_projection(path, 4, nodes, embed_fn, sample_size=100, refit=True)[1]
+    assert calls == [100, 100, 100]
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import types
+
+import numpy as np
+import pytest
+from llama_index.core import MockEmbedding
+from llama_index.core.schema import NodeRelationship, TextNode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from qdrant_client import models
+
+from easyrag.custom.vector_stores import SPARSE_VECTOR_NAME, build_quantization_config
+from easyrag.pipeline.ingestion import arun_preprocess, build_nodes, build_vector_store, read_data, \
+    update_collection_config, update_vector_store, upload_plan
+from easyrag.pipeline.snapshot import save_manifest
+
+CHUNK_SIZE = 256
+
+
+def write_corpus(data_path, files):
+    for name, num_paragraphs in files.items():
+        path = os.path.join(data_path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("\n\n".join(
+                f"{name} paragraph {i}: " + " ".join(f"word{i}_{j}" for j in range(40))
+                for i in range(num_paragraphs)
+            ))
+
+
+def link_structure(nodes):
+    # 节点编号每次切分都不同，用 (文件, 正文) 表示节点，比较前后关系指向的节点
+    keys = {node.node_id: (node.metadata["file_path"], node.text) for node in nodes}
+    structure = []
+    for node in nodes:
+        prev_info = node.relationships.get(NodeRelationship.PREVIOUS)
+        next_info = node.relationships.get(NodeRelationship.NEXT)
+        structure.append((
+            keys[node.node_id],
+            None if prev_info is None else keys[prev_info.node_id],
+            None if next_info is None else keys[next_info.node_id],
+        ))
+    return structure
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    data_path = str(tmp_path / "data")
+    write_corpus(data_path, {f"dir{i % 3}/file{i}.txt": 3 + i % 4 for i in range(8)})
+    return data_path
+
+
+def test_parallel_preprocess_keeps_prev_next_links(corpus):
+    documents = read_data(corpus)
+    serial = asyncio.run(arun_preprocess(documents, corpus, CHUNK_SIZE, 0, num_workers=1))
+    parallel = asyncio.run(arun_preprocess(read_data(corpus), corpus, CHUNK_SIZE, 0, num_workers=2))
+    assert link_structure(parallel) == link_structure(serial)
+    assert sum(NodeRelationship.PREVIOUS not in node.relationships for node in parallel) == 1
+
+
+def test_incremental_build_relinks_file_boundaries(corpus, tmp_path):
+    snapshot_path = str(tmp_path / "snapshot")
+    asyncio.run(build_nodes(corpus, CHUNK_SIZE, 0, 0, snapshot_path))
+
+    os.remove(os.path.join(corpus, "dir1/file4.txt"))
+    write_corpus(corpus, {"dir0/file3.txt": 2, "dir2/file9.txt": 4})
+    incremental = asyncio.run(build_nodes(corpus, CHUNK_SIZE, 0, 0, snapshot_path))
+    full = asyncio.run(build_nodes(corpus, CHUNK_SIZE, 0, 0))
+
+    assert link_structure(incremental) == link_structure(full)
+    # 写入快照的节点也不再含有指向已删除节点的关系
+    reloaded = asyncio.run(build_nodes(corpus, CHUNK_SIZE, 0, 0, snapshot_path))
+    assert link_structure(reloaded) == link_structure(full)
+
+
+class RecordingClient:
+    """只实现 update_collection_config 用到的接口，记录对集合配置的修改"""
+
+    def __init__(self, quantization_config, sparse_vectors=None):
+        vectors = models.VectorParams(size=4, distance=models.Distance.COSINE, on_disk=quantization_config is not None)
+        self.config = types.SimpleNamespace(
+            hnsw_config=models.HnswConfig(m=16, ef_construct=100, full_scan_threshold=10000),
+            params=types.SimpleNamespace(vectors=vectors, sparse_vectors=sparse_vectors),
+            quantization_config=quantization_config,
+        )
+        self.updates = []
+
+    async def get_collection(self, collection_name):
+        return types.SimpleNamespace(config=self.config)
+
+    async def update_collection(self, collection_name, **kwargs):
+        self.updates.append(kwargs)
+
+
+@pytest.mark.parametrize("current, requested, expected", [
+    ("int8", "", models.Disabled.DISABLED),
+    ("", "binary", build_quantization_config("binary")),
+    ("int8", "int8", None),
+    ("", "", None),
+])
+def test_update_collection_quantization(current, requested, expected):
+    client = RecordingClient(build_quantization_config(current))
+    quantization_config = build_quantization_config(requested)
+    hnsw_config = models.HnswConfigDiff(m=16, ef_construct=100, on_disk=False)
+    asyncio.run(update_collection_config(client, "collection", hnsw_config, quantization_config is not None,
+                                         quantization_config))
+    assert [update.get("quantization_config") for update in client.updates] == ([expected] if expected else [])
+
+
+@pytest.mark.parametrize("has_sparse", [False, True])
+def test_update_collection_requires_rebuild_without_sparse_vectors(has_sparse):
+    sparse_vectors_config = {SPARSE_VECTOR_NAME: models.SparseVectorParams()}
+    client = RecordingClient(None, sparse_vectors_config if has_sparse else None)
+    hnsw_config = models.HnswConfigDiff(m=16, ef_construct=100, on_disk=False)
+    rebuild = asyncio.run(update_collection_config(client, "collection", hnsw_config, False,
+                                                   sparse_vectors_config=sparse_vectors_config))
+    # 已写入的点没有稀疏向量，不能只补充稀疏向量配置
+    assert rebuild is not has_sparse
+    assert all("sparse_vectors_config" not in update for update in client.updates)
+
+
+def test_checkpoint_ignored_for_empty_collection(tmp_path):
+    nodes = [TextNode(text=f"text {i}", metadata={"file_path": f"doc{i}.txt", "dir": "d0"}) for i in range(10)]
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    # 断点记录第一批已写入，但集合已被重建为空集合
+    save_manifest(checkpoint_file, {"config": None, "plan": upload_plan(nodes, [], 4), "done": [0]})
+
+    async def upload():
+        client, vector_store = await build_vector_store(
+            qdrant_url="", cache_path=str(tmp_path / "qdrant"), collection_name="c", vector_size=4)
+        await update_vector_store(client, vector_store, MockEmbedding(embed_dim=4), nodes, "c",
+                                  checkpoint_file=checkpoint_file, upload_batch_size=4)
+        return (await client.get_collection("c")).points_count
+
+    assert asyncio.run(upload()) == len(nodes)
+
+
+class FlakyEmbedding:
+    """按块编码的假模型，记录编码过的文本，第 fail_at 次调用时抛出异常模拟进程中断"""
+
+    def __init__(self, fail_at=None, embed_batch_size=4):
+        self.embed_batch_size = embed_batch_size
+        self.fail_at = fail_at
+        self.embedded = []
+
+    def embed_nodes(self, nodes):
+        if self.fail_at is not None and len(self.embedded) == self.fail_at:
+            raise RuntimeError("interrupted")
+        self.embedded.append([node.text for node in nodes])
+        return np.asarray([[1.0, len(node.text), i % 3, 1.0] for i, node in enumerate(nodes)], dtype=np.float32)
+
+
+def test_checkpoint_resumes_partial_upload(tmp_path):
+    nodes = [TextNode(text=f"text {i}", metadata={"file_path": f"doc{i // 3}.txt", "dir": "d0"}) for i in range(30)]
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+
+    async def upload(embed_model, nodes):
+        client, vector_store = await build_vector_store(
+            qdrant_url="", cache_path=str(tmp_path / "qdrant"), collection_name="c", vector_size=4)
+        try:
+            await update_vector_store(client, vector_store, embed_model, nodes, "c", config={"v": 1},
+                                      checkpoint_file=checkpoint_file, upload_batch_size=4, upload_parallel=1)
+        finally:
+            points = (await client.scroll("c", limit=100))[0]
+            await client.close()
+        return sorted(metadata_dict_to_node(point.payload).text for point in points)
+
+    interrupted = FlakyEmbedding(fail_at=3)
+    with pytest.raises(RuntimeError):
+        asyncio.run(upload(interrupted, nodes))
+    assert os.path.exists(checkpoint_file)
+    written = sum(interrupted.embedded, [])
+    assert len(written) == 12
+
+    # 从断点继续：已确认的批次不再编码，最终集合与一次写完一致
+    resumed = FlakyEmbedding()
+    assert asyncio.run(upload(resumed, nodes)) == sorted(node.text for node in nodes)
+    assert sorted(sum(resumed.embedded, [])) == sorted(set(node.text for node in nodes) - set(written))
+    assert not os.path.exists(checkpoint_file)
+
+
+def test_checkpoint_discarded_when_corpus_changes(tmp_path):
+    nodes = [TextNode(text=f"text {i}", metadata={"file_path": f"doc{i // 3}.txt", "dir": "d0"}) for i in range(30)]
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+
+    async def upload(embed_model, nodes):
+        client, vector_store = await build_vector_store(
+            qdrant_url="", cache_path=str(tmp_path / "qdrant"), collection_name="c", vector_size=4)
+        try:
+            await update_vector_store(client, vector_store, embed_model, nodes, "c", config={"v": 1},
+                                      checkpoint_file=checkpoint_file, upload_batch_size=4, upload_parallel=1)
+            return (await client.get_collection("c")).points_count
+        finally:
+            await client.close()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(upload(FlakyEmbedding(fail_at=2), nodes))
+    # 中断后语料变化，集合清空后全部重写，不残留旧语料的点
+    changed = nodes[:20]
+    rewritten = FlakyEmbedding()
+    assert asyncio.run(upload(rewritten, changed)) == len(changed)
+    assert sorted(sum(rewritten.embedded, [])) == sorted(node.text for node in changed)
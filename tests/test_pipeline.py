@@ -0,0 +1,55 @@
+import asyncio
+import types
+
+import numpy as np
+import pytest
+from llama_index.core import QueryBundle
+from llama_index.core.schema import TextNode
+
+pytest.importorskip("torch")
+
+from easyrag.custom.retrievers import BM25Retriever
+from easyrag.pipeline.context import RequestContext, request_context
+from easyrag.pipeline.pipeline import EasyRAGPipeline
+
+TOKENIZER = types.SimpleNamespace(cut=str.split)
+
+
+class ReverseRerank:
+    """与真实精排模型一样原地改写节点分数"""
+
+    def postprocess_nodes(self, nodes, query_bundle):
+        for i, node in enumerate(nodes):
+            node.score = float(i)
+        return nodes[::-1][:3]
+
+
+@pytest.fixture
+def pipeline():
+    rng = np.random.default_rng(0)
+    words = [f"w{i}" for i in range(20)]
+    nodes = [TextNode(text=" ".join(rng.choice(words, 8)), metadata={"file_path": f"f{i}", "dir": f"d{i % 2}"})
+             for i in range(100)]
+    pipeline = EasyRAGPipeline.__new__(EasyRAGPipeline)
+    pipeline.__dict__.update(
+        hyde=False, hyde_merging=False, re_only=True, rerank_fusion_type=0, retrieval_type=2,
+        llm_embed_type=0, nodes=nodes, nodeid2idx={node.node_id: i for i, node in enumerate(nodes)},
+        sparse_retriever=BM25Retriever(nodes, TOKENIZER, similarity_top_k=10), path_retriever=None,
+        reranker=ReverseRerank(),
+    )
+    return pipeline
+
+
+def test_run_returns_stages_per_request(pipeline):
+    queries = [{"query": "w1 w2 w3", "document": "d0"}, {"query": "w1 w2 w3", "document": "d1"}]
+
+    async def run_all():
+        return await asyncio.gather(*[pipeline.run(dict(query)) for query in queries])
+
+    for query, res in zip(queries, asyncio.run(run_all())):
+        with request_context(RequestContext(filter_dict={"dir": query["document"]})):
+            expected = pipeline.sparse_retriever.retrieve(QueryBundle(query["query"]))
+        # 粗排阶段保留精排前的检索分数，各请求只包含自己的过滤结果
+        assert [(node.node_id, node.score) for node in res["stages"]["retrieve"]] == \
+               [(node.node_id, node.score) for node in expected]
+        assert res["stages"]["rerank"] == res["nodes"]
@@ -0,0 +1,156 @@
+import asyncio
+import types
+
+import numpy as np
+import pytest
+from llama_index.core import QueryBundle
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.schema import NodeWithScore, TextNode
+from qdrant_client import AsyncQdrantClient, models
+
+from easyrag.custom.bm25 import BM25SparseEncoder, QueryAnalyzer
+from easyrag.custom.retrievers import BM25Retriever, HybridRetriever, QdrantHybridRetriever, QdrantRetriever
+from easyrag.pipeline.ingestion import build_vector_store, set_content_fingerprints, update_vector_store
+
+TOKENIZER = types.SimpleNamespace(cut=str.split)
+# 同义词映射到同一维度：稠密检索能找到没有共同词的文档，稀疏检索找不到
+CONCEPTS = {"car": 0, "automobile": 0, "engine": 1, "motor": 1, "repair": 2, "fix": 2}
+DIM = 16
+
+requires_query_points = pytest.mark.skipif(
+    not hasattr(AsyncQdrantClient, "query_points") or not hasattr(models, "Modifier"),
+    reason="qdrant原生混合检索需要 qdrant-client>=1.10",
+)
+
+
+class ConceptEmbedding(BaseEmbedding):
+    def _embed(self, text):
+        vector = np.full(DIM, 1e-3)
+        for word in text.split():
+            vector[CONCEPTS.get(word, 3 + hash(word) % (DIM - 3))] += 1
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _get_query_embedding(self, query):
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._embed(query)
+
+    def _get_text_embedding(self, text):
+        return self._embed(text)
+
+
+@pytest.fixture
+def nodes():
+    rng = np.random.default_rng(0)
+    fillers = [f"f{i}" for i in range(50)]
+    texts = ["car engine repair", "automobile motor fix"] + \
+            [" ".join(rng.choice(fillers, 6)) for _ in range(60)] + ["car " + " ".join(rng.choice(fillers, 5))]
+    return [TextNode(text=text, metadata={"file_path": f"doc{i}.txt", "dir": "d0"}) for i, text in enumerate(texts)]
+
+
+@requires_query_points
+def test_hybrid_native_and_in_process_fusion_cover_both_legs(nodes, tmp_path):
+    async def retrieve():
+        client, vector_store = await build_vector_store(
+            qdrant_url="", cache_path=str(tmp_path / "qdrant"), collection_name="c", vector_size=DIM,
+            sparse_vectors=True,
+        )
+        embed_model = ConceptEmbedding()
+        encoder = BM25SparseEncoder(QueryAnalyzer(str.split))
+        await update_vector_store(client, vector_store, embed_model, nodes, "c", sparse_encoder=encoder)
+        native = QdrantHybridRetriever(vector_store, embed_model, encoder,
+                                       similarity_top_k=5, dense_top_k=5, sparse_top_k=5)
+        in_process = HybridRetriever(
+            dense_retriever=QdrantRetriever(vector_store, embed_model, similarity_top_k=5),
+            sparse_retriever=BM25Retriever(nodes, TOKENIZER, similarity_top_k=5),
+            retrieval_type=3,
+            topk=5,
+        )
+        query = QueryBundle("car engine repair")
+        return await native.aretrieve(query), await in_process.aretrieve(query)
+
+    native, in_process = asyncio.run(retrieve())
+    for result in (native, in_process):
+        texts = [n.node.text for n in result]
+        # 两路都命中的文档排第一，只有稠密命中(同义词)和只有稀疏命中(共同词)的文档都在融合结果中
+        assert texts[0] == "car engine repair"
+        assert "automobile motor fix" in texts
+        assert nodes[-1].text in texts
+
+
+@requires_query_points
+def test_adding_sparse_vectors_rebuilds_collection(nodes, tmp_path):
+    async def rebuild():
+        cache_path = str(tmp_path / "qdrant")
+        client, vector_store = await build_vector_store(
+            qdrant_url="", cache_path=cache_path, collection_name="c", vector_size=DIM)
+        await update_vector_store(client, vector_store, ConceptEmbedding(), nodes, "c")
+        await client.close()
+        # 已有集合没有稀疏向量，开启混合检索后集合被重建，所有节点重新写入并带上稀疏向量
+        client, vector_store = await build_vector_store(
+            qdrant_url="", cache_path=cache_path, collection_name="c", vector_size=DIM, sparse_vectors=True)
+        rebuilt = await client.get_collection("c")
+        encoder = BM25SparseEncoder(QueryAnalyzer(str.split))
+        await update_vector_store(client, vector_store, ConceptEmbedding(), nodes, "c", sparse_encoder=encoder)
+        native = QdrantHybridRetriever(vector_store, ConceptEmbedding(), encoder,
+                                       similarity_top_k=5, dense_top_k=5, sparse_top_k=5)
+        return rebuilt, await native.aretrieve(QueryBundle("car engine repair"))
+
+    rebuilt, result = asyncio.run(rebuild())
+    assert rebuilt.points_count == 0
+    assert "bm25" in rebuilt.config.params.sparse_vectors
+    assert nodes[-1].text in [n.node.text for n in result]
+
+
+def baseline_rrf(list_of_list_ranks_system, K=60, topk=256):
+    # 优化前以正文为键的倒数排序融合
+    from collections import defaultdict
+    rrf_map = defaultdict(float)
+    text_to_node = {}
+    for rank_list in list_of_list_ranks_system:
+        for rank, item in enumerate(rank_list, 1):
+            content = item.get_content()
+            text_to_node[content] = item
+            rrf_map[content] += 1 / (rank + K)
+    sorted_items = sorted(rrf_map.items(), key=lambda x: x[1], reverse=True)
+    return [(text_to_node[text], score) for text, score in sorted_items][:topk]
+
+
+def ranked_lists(seed):
+    # 多路检索结果：同一正文在不同路中是不同的节点对象(不同切分或检索器的副本)，部分节点带预先计算的指纹
+    rng = np.random.default_rng(seed)
+    texts = [f"chunk {i}" for i in range(80)]
+    fingerprinted = [TextNode(text=text) for text in texts]
+    set_content_fingerprints(fingerprinted)
+    lists = []
+    for _ in range(rng.integers(2, 5)):
+        picked = rng.choice(len(texts), rng.integers(0, 60), replace=False)
+        lists.append([NodeWithScore(node=fingerprinted[i] if rng.random() < 0.5 else TextNode(text=texts[i]),
+                                    score=float(rng.random())) for i in picked])
+    return lists
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("topk", [5, 256])
+def test_rrf_matches_content_keyed_fusion(seed, topk):
+    lists = ranked_lists(seed)
+    # 按对象位置对应两次生成的节点，比较保留的是哪一个副本
+    position = {id(node): (i, j) for i, nodes in enumerate(lists) for j, node in enumerate(nodes)}
+    expected_lists = ranked_lists(seed)
+    expected_position = {id(node): (i, j) for i, nodes in enumerate(expected_lists) for j, node in enumerate(nodes)}
+    expected = [(expected_position[id(node)], node.get_content(), score)
+                for node, score in baseline_rrf(expected_lists, topk=topk)]
+    result = HybridRetriever.reciprocal_rank_fusion(lists, topk=topk)
+    assert [(position[id(node)], node.get_content(), node.score) for node in result] == expected
+
+
+def test_fusion_dedups_by_content():
+    lists = ranked_lists(0)
+    seen, expected = set(), []
+    for node in (node for nodes in lists for node in nodes):
+        if node.get_content() not in seen:
+            seen.add(node.get_content())
+            expected.append(node)
+    expected = sorted(expected, key=lambda node: node.score, reverse=True)
+    assert [id(node) for node in HybridRetriever.fusion(lists)] == [id(node) for node in expected]
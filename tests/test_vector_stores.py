@@ -0,0 +1,158 @@
+import asyncio
+
+import numpy as np
+import pytest
+from llama_index.core import MockEmbedding, QueryBundle
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores import VectorStoreQuery
+from llama_index.core.vector_stores.types import VectorStoreQueryMode
+from qdrant_client import models
+
+from easyrag.custom.retrievers import QdrantRetriever
+from easyrag.custom.vector_stores import LocalVectorStore, build_search_params
+from easyrag.pipeline.context import RequestContext, request_context
+from easyrag.pipeline.ingestion import build_qdrant_filters, build_vector_store, update_vector_store
+
+NUM_NODES, DIM, TOP_K = 3000, 32, 10
+
+
+@pytest.fixture(scope="module")
+def data():
+    # 聚类分布的向量；d_rare 只有5个节点，分散在各个桶中
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((60, DIM))
+    vectors = (centers[rng.integers(len(centers), size=NUM_NODES)]
+               + 0.3 * rng.standard_normal((NUM_NODES, DIM))).astype(np.float32)
+    nodes = [TextNode(text=f"t{i}", id_=f"id{i}", metadata={"dir": "d_rare" if i % 600 == 7 else f"d{i % 5}"})
+             for i in range(NUM_NODES)]
+    queries = vectors[rng.integers(NUM_NODES, size=30)] + 0.1 * rng.standard_normal((30, DIM)).astype(np.float32)
+    return nodes, vectors, queries
+
+
+def build(tmp_path, data, name, **kwargs):
+    nodes, vectors, _ = data
+    pos = {node.node_id: i for i, node in enumerate(nodes)}
+    return LocalVectorStore.build(str(tmp_path / name), nodes, lambda batch: vectors[[pos[n.node_id] for n in batch]],
+                                  block_size=512, **kwargs)
+
+
+def brute_force(data, query, dir=None):
+    nodes, vectors, _ = data
+    # 与存储精度一致：归一化后取float16
+    stored = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float16).astype(np.float32)
+    scores = stored @ (query / np.linalg.norm(query))
+    if dir is not None:
+        scores = np.where([node.metadata["dir"] == dir for node in nodes], scores, -np.inf)
+    top = np.argsort(-scores, kind="stable")[:TOP_K]
+    return [nodes[i].node_id for i in top if np.isfinite(scores[i])], scores[top]
+
+
+def search(store, query, dir=None):
+    return store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=TOP_K),
+                       qdrant_filters=build_qdrant_filters(dir) if dir else None)
+
+
+def recall(store, data, dir=None):
+    hits = []
+    for query in data[2]:
+        expected, _ = brute_force(data, query, dir)
+        hits.append(len(set(expected) & set(search(store, query, dir).ids)) / len(expected))
+    return np.mean(hits)
+
+
+def test_exact_search_matches_brute_force(tmp_path, data):
+    store = build(tmp_path, data, "exact", ivf_threshold=NUM_NODES + 1)
+    # 精确检索直接读取内存映射的float16向量
+    assert isinstance(store.vectors, np.memmap) and store.vectors.dtype == np.float16
+    for query in data[2]:
+        for dir in [None, "d2"]:
+            expected, scores = brute_force(data, query, dir)
+            result = search(store, query, dir)
+            assert result.ids == expected
+            np.testing.assert_allclose(result.similarities, scores, rtol=1e-5)
+
+
+@pytest.mark.parametrize("quantization", ["", "int8", "binary"])
+@pytest.mark.parametrize("ivf_threshold", [NUM_NODES + 1, 500])
+def test_search_recall(tmp_path, data, quantization, ivf_threshold):
+    store = build(tmp_path, data, "store", ivf_threshold=ivf_threshold, nprobe=8, quantization=quantization,
+                  oversampling=4.0)
+    assert (store.centroids is not None) == (ivf_threshold <= NUM_NODES)
+    assert recall(store, data) >= (0.9 if quantization != "binary" else 0.8)
+    assert recall(store, data, "d3") >= (0.9 if quantization != "binary" else 0.8)
+
+
+@pytest.mark.parametrize("quantization", ["", "int8"])
+def test_ivf_filter_widens_probe(tmp_path, data, quantization):
+    store = build(tmp_path, data, "ivf", ivf_threshold=500, nprobe=1, quantization=quantization)
+    for query in data[2]:
+        result = search(store, query, "d_rare")
+        # 只有5个节点满足条件，逐步增加桶直到全部找到
+        assert sorted(result.ids) == sorted(node.node_id for node in data[0] if node.metadata["dir"] == "d_rare")
+        assert all(node.metadata["dir"] == "d_rare" for node in result.nodes)
+        assert search(store, query, "missing").ids == []
+
+
+@pytest.mark.parametrize("quantization", ["", "binary"])
+def test_persist_and_reload(tmp_path, data, quantization):
+    store = build(tmp_path, data, "store", ivf_threshold=500, quantization=quantization)
+    reloaded = LocalVectorStore(str(tmp_path / "store"), data[0], quantization=quantization)
+    for query in data[2][:5]:
+        assert search(reloaded, query).ids == search(store, query).ids
+        result = asyncio.run(reloaded.aquery(VectorStoreQuery(query_embedding=query.tolist(),
+                                                              similarity_top_k=TOP_K)))
+        assert result.ids == search(store, query).ids
+    with pytest.raises(ValueError):
+        LocalVectorStore(str(tmp_path / "store"), data[0], quantization="int8")
+    with pytest.raises(ValueError):
+        LocalVectorStore(str(tmp_path / "store"), data[0][:-1], quantization=quantization)
+
+
+def test_build_search_params():
+    assert build_search_params("") is None
+    assert build_search_params("", hnsw_ef=0) is None
+    assert build_search_params("", hnsw_ef=128) == models.SearchParams(hnsw_ef=128)
+    assert build_search_params("int8", oversampling=2.0) == models.SearchParams(
+        quantization=models.QuantizationSearchParams(rescore=True, oversampling=2.0))
+
+
+@pytest.mark.parametrize("quantization, default_ef", [("", None), ("binary", 64)])
+def test_qdrant_search_params_follow_request(tmp_path, quantization, default_ef):
+    nodes = [TextNode(text=f"text {i}", metadata={"file_path": f"doc{i}.txt", "dir": f"d{i % 2}"}) for i in range(20)]
+
+    async def search():
+        client, vector_store = await build_vector_store(
+            qdrant_url="", cache_path=str(tmp_path / "qdrant"), collection_name="c", vector_size=4,
+            quantization=quantization, hnsw_ef=default_ef)
+        await update_vector_store(client, vector_store, MockEmbedding(embed_dim=4), nodes, "c")
+        requests = []
+        search = client.search
+
+        async def recording_search(**kwargs):
+            requests.append(kwargs)
+            return await search(**kwargs)
+
+        client.search = recording_search
+        retriever = QdrantRetriever(vector_store, MockEmbedding(embed_dim=4), similarity_top_k=5)
+        default = await retriever.aretrieve(QueryBundle("query"))
+        with request_context(RequestContext(filters=build_qdrant_filters("d1"), hnsw_ef=256)):
+            filtered = await retriever.aretrieve(QueryBundle("query"))
+        return requests, default, filtered
+
+    requests, default, filtered = asyncio.run(search())
+    # 没有量化也没有hnsw_ef时沿用llama_index的默认查询，请求中的hnsw_ef优先于集合默认值且保留量化参数
+    default_params = build_search_params(quantization, hnsw_ef=default_ef)
+    assert [request.get("search_params") for request in requests] == \
+           [default_params, build_search_params(quantization, hnsw_ef=256)]
+    assert len(default) == 5
+    assert {node.metadata["dir"] for node in filtered} == {"d1"}
+
+
+def test_search_params_skip_non_default_modes(tmp_path):
+    async def store():
+        return (await build_vector_store(qdrant_url="", cache_path=str(tmp_path / "qdrant"), collection_name="c",
+                                         vector_size=4, quantization="int8"))[1]
+
+    vector_store = asyncio.run(store())
+    query = VectorStoreQuery(query_embedding=[0.1] * 4, mode=VectorStoreQueryMode.MMR)
+    assert vector_store.get_search_params(query, hnsw_ef=128) is None